@@ -0,0 +1,91 @@
+import math
+import struct
+import hashlib
+import logging
+
+import store
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+BLOOM_FILTER_NAME = "manifest.bloom"
+
+# Serialized as MAGIC, bit count (u64), hash count (u64), item count (u64), then the bits
+MAGIC = b"NDRBLOM1"
+HEADER = struct.Struct("<8sQQQ")
+
+
+class BloomFilter:
+    """
+    Set membership with no false negatives: if a key was added, it is always reported as
+    present, while keys that were never added are reported present with a small probability.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None, count=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self._bits = bytearray((num_bits + 7) // 8) if bits is None else bytearray(bits)
+
+    @classmethod
+    def for_capacity(cls, capacity, false_positive_rate):
+        # the standard optimal sizing for a filter holding capacity items
+        capacity = max(capacity, 1)
+        num_bits = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        num_hashes = max(1, round(num_bits / capacity * math.log(2)))
+        return cls(num_bits, num_hashes)
+
+    def add(self, key):
+        for index in self._indexes(key):
+            self._bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(key))
+
+    def false_positive_rate(self):
+        # the expected rate given the number of items actually added
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    def stats(self):
+        return {
+            "items": self.count,
+            "bytes": len(self._bits),
+            "hashes": self.num_hashes,
+            "false_positive_rate": self.false_positive_rate(),
+        }
+
+    def to_bytes(self):
+        return HEADER.pack(MAGIC, self.num_bits, self.num_hashes, self.count) + bytes(self._bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, num_bits, num_hashes, count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC:
+            raise ValueError("data is not a serialized bloom filter")
+        return cls(num_bits, num_hashes, bits=data[HEADER.size :], count=count)
+
+    def _indexes(self, key):
+        # Kirsch-Mitzenmacher double hashing: k indexes from the two halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return ((first + i * second) % self.num_bits for i in range(self.num_hashes))
+
+
+def write_bloom_filter(location, filepaths, false_positive_rate):
+    bloom_filter = BloomFilter.for_capacity(len(filepaths), false_positive_rate)
+    for filepath in filepaths:
+        bloom_filter.add(filepath)
+    store.put_artifact(location, BLOOM_FILTER_NAME, bloom_filter.to_bytes())
+    LOGGER.info("Wrote bloom filter to %s: %s", location, bloom_filter.stats())
+
+
+def load_bloom_filter(location):
+    path = store.fetch_artifact(location, BLOOM_FILTER_NAME)
+    if path is None:
+        LOGGER.warning("No bloom filter found at %s", location)
+        return None
+    with open(path, "rb") as file:
+        bloom_filter = BloomFilter.from_bytes(file.read())
+    LOGGER.info("Loaded bloom filter: %s", bloom_filter.stats())
+    return bloom_filter
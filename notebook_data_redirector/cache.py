@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Sentinel returned by TTLCache.get when a key is absent or expired, since None
+# is a legitimate (negative) cached value.
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded in-process cache with per-entry expiry and LRU eviction.  Entries whose
+    value is None are treated as negative results and expire after negative_ttl.
+    Lives at module scope in the lambdas so that it survives warm invocations.
+    """
+
+    def __init__(self, max_entries, ttl, negative_ttl=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self._clock():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return MISSING
+
+    def put(self, key, value):
+        ttl = self.negative_ttl if value is None else self.ttl
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self._entries)}
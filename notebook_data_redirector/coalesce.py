@@ -0,0 +1,100 @@
+import os
+import time
+import datetime
+import collections
+
+import cache
+
+# Box redelivers an event it doesn't see acknowledged within 30 seconds, and bulk uploads or
+# re-sharing a large folder produce storms of events on the same items.  Deliveries and
+# processed items are remembered for this many seconds.
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "600"))
+COALESCE_MAX_ENTRIES = int(os.environ.get("COALESCE_MAX_ENTRIES", "10000"))
+
+# how far Box's delivery timestamps may be ahead of our clock
+CLOCK_SKEW = 5
+
+
+class Coalescer:
+    """
+    Reduces a batch of queued webhook messages to the work it actually calls for.  Repeat
+    deliveries are dropped, events on the same item are merged, and events delivered before
+    the item was last processed are skipped, since processing reads the item's current
+    state from Box.  Lives at module scope in the worker, so that it spans warm invocations.
+    """
+
+    def __init__(self, window=COALESCE_WINDOW, max_entries=COALESCE_MAX_ENTRIES, clock=time.time):
+        self._clock = clock
+        self._deliveries = cache.TTLCache(max_entries, window, clock=clock)
+        self._processed = cache.TTLCache(max_entries, window, clock=clock)
+        self._pending = {}
+        self.dropped = 0
+
+    def coalesce(self, messages):
+        # Takes (message_id, message) pairs and returns an ordered (box_type, box_id) ->
+        # [message_id] dict, listing the queued messages each item's processing stands for
+        items = collections.OrderedDict()
+        self._pending = {}
+        delivery_ids = set()
+        for message_id, message in messages:
+            key = (message["box_type"], message["box_id"])
+            delivery_id = message.get("delivery_id")
+            if delivery_id and (delivery_id in delivery_ids or self._deliveries.get(delivery_id) is not cache.MISSING):
+                self.dropped += 1
+                continue
+
+            processed_at = self._processed.get(key)
+            delivered_at = _parse_timestamp(message.get("delivered_at"))
+            if processed_at is not cache.MISSING and delivered_at is not None:
+                if delivered_at + CLOCK_SKEW < processed_at:
+                    self.dropped += 1
+                    continue
+
+            # deliveries are only remembered once their item is processed, so that Box's
+            # retry of an event whose processing failed isn't dropped
+            if delivery_id:
+                delivery_ids.add(delivery_id)
+                self._pending.setdefault(key, []).append(delivery_id)
+            items.setdefault(key, []).append(message_id)
+        return items
+
+    def start_processing(self, box_type, box_id):
+        self._processed.put((box_type, box_id), self._clock())
+
+    def finish(self, box_type, box_id):
+        for delivery_id in self._pending.pop((box_type, box_id), ()):
+            self._deliveries.put(delivery_id, True)
+
+    def forget(self, box_type, box_id):
+        # processing failed, so later events on the item, and retries of these, mustn't be skipped
+        self._pending.pop((box_type, box_id), None)
+        self._processed.invalidate((box_type, box_id))
+
+
+def collapse_folders(folders):
+    # Given a folder_id -> folder dict, returns a folder_id -> [folder_id] dict mapping the
+    # folders with no ancestor among the others to themselves and the folders below them,
+    # so that a walk of each of the former covers all of the latter.
+    roots = collections.OrderedDict()
+    nested = {}
+    for folder_id, folder in folders.items():
+        ancestor_ids = [entry["id"] for entry in folder.path_collection["entries"]]
+        root_id = next((ancestor_id for ancestor_id in ancestor_ids if ancestor_id in folders), None)
+        if root_id is None:
+            roots[folder_id] = [folder_id]
+        else:
+            nested[folder_id] = root_id
+
+    for folder_id, root_id in nested.items():
+        # the outermost ancestor in the set may itself be nested in another
+        while root_id not in roots:
+            root_id = nested[root_id]
+        roots[root_id].append(folder_id)
+    return roots
+
+
+def _parse_timestamp(timestamp):
+    try:
+        return datetime.datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return None
@@ -1,18 +1,35 @@
 import os
+import hmac
+import time
 import json
+import base64
+import hashlib
+import datetime
 import logging
+import functools
+import itertools
+import collections
+import concurrent.futures
 
 import boto3
 from boxsdk import Client, JWTAuth
 from boxsdk.exception import BoxAPIException
+from boxsdk.session.session import AuthorizedSession
+
+import cache
+import ratelimit
+from manifest import BATCH_GET_SIZE, DYNAMODB_READS, batch_get_items, batch_write_items, get_filepaths, is_deleted
+from manifest import delete_item, get_path_root, put_item, query_folder_items, write_items
+from manifest import MANIFEST_TABLE_NAME, get_ddb_table, get_download_url, scan_items  # noqa: F401
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
 SECRET_ARN = os.environ["SECRET_ARN"]
-MANIFEST_TABLE_NAME = os.environ["MANIFEST_TABLE_NAME"]
 BOX_FOLDER_ID = os.environ["BOX_FOLDER_ID"]
 SECRET_ROLE_ARN = os.environ["SECRET_ROLE_ARN"]
+STATE_TABLE_NAME = os.environ["STATE_TABLE_NAME"]
+FOLDER_TABLE_NAME = os.environ["FOLDER_TABLE_NAME"]
 
 
 HANDLED_FILE_TRIGGERS = {
@@ -35,13 +52,130 @@ HANDLED_FOLDER_TRIGGERS = {
 
 HANDLED_TRIGGERS = HANDLED_FILE_TRIGGERS | HANDLED_FOLDER_TRIGGERS
 
-GET_ITEMS_FIELDS = {"name", "path_collection", "shared_link"}
+# Listings don't request path_collection, since iterate_files already knows each item's
+# ancestry and attaches it itself.  type, id, etag and sequence_id are always returned.
+# content_modified_at goes into the fingerprints sync uses to pass over unchanged folders.
+GET_ITEMS_FIELDS = {"name", "shared_link", "content_modified_at"}
 
 GET_ITEMS_LIMIT = 1000
 
+# number of folders listed concurrently while walking the Box tree
+TRAVERSAL_WORKERS = int(os.environ.get("TRAVERSAL_WORKERS", "8"))
+
+# Warm invocations reuse the secret and the authenticated Box client, which otherwise cost
+# a Secrets Manager read, a JWT authentication and a users listing every time.  Both are
+# dropped after this many seconds, so that rotated credentials are picked up, or as soon
+# as Box rejects the client's credentials.  Access tokens themselves are refreshed by
+# JWTAuth when they expire.
+BOX_CLIENT_TTL = float(os.environ.get("BOX_CLIENT_TTL", "3600"))
+_BOX_CLIENT_CACHE = cache.TTLCache(2, BOX_CLIENT_TTL)
+
+# Whether each folder is public is cached in the folder table, so that checking a file's
+# ancestors costs one batched read rather than a Box call per ancestor.  Entries record the
+# folder's etag, which changes whenever the folder does, and their publicity is disregarded
+# after this many seconds regardless.  The entries themselves stay, since they also record
+# where each folder is, which mustn't be forgotten while rows beneath it remain.
+FOLDER_CACHE_TTL = int(os.environ.get("FOLDER_CACHE_TTL", "86400"))
+
+# Box signs every webhook delivery along with its delivery timestamp, and recommends
+# rejecting deliveries older than ten minutes so that captured requests can't be replayed.
+WEBHOOK_MAX_AGE = int(os.environ.get("WEBHOOK_MAX_AGE", "600"))
+
+# Box allows about 1000 requests per minute per user, which every Box call shares.  Each
+# kind of call also has its own concurrency cap, and calls throttled with a 429 are
+# retried after the Retry-After delay Box asks for, by the Limiter alone, see LimitedSession.
+BOX_REQUESTS_PER_SECOND = float(os.environ.get("BOX_REQUESTS_PER_SECOND", "15"))
+BOX_BUCKET = ratelimit.TokenBucket(BOX_REQUESTS_PER_SECOND)
+BOX_ITEMS = ratelimit.Limiter("Box items", BOX_BUCKET, int(os.environ.get("BOX_ITEMS_CONCURRENCY", "8")))
+BOX_LISTINGS = ratelimit.Limiter("Box listings", BOX_BUCKET, int(os.environ.get("BOX_LISTINGS_CONCURRENCY", "8")))
+BOX_SHARED_LINKS = ratelimit.Limiter(
+    "Box shared links", BOX_BUCKET, int(os.environ.get("BOX_SHARED_LINKS_CONCURRENCY", "4"))
+)
+
+# Threads creating and removing shared links while a walk carries on.  BOX_SHARED_LINKS
+# still caps the calls in flight, so this only needs to keep it busy.
+SHARED_LINK_WORKERS = int(os.environ.get("SHARED_LINK_WORKERS", "8"))
+
 
 def get_box_client():
-    secret = _get_secret()
+    box_client = _BOX_CLIENT_CACHE.get("box_client")
+    if box_client is cache.MISSING:
+        box_client = _create_box_client(get_secret())
+        _BOX_CLIENT_CACHE.put("box_client", box_client)
+    return box_client
+
+
+def get_secret():
+    secret = _BOX_CLIENT_CACHE.get("secret")
+    if secret is cache.MISSING:
+        secret = _get_secret()
+        _BOX_CLIENT_CACHE.put("secret", secret)
+    return secret
+
+
+def invalidate_box_client():
+    _BOX_CLIENT_CACHE.clear()
+
+
+def invalidating_box_client(handler):
+    # Decorates a handler so that a 401 from Box drops the cached client and secret before
+    # the error propagates, and the next invocation authenticates afresh.
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        try:
+            return handler(*args, **kwargs)
+        except BoxAPIException as e:
+            if e.status == 401:
+                LOGGER.warning("Box rejected the client's credentials, dropping the cached client")
+                invalidate_box_client()
+            raise
+
+    return wrapper
+
+
+def validate_webhook_message(body, headers, primary_signature_key, secondary_signature_key=None, now=None):
+    # The same check as boxsdk's Webhook.validate_message, plus the timestamp check, done
+    # locally so that invalid requests are rejected without a Box client.
+    headers = {name.lower(): value for name, value in (headers or {}).items()}
+    if headers.get("box-signature-version") != "1" or headers.get("box-signature-algorithm") != "HmacSHA256":
+        return False
+
+    timestamp = headers.get("box-delivery-timestamp")
+    try:
+        delivered_at = datetime.datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return False
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    if delivered_at.tzinfo is None or abs((now - delivered_at).total_seconds()) > WEBHOOK_MAX_AGE:
+        return False
+
+    for signature_key, signature_header in [
+        (primary_signature_key, "box-signature-primary"),
+        (secondary_signature_key, "box-signature-secondary"),
+    ]:
+        signature = headers.get(signature_header)
+        if signature_key and signature:
+            digest = hmac.new(signature_key.encode("utf-8"), body + timestamp.encode("utf-8"), hashlib.sha256)
+            if hmac.compare_digest(base64.b64encode(digest.digest()).decode("utf-8"), signature):
+                return True
+    return False
+
+
+class LimitedSession(AuthorizedSession):
+    """
+    A Box session that leaves 429s to the Limiter each call goes through, rather than
+    retrying them itself unseen by the shared TokenBucket, which then doesn't slow down.  The
+    session's other retries, such as for server errors and expired access tokens, remain.
+    """
+
+    def _get_retry_request_callable(self, network_response, attempt_number, request, skip_retry_codes, *args, **kwargs):
+        skip_retry_codes = set(skip_retry_codes) | {429}
+        return super()._get_retry_request_callable(
+            network_response, attempt_number, request, skip_retry_codes, *args, **kwargs
+        )
+
+
+def _create_box_client(secret):
 
     client_id = secret["box_client_id"]
     client_secret = secret["box_client_secret"]
@@ -61,7 +195,7 @@ def get_box_client():
     )
     auth.authenticate_instance()
 
-    client = Client(auth)
+    client = Client(auth, session=LimitedSession(auth))
 
     users = client.users()
     try:
@@ -86,17 +220,37 @@ def is_box_object_public(file):
     )
 
 
-def is_any_parent_public(client, file):
+def is_any_parent_public(client, file, folder_table=None):
     # checks if any parent folder of the file is public
     # necessary due to changes in the Box API when a folder is shared
+    # Parents cached in the folder table are answered with one batched read, and only the
+    # rest are fetched from Box, then cached in turn.
     filepath_collection = file.path_collection
     start_index = [e["id"] for e in filepath_collection["entries"]].index(BOX_FOLDER_ID)
-    for fpc in filepath_collection["entries"][start_index:]:
-        folder = get_folder(client, fpc["id"]).get()
-        if is_box_object_public(folder):
+    entries = filepath_collection["entries"][start_index:]
+
+    cached = {}
+    if folder_table is not None:
+        cached = get_folder_publicity(folder_table, {e["id"]: e.get("etag") for e in entries})
+        if any(cached.values()):
             return True
 
-    return False
+    public = False
+    fetched = []
+    for fpc in entries:
+        if fpc["id"] not in cached:
+            folder = get_folder(client, fpc["id"])
+            if folder is None:
+                # deleted since the file was fetched, so it can't make the file public
+                continue
+            fetched.append(folder)
+            if is_box_object_public(folder):
+                public = True
+                break
+
+    if folder_table is not None and fetched:
+        put_folder_publicity(folder_table, fetched)
+    return public
 
 
 def create_shared_link(client, file, **boxargs):
@@ -105,23 +259,139 @@ def create_shared_link(client, file, **boxargs):
     # technically this could be a file or a folder
     # create_shared_link returns a new object with the shared link; the original object is not modified
     # see boxsdk docstring
-    return file.create_shared_link(**boxargs)
+    return BOX_SHARED_LINKS.call(file.create_shared_link, **boxargs)
 
 
 def remove_shared_link(client, file):
     if not hasattr(file, "shared_link"):
         raise RuntimeError("cannot operate on summary file, call get() first")
-    # unlike create_shared_link, remove_shared_link returns a boolean indicating whether the operation was successful
-    # to avoid confusion, I'm going to get and return the new file without the shared link
-    response = file.remove_shared_link()
-    if not response:
+    # boxsdk's remove_shared_link only returns whether it worked, so make the same update
+    # ourselves, which returns the new file without the shared link and saves getting it again
+    file = BOX_SHARED_LINKS.call(file.update_info, data={"shared_link": None})
+    if file.shared_link is not None:
         # not sure how to reach this in testing
-        raise RuntimeError("boxsdk API call to remove_shared_link returned False")
-    return file.get()
+        raise RuntimeError("boxsdk API call to remove the shared link left it in place")
+    return file
+
+
+def get_folder_table():
+    return boto3.resource("dynamodb").Table(FOLDER_TABLE_NAME)
+
+
+def get_folder_publicity(folder_table, folder_etags):
+    # Returns a folder_id -> public dict for the folders in the folder_id -> etag dict whose
+    # cached entries are still current.  An etag of None matches any entry.
+    now = int(time.time())
+    publicity = {}
+    for item in batch_get_items(folder_table, [{"folder_id": folder_id} for folder_id in folder_etags]):
+        etag = folder_etags[item["folder_id"]]
+        if item["expires_at"] > now and etag in (None, item.get("etag")):
+            publicity[item["folder_id"]] = item["public"]
+    return publicity
+
+
+def put_folder_publicity(folder_table, folders, fingerprints=None, shared=None):
+    # fingerprints optionally maps folder ids to the fingerprint and descended_at time sync
+    # keeps for them, and shared to whether the folder's files are shared, which they also
+    # are when any ancestor is public.  Folders they don't cover keep those of their current
+    # entries.
+    fingerprints = dict(fingerprints or {})
+    shared = dict(shared or {})
+    uncovered = [folder.id for folder in folders if folder.id not in fingerprints or folder.id not in shared]
+    for folder_id, state in get_folder_states(folder_table, uncovered).items():
+        if "fingerprint" in state and folder_id not in fingerprints:
+            fingerprints[folder_id] = (state["fingerprint"], state["descended_at"])
+        if "shared" in state and folder_id not in shared:
+            shared[folder_id] = state["shared"]
+
+    expires_at = int(time.time()) + FOLDER_CACHE_TTL
+    items = {
+        folder.id: {
+            "folder_id": folder.id,
+            "public": is_box_object_public(folder),
+            "etag": getattr(folder, "etag", None),
+            "expires_at": expires_at,
+        }
+        for folder in folders
+    }
+    for folder in folders:
+        # remembered so that the rows beneath the folder can be found once it has moved or gone
+        if folder.id != BOX_FOLDER_ID and is_managed(folder):
+            items[folder.id]["path"] = get_filepath(folder)
+    for folder_id, (fingerprint, descended_at) in fingerprints.items():
+        if folder_id in items:
+            items[folder_id].update(fingerprint=fingerprint, descended_at=descended_at)
+    for folder_id, folder_shared in shared.items():
+        if folder_id in items:
+            items[folder_id]["shared"] = folder_shared
+    batch_write_items(folder_table, items.values())
+
+
+def get_folder_states(folder_table, folder_ids):
+    # returns a folder_id -> entry dict of the folders' entries in the folder table
+    return {item["folder_id"]: item for item in batch_get_items(folder_table, [{"folder_id": i} for i in folder_ids])}
+
+
+def get_folder_fingerprint(folder, shared):
+    # Digest of a folder as its parent's listing describes it, along with whether it inherits
+    # sharing.  Box updates a folder's etag when it's renamed, moved or re-shared, and its
+    # content_modified_at when its contents change.
+    shared_link = getattr(folder, "shared_link", None) or {}
+    fields = [
+        getattr(folder, "etag", None),
+        getattr(folder, "sequence_id", None),
+        getattr(folder, "content_modified_at", None),
+        shared_link.get("url"),
+        shared_link.get("effective_access"),
+        shared_link.get("effective_permission"),
+        shared,
+    ]
+    return hashlib.sha256(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+def move_folder_paths(folder_table, old_path, new_path):
+    # Rewrites the paths recorded for the folders beneath old_path, which has moved to
+    # new_path.  There's no index by path, but moves are rare and the table is small.
+    scan_kwargs = {
+        "FilterExpression": "begins_with(#path, :prefix)",
+        "ExpressionAttributeNames": {"#path": "path"},
+        "ExpressionAttributeValues": {":prefix": old_path + "/"},
+    }
+    items = []
+    while True:
+        scan_response = DYNAMODB_READS.call(folder_table.scan, **scan_kwargs)
+        items.extend(dict(item, path=new_path + item["path"][len(old_path) :]) for item in scan_response["Items"])
+        if not scan_response.get("LastEvaluatedKey"):
+            break
+        scan_kwargs["ExclusiveStartKey"] = scan_response["LastEvaluatedKey"]
+    batch_write_items(folder_table, items)
+    return len(items)
+
+
+def invalidate_folder_publicity(folder_table, folder_ids):
+    batch_write_items(folder_table, delete_keys=[{"folder_id": folder_id} for folder_id in set(folder_ids)])
+
+
+def get_state_table():
+    return boto3.resource("dynamodb").Table(STATE_TABLE_NAME)
+
+
+def get_state(state_table, state_key):
+    result = state_table.get_item(Key={"state_key": state_key})
+    return result.get("Item", {}).get("state")
+
+
+def put_state(state_table, state_key, state):
+    state_table.put_item(Item={"state_key": state_key, "state": state})
+
+
+def delete_state(state_table, state_key):
+    state_table.delete_item(Key={"state_key": state_key})
 
 
-def get_ddb_table():
-    return boto3.resource("dynamodb").Table(MANIFEST_TABLE_NAME)
+def is_managed(item):
+    # true if the item lives somewhere beneath the managed Box folder
+    return BOX_FOLDER_ID in [e["id"] for e in item.path_collection["entries"]]
 
 
 def get_filepath(file):
@@ -132,31 +402,246 @@ def get_filepath(file):
     return "/".join(filepath_tokens)
 
 
+# every attribute make_ddb_item writes
+MANIFEST_ATTRIBUTES = ("filepath", "box_file_id", "download_url", "path_root", "sequence_id")
+
+
 def make_ddb_item(file):
-    return {"filepath": get_filepath(file), "box_file_id": file.id, "download_url": file.shared_link["download_url"]}
+    filepath = get_filepath(file)
+    item = {
+        "filepath": filepath,
+        "box_file_id": file.id,
+        "download_url": file.shared_link["download_url"],
+        "path_root": get_path_root(filepath),
+    }
+    sequence_id = get_sequence_id(file)
+    if sequence_id is not None:
+        item["sequence_id"] = sequence_id
+    return item
+
+
+def get_sequence_id(item):
+    # Box sends sequence_id as a string, but the manifest compares it as a number
+    sequence_id = getattr(item, "sequence_id", None)
+    return None if sequence_id is None else int(sequence_id)
+
+
+def make_ddb_key(file):
+    return {"filepath": get_filepath(file)}
+
+
+def is_unchanged(file, shared, row):
+    # True if syncing the file would do nothing: it's public and described by its manifest
+    # row, or neither.  Rows record the version and public link of the file, which a listing
+    # returns too, so a steady-state sync only has to read and compare.  Rows written before
+    # path_root was are rewritten, since the path_root index leaves them out.
+    if not shared:
+        return row is None and not is_box_object_public(file)
+    return (
+        row is not None
+        and is_box_object_public(file)
+        and row.get("box_file_id") == file.id
+        and row.get("sequence_id") == get_sequence_id(file)
+        and row.get("download_url") == file.shared_link["download_url"]
+        and "path_root" in row
+    )
 
 
 def put_file_item(ddb_table, file):
+    # writes the file's row, returning how many rows changed
     if not is_box_object_public(file):
         raise ValueError("cannot put a file that hasn't been shared publicly")
 
-    # this could cause concurrency issues in a scenario where lots of threads were operating on the ddb at once
     item = make_ddb_item(file)
-    result = ddb_table.get_item(Key={"filepath": item["filepath"]})
-    if result.get("Item") != item:
-        ddb_table.put_item(Item=item)
+    replaced = put_item(ddb_table, item)
+    if replaced is None:
+        LOGGER.info("Row for file %s at %s is newer, leaving it", file.id, item["filepath"])
+        return 0
+    changed = int(replaced != item)
+    if is_deleted(replaced) or replaced.get("box_file_id") != file.id:
+        # a file that has moved leaves a row at its old path
+        changed += delete_box_file_items(ddb_table, file.id, keep=item["filepath"], sequence_id=item.get("sequence_id"))
+    return changed
 
 
 def delete_file_item(ddb_table, file):
-    ddb_table.delete_item(Key={"filepath": get_filepath(file)})
+    # deletes every row for the file, including those left at paths it has since moved from,
+    # returning how many were deleted
+    return delete_box_file_items(ddb_table, file.id, sequence_id=get_sequence_id(file))
+
+
+def delete_box_file_items(ddb_table, box_file_id, keep=None, sequence_id=None):
+    # deletes every row for the Box file but the one at `keep`, returning how many were deleted
+    filepaths = [filepath for filepath in get_filepaths(ddb_table, box_file_id) if filepath != keep]
+    deleted = 0
+    for filepath in filepaths:
+        if delete_item(ddb_table, filepath, box_file_id, sequence_id):
+            LOGGER.info("Deleted row for file %s at %s", box_file_id, filepath)
+            deleted += 1
+    return deleted
+
+
+def delete_folder_items(ddb_table, folder_path):
+    # Deletes every row beneath the folder at `folder_path` that hasn't been rewritten with a
+    # newer version since the index was read, returning how many were deleted
+    items = query_folder_items(ddb_table, folder_path)
+    skipped = write_items(ddb_table, delete_items=items)
+    LOGGER.info("Deleted %s rows beneath %s, skipping %s changed since", len(items) - skipped, folder_path, skipped)
+    return len(items) - skipped
+
+
+def move_folder_items(ddb_table, old_path, new_path):
+    # Moves every row beneath old_path to the same place beneath new_path, for a folder whose
+    # files are shared as they were before it moved, and so keep their download URLs.  Rows
+    # rewritten with a newer version since they were read are left alone.  Returns how many
+    # rows were moved.
+    keys = [{"filepath": item["filepath"]} for item in query_folder_items(ddb_table, old_path)]
+    rows = [row for row in batch_get_items(ddb_table, keys) if not is_deleted(row)]
+    moved_rows = []
+    for row in rows:
+        filepath = new_path + row["filepath"][len(old_path) :]
+        moved_rows.append(dict(row, filepath=filepath, path_root=get_path_root(filepath)))
+    skipped = write_items(ddb_table, put_items=moved_rows, delete_items=rows)
+    LOGGER.info("Moved %s rows from %s to %s, skipping %s changed since", len(rows), old_path, new_path, skipped)
+    return len(rows)
+
+
+def fix_shared_link(client, file, shared):
+    # creates or removes the file's shared link so that it's public exactly when it should
+    # be shared, returning the possibly updated file
+    if (not is_box_object_public(file)) and shared:
+        # this includes an api call
+        file = create_shared_link(client, file, access="open", allow_download=True)
+    elif (is_box_object_public(file)) and (not shared):
+        file = remove_shared_link(client, file)
+    return file
+
+
+def fix_shared_links(client, files, workers=None):
+    # Yields the (file, shared) pairs of `files` with each file's shared link fixed, see
+    # fix_shared_link.  Files whose link is already right pass straight through, and the
+    # rest are fixed by a pool of `workers` threads as `files` is consumed, so results come
+    # in the order they complete.  At most twice as many fixes as workers wait at once,
+    # which holds back whatever produces `files`.
+    workers = workers or SHARED_LINK_WORKERS
+    running = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for file, shared in files:
+            if is_box_object_public(file) == shared:
+                yield file, shared
+                continue
+            if len(running) >= 2 * workers:
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from (future.result() for future in done)
+            running.add(executor.submit(lambda f, s: (fix_shared_link(client, f, s), s), file, shared))
+        yield from (future.result() for future in concurrent.futures.as_completed(running))
+
+
+def write_file_item(ddb_table, file):
+    # makes the file's manifest row agree with whether it's public, returning how many rows changed
+    if is_box_object_public(file):
+        return put_file_item(ddb_table, file)
+    return delete_file_item(ddb_table, file)
+
+
+def sync_file(client, ddb_table, file, shared):
+    # makes the file's shared link and manifest row agree with whether it should be shared,
+    # returning the possibly updated file
+    file = fix_shared_link(client, file, shared)
+    write_file_item(ddb_table, file)
+    return file
+
+
+def sync_box_file(client, ddb_table, box_file_id, folder_table=None):
+    # Returns how many manifest rows changed, so callers can tell when nothing did
+    file = get_file(client, box_file_id)
+    if not file:
+        LOGGER.warning("File %s is missing (trashed or deleted)", box_file_id)
+        # we no longer know the file's path, but the index by id does
+        return delete_box_file_items(ddb_table, box_file_id)
+    if not is_managed(file):
+        LOGGER.info("File %s is not in the managed folder", box_file_id)
+        # it may have been moved out, leaving a row at its old path
+        return delete_file_item(ddb_table, file)
+
+    # if the file isn't public but any parent directory is, make a shared link
+    # if the file is public but no parent directory is, delete the shared link
+    file = fix_shared_link(client, file, is_any_parent_public(client, file, folder_table))
+    return write_file_item(ddb_table, file)
+
+
+def sync_box_folder(client, ddb_table, box_folder_id, folder_table=None):
+    # Returns how many manifest rows changed, like sync_box_file.
+    #
+    # The Box API doesn't appear to give us a way to list the contents of a trashed folder,
+    # but the folder table remembers where the folder was, so the rows beneath its old path
+    # can be found by a query.  Otherwise the sync lambda cleans them up.
+    folder = get_folder(client, box_folder_id)
+    state = {}
+    if folder_table is not None:
+        state = get_folder_states(folder_table, [box_folder_id]).get(box_folder_id, {})
+    old_path = state.get("path")
+    changed = 0
+    if not folder:
+        LOGGER.warning("Folder %s is missing (trashed or deleted)", box_folder_id)
+        if old_path is not None:
+            changed = delete_folder_items(ddb_table, old_path)
+        if folder_table is not None:
+            invalidate_folder_publicity(folder_table, [box_folder_id])
+        return changed
+    if folder.id != BOX_FOLDER_ID and not is_managed(folder):
+        LOGGER.info("Folder %s is not in the managed folder", box_folder_id)
+        if old_path is not None:
+            changed = delete_folder_items(ddb_table, old_path)
+            invalidate_folder_publicity(folder_table, [box_folder_id])
+        return changed
+
+    # files inherit publicity from the folder and any of its parents
+    folder_shared = is_box_object_public(folder)
+    if not folder_shared and folder.id != BOX_FOLDER_ID:
+        folder_shared = is_any_parent_public(client, folder, folder_table)
+
+    if old_path is not None and old_path != get_filepath(folder):
+        LOGGER.info("Folder %s has moved from %s", box_folder_id, old_path)
+        if state.get("shared") == folder_shared:
+            # its files are shared as they were, so their rows only have to follow it
+            changed = move_folder_items(ddb_table, old_path, get_filepath(folder))
+            move_folder_paths(folder_table, old_path, get_filepath(folder))
+            put_folder_publicity(folder_table, [folder], shared={folder.id: folder_shared})
+            return changed
+        # otherwise the walk below writes the rows at its new path
+        changed = delete_folder_items(ddb_table, old_path)
+
+    discovered = [(folder, folder_shared)]
+    walk = walk_folders(collections.deque([(folder, folder_shared)]), discovered=discovered)
+    counts = collections.Counter()
+
+    def changed_files():
+        # the rows of each chunk of files are read in one batch, so that unchanged files cost no writes
+        while True:
+            files = list(itertools.islice(walk, BATCH_GET_SIZE))
+            if not files:
+                return
+            rows = batch_get_items(ddb_table, [make_ddb_key(f) for f, _ in files])
+            rows = {row["filepath"]: row for row in rows if not is_deleted(row)}
+            for file, shared in files:
+                if is_unchanged(file, shared, rows.get(get_filepath(file))):
+                    counts["unchanged"] += 1
+                else:
+                    counts["touched"] += 1
+                    yield file, shared
+
+    for file, _ in fix_shared_links(client, changed_files()):
+        changed += write_file_item(ddb_table, file)
+    LOGGER.info(
+        "Synced folder %s: %s files touched, %s unchanged", box_folder_id, counts["touched"], counts["unchanged"]
+    )
 
-
-def get_download_url(ddb_table, filepath):
-    result = ddb_table.get_item(Key={"filepath": filepath})
-    if result.get("Item"):
-        return result["Item"]["download_url"]
-    else:
-        return None
+    # the folder's own entry is refreshed along with every folder below it
+    if folder_table is not None:
+        folders = [f for f, _ in discovered]
+        put_folder_publicity(folder_table, folders, shared={f.id: shared for f, shared in discovered})
+    return changed
 
 
 def get_file(client, box_file_id):
@@ -169,7 +654,7 @@ def get_folder(client, box_folder_id):
 
 def _get_box_resource(callback):
     try:
-        return callback()
+        return BOX_ITEMS.call(callback)
     except BoxAPIException as e:
         if e.status == 404:
             return None
@@ -177,24 +662,121 @@ def _get_box_resource(callback):
             raise e
 
 
-def iterate_files(folder, shared=False):
-    offset = 0
-    while True:
-        count = 0
-        for item in folder.get_items(limit=GET_ITEMS_LIMIT, offset=offset, fields=GET_ITEMS_FIELDS):
-            count += 1
-            if item.object_type == "folder":
-                # Here we're recursively calling iterate_files on a nested folder and
-                # receiving an iterator that contains all of its files.  "yield from"
-                # will yield each value from that iterator in turn.
-                yield from iterate_files(item, shared=shared or is_box_object_public(item))
-            elif item.object_type == "file":
-                yield item, shared
-        if count >= GET_ITEMS_LIMIT:
-            offset += count
-        else:
-            # unclear why pytest reports this break is never tested...
+def iterate_files(folder, shared=False, workers=None):
+    yield from walk_folders(collections.deque([(folder, shared)]), workers=workers)
+
+
+def walk_folders(pending, workers=None, should_stop=None, discovered=None, prune=None):
+    # Walks the folder tree breadth-first, listing up to `workers` folders concurrently since
+    # the walk is almost entirely Box latency.  `pending` is a deque of (folder, shared) pairs
+    # that folders discovered along the way join until a listing slot frees up, and each
+    # folder's files are yielded as soon as its listing completes.  Files inherit `shared`
+    # from any public ancestor.
+    #
+    # Once should_stop() returns true, no new listings start and the walk ends after yielding
+    # the files of those already running, leaving every folder not yet listed in `pending`.
+    # The (folder, shared) pair of every subfolder found along the way is also appended to
+    # `discovered`, if given.  Given `prune`, only the (folder, shared) pairs
+    # prune(subfolders) returns are walked further.
+    workers = workers or TRAVERSAL_WORKERS
+    running = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            while pending and len(running) < workers and not (should_stop and should_stop()):
+                running.add(executor.submit(list_folder, *pending.popleft()))
+            if not running:
+                break
+            done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                files, subfolders = future.result()
+                if discovered is not None:
+                    discovered.extend(subfolders)
+                pending.extend(prune(subfolders) if prune and subfolders else subfolders)
+                yield from files
+
+
+def dump_folder(folder, shared):
+    # a JSON-serializable record of a folder waiting to be walked, see load_folder
+    return {
+        "id": folder.id,
+        "name": folder.name,
+        # not every listing includes these
+        "sequence_id": getattr(folder, "sequence_id", None),
+        "etag": getattr(folder, "etag", None),
+        "path_collection": folder.path_collection,
+        "shared": shared,
+    }
+
+
+def load_folder(client, record):
+    # restores a folder saved with dump_folder, along with everything walk_folders needs
+    # to list it, without a round trip to Box
+    folder = client.folder(record["id"])
+    for field in ["name", "sequence_id", "etag", "path_collection"]:
+        setattr(folder, field, record[field])
+    return folder, record["shared"]
+
+
+def list_folder(folder, shared):
+    # Marker-based paging stays efficient on very large folders, unlike offsets.  Each page
+    # of GET_ITEMS_LIMIT items is its own limited call, so a listing of many pages takes as
+    # many tokens, and a throttled page is retried on its own, from its marker.
+    files = []
+    subfolders = []
+    path_collection = _get_child_path_collection(folder)
+    items = []
+    marker = None
+    try:
+        while True:
+            page, marker = BOX_LISTINGS.call(_get_items_page, folder, marker)
+            items.extend(page)
+            if marker is None:
+                break
+    except BoxAPIException as e:
+        if e.status != 404:
+            raise
+        # trashed or deleted since it was found, as can happen between checkpointed runs, so
+        # there's nothing beneath it to walk, and the rows beneath it go as stale ones do
+        LOGGER.warning("Folder %s is missing (trashed or deleted), passing over it", folder.id)
+        return files, subfolders
+    for item in items:
+        # stand in for the path_collection we didn't request, so get_filepath works as usual
+        item.path_collection = path_collection
+        if item.object_type == "folder":
+            subfolders.append((item, shared or is_box_object_public(item)))
+        elif item.object_type == "file":
+            files.append((item, shared))
+    return files, subfolders
+
+
+def _get_items_page(folder, marker):
+    # Returns the items of the page at `marker`, and the marker of the next page, or None
+    # after the last.  The collection boxsdk returns fetches a page whenever the last is used
+    # up, so it's read only until the marker moves on, and should Box return a short page
+    # before the last, the page after it is read again from its own marker by the next call.
+    collection = folder.get_items(limit=GET_ITEMS_LIMIT, marker=marker, use_marker=True, fields=GET_ITEMS_FIELDS)
+    items = []
+    for item in collection:
+        if items and collection.next_pointer() != marker:
+            return items, marker
+        marker = collection.next_pointer()
+        items.append(item)
+        if len(items) == GET_ITEMS_LIMIT:
             break
+    return items, collection.next_pointer()
+
+
+def _get_child_path_collection(folder):
+    entries = folder.path_collection["entries"] + [
+        {
+            "type": "folder",
+            "id": folder.id,
+            "sequence_id": folder.sequence_id,
+            "etag": folder.etag,
+            "name": folder.name,
+        }
+    ]
+    return {"total_count": len(entries), "entries": entries}
 
 
 def _get_secret():
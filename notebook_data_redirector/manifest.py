@@ -0,0 +1,312 @@
+import os
+import time
+import queue
+import threading
+import functools
+import concurrent.futures
+
+import boto3
+from botocore.exceptions import ClientError
+
+import ratelimit
+
+# This module holds the manifest table access shared by every lambda.  It must stay free
+# of boxsdk (and its JWT/cryptography dependencies) so that the redirector, which never
+# talks to Box, can be deployed without them and cold-start quickly.
+
+MANIFEST_TABLE_NAME = os.environ["MANIFEST_TABLE_NAME"]
+
+# global secondary index of the table by box_file_id, projecting the keys and whether the
+# row is deleted
+BOX_FILE_ID_INDEX_NAME = "box_file_id"
+# and by path_root, the first component of the filepath, sorted by filepath.  Querying it
+# reads only the rows under a folder's path rather than the whole table.  It also projects
+# what conditional deletes need, box_file_id, sequence_id and whether the row is deleted,
+# along with download_url, so that the rows it returns are whole.
+PATH_ROOT_INDEX_NAME = "path_root"
+
+# BatchGetItem accepts at most 100 keys per request
+BATCH_GET_SIZE = 100
+# and BatchWriteItem at most 25 requests
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_WORKERS = int(os.environ.get("BATCH_WRITE_WORKERS", "4"))
+
+# number of segments scanned in parallel when reading the whole table
+SCAN_SEGMENTS = int(os.environ.get("SCAN_SEGMENTS", "4"))
+
+# Every DynamoDB call goes through these limiters, which retry throttled requests with
+# jittered exponential backoff.  Requests per second are unlimited by default, which suits
+# on-demand tables, while reads and writes each have their own concurrency cap.
+DYNAMODB_REQUESTS_PER_SECOND = float(os.environ.get("DYNAMODB_REQUESTS_PER_SECOND", "0"))
+DYNAMODB_BUCKET = ratelimit.TokenBucket(DYNAMODB_REQUESTS_PER_SECOND)
+DYNAMODB_READS = ratelimit.Limiter(
+    "DynamoDB reads", DYNAMODB_BUCKET, int(os.environ.get("DYNAMODB_READ_CONCURRENCY", "16"))
+)
+DYNAMODB_WRITES = ratelimit.Limiter(
+    "DynamoDB writes", DYNAMODB_BUCKET, int(os.environ.get("DYNAMODB_WRITE_CONCURRENCY", "8"))
+)
+
+# Rows carry the Box sequence_id of the file version they describe, and writes are
+# conditional on it, so that a writer holding stale state can't undo a newer write.  A put
+# applies unless the row holds a newer version of the same file, and a delete only if the
+# row belongs to the file and isn't newer than the version the caller knows of.
+NOT_NEWER_CONDITION = "attribute_not_exists(sequence_id) OR box_file_id <> :box_file_id OR sequence_id <= :sequence_id"
+SAME_FILE_CONDITION = "box_file_id = :box_file_id AND attribute_not_exists(#deleted)"
+SAME_FILE_NOT_NEWER_CONDITION = (
+    "box_file_id = :box_file_id AND attribute_not_exists(#deleted)"
+    " AND (attribute_not_exists(sequence_id) OR sequence_id <= :sequence_id)"
+)
+
+# Deleting a row leaves a tombstone in its place, marked deleted and without a download_url,
+# which keeps the row's box_file_id and sequence_id so that a stale put of an older version
+# can't bring it back.  Readers pass over tombstones, and DynamoDB removes them once they
+# expire, by which time any writer that read the row before it was deleted has finished.
+TOMBSTONE_TTL = int(os.environ.get("TOMBSTONE_TTL", "86400"))
+DELETE_EXPRESSION = "SET #deleted = :deleted, expires_at = :expires_at REMOVE download_url"
+DELETE_NEWER_EXPRESSION = (
+    "SET #deleted = :deleted, expires_at = :expires_at, sequence_id = :sequence_id REMOVE download_url"
+)
+NOT_DELETED_FILTER = "attribute_not_exists(#deleted)"
+
+# marks the end of a segment in scan_items' page queue
+_SEGMENT_DONE = object()
+BATCH_MAX_ATTEMPTS = 8
+BATCH_RETRY_DELAY = 0.05
+
+
+def get_ddb_table():
+    return boto3.resource("dynamodb").Table(MANIFEST_TABLE_NAME)
+
+
+def get_download_url(ddb_table, filepath):
+    result = DYNAMODB_READS.call(ddb_table.get_item, Key={"filepath": filepath})
+    if result.get("Item") and not is_deleted(result["Item"]):
+        return result["Item"]["download_url"]
+    else:
+        return None
+
+
+def get_download_urls(ddb_table, filepaths):
+    # returns a filepath -> download_url dict; filepaths missing from the manifest are omitted
+    filepaths = list(dict.fromkeys(filepaths))
+    download_urls = {}
+    for start in range(0, len(filepaths), BATCH_GET_SIZE):
+        keys = [{"filepath": filepath} for filepath in filepaths[start : start + BATCH_GET_SIZE]]
+        request_items = {
+            ddb_table.name: {
+                "Keys": keys,
+                "ProjectionExpression": "#filepath, download_url, #deleted",
+                "ExpressionAttributeNames": {"#filepath": "filepath", "#deleted": "deleted"},
+            }
+        }
+        for item in _batch_get_items(ddb_table, request_items):
+            if not is_deleted(item):
+                download_urls[item["filepath"]] = item["download_url"]
+    return download_urls
+
+
+def is_deleted(item):
+    # true if the row is the tombstone of a deleted one
+    return bool(item.get("deleted"))
+
+
+def get_filepaths(ddb_table, box_file_id):
+    # Returns the filepaths of a Box file's rows.  There's normally at most one, but a file
+    # that has been moved may still have a row at its old path.  The index is eventually
+    # consistent, so rows written in the last moment may be missing.
+    query_kwargs = {
+        "IndexName": BOX_FILE_ID_INDEX_NAME,
+        "KeyConditionExpression": "#box_file_id = :box_file_id",
+        "FilterExpression": NOT_DELETED_FILTER,
+        "ExpressionAttributeNames": {"#box_file_id": "box_file_id", "#deleted": "deleted"},
+        "ExpressionAttributeValues": {":box_file_id": box_file_id},
+    }
+    filepaths = []
+    while True:
+        query_response = DYNAMODB_READS.call(ddb_table.query, **query_kwargs)
+        filepaths.extend(item["filepath"] for item in query_response["Items"])
+        if not query_response.get("LastEvaluatedKey"):
+            return filepaths
+        query_kwargs["ExclusiveStartKey"] = query_response["LastEvaluatedKey"]
+
+
+def get_path_root(filepath):
+    return filepath.split("/", 1)[0]
+
+
+def query_folder_items(ddb_table, folder_path):
+    # Returns the rows beneath the folder at `folder_path`, however deeply nested, with every
+    # attribute but deleted and expires_at, which the index projects.  Like get_filepaths,
+    # this reads an eventually consistent index.
+    query_kwargs = {
+        "IndexName": PATH_ROOT_INDEX_NAME,
+        "KeyConditionExpression": "#path_root = :path_root AND begins_with(#filepath, :prefix)",
+        "FilterExpression": NOT_DELETED_FILTER,
+        "ExpressionAttributeNames": {"#path_root": "path_root", "#filepath": "filepath", "#deleted": "deleted"},
+        "ExpressionAttributeValues": {":path_root": get_path_root(folder_path), ":prefix": folder_path + "/"},
+    }
+    items = []
+    while True:
+        query_response = DYNAMODB_READS.call(ddb_table.query, **query_kwargs)
+        items.extend(query_response["Items"])
+        if not query_response.get("LastEvaluatedKey"):
+            return items
+        query_kwargs["ExclusiveStartKey"] = query_response["LastEvaluatedKey"]
+
+
+def scan_items(ddb_table, attributes=None, segments=None):
+    # Streams every item in the table but tombstones, scanning `segments` disjoint segments
+    # of it at once.  Pages flow through a bounded queue, so a slow consumer holds back the
+    # scanning threads rather than letting the whole table pile up in memory.  Only the
+    # named attributes are read when given.
+    segments = segments or SCAN_SEGMENTS
+    scan_kwargs = {"TotalSegments": segments, "FilterExpression": NOT_DELETED_FILTER}
+    attribute_names = {"#deleted": "deleted"}
+    if attributes:
+        attribute_names.update({f"#attribute{i}": attribute for i, attribute in enumerate(attributes)})
+        scan_kwargs["ProjectionExpression"] = ", ".join(name for name in attribute_names if name != "#deleted")
+    scan_kwargs["ExpressionAttributeNames"] = attribute_names
+
+    pages = queue.Queue(maxsize=segments * 2)
+    stopped = threading.Event()
+
+    def put_page(page):
+        while not stopped.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def scan_segment(segment):
+        try:
+            kwargs = dict(scan_kwargs, Segment=segment)
+            while not stopped.is_set():
+                scan_response = DYNAMODB_READS.call(ddb_table.scan, **kwargs)
+                put_page(scan_response["Items"])
+
+                # If the data returned by a scan would exceed 1MB, DynamoDB will begin paging.
+                # The LastEvaluatedKey field is the placeholder used to request the next page.
+                if not scan_response.get("LastEvaluatedKey"):
+                    break
+                kwargs["ExclusiveStartKey"] = scan_response["LastEvaluatedKey"]
+            put_page(_SEGMENT_DONE)
+        except Exception as e:
+            put_page(e)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+        for segment in range(segments):
+            executor.submit(scan_segment, segment)
+        try:
+            remaining = segments
+            while remaining:
+                page = pages.get()
+                if page is _SEGMENT_DONE:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            # lets the scanning threads exit if we stop early
+            stopped.set()
+
+
+def put_item(ddb_table, item):
+    # Writes the item unless its row holds a newer version of the same file, returning the
+    # row it replaced ({} if there was none), or None if it wasn't written
+    kwargs = {"Item": item, "ReturnValues": "ALL_OLD"}
+    if item.get("sequence_id") is not None:
+        kwargs["ConditionExpression"] = NOT_NEWER_CONDITION
+        kwargs["ExpressionAttributeValues"] = {":box_file_id": item["box_file_id"], ":sequence_id": item["sequence_id"]}
+    response = _write_conditionally(ddb_table.put_item, **kwargs)
+    return None if response is None else response.get("Attributes", {})
+
+
+def delete_item(ddb_table, filepath, box_file_id, sequence_id=None):
+    # Replaces the file's row at filepath with a tombstone unless it's newer than
+    # sequence_id, returning whether it was deleted.  Without a sequence_id, any version of
+    # the row is deleted, and the tombstone keeps the row's own.
+    values = {":box_file_id": box_file_id, ":deleted": True, ":expires_at": int(time.time()) + TOMBSTONE_TTL}
+    if sequence_id is None:
+        condition, expression = SAME_FILE_CONDITION, DELETE_EXPRESSION
+    else:
+        condition, expression = SAME_FILE_NOT_NEWER_CONDITION, DELETE_NEWER_EXPRESSION
+        values[":sequence_id"] = sequence_id
+    response = _write_conditionally(
+        ddb_table.update_item,
+        Key={"filepath": filepath},
+        UpdateExpression=expression,
+        ConditionExpression=condition,
+        ExpressionAttributeNames={"#deleted": "deleted"},
+        ExpressionAttributeValues=values,
+    )
+    return response is not None
+
+
+def write_items(ddb_table, put_items=(), delete_items=()):
+    # The conditional counterpart of batch_write_items, for rows other writers may be
+    # updating at the same time.  BatchWriteItem doesn't take conditions, so the writes are
+    # made one by one, several at a time.  delete_items are rows as read from the table.
+    # Returns how many writes were skipped because the row had changed.
+    writes = [functools.partial(put_item, ddb_table, item) for item in put_items]
+    writes += [
+        functools.partial(delete_item, ddb_table, item["filepath"], item["box_file_id"], item.get("sequence_id"))
+        for item in delete_items
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WRITE_WORKERS) as executor:
+        results = list(executor.map(lambda write: write(), writes))
+    return sum(result is None or result is False for result in results)
+
+
+def _write_conditionally(callback, **kwargs):
+    # returns the response, or None if the condition failed
+    try:
+        return DYNAMODB_WRITES.call(callback, **kwargs)
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+            raise
+        return None
+
+
+def batch_write_items(ddb_table, put_items=(), delete_keys=()):
+    # Applies the puts and deletes in BatchWriteItem batches, several batches at a time
+    requests = [{"PutRequest": {"Item": item}} for item in put_items]
+    requests += [{"DeleteRequest": {"Key": key}} for key in delete_keys]
+    batches = [requests[start : start + BATCH_WRITE_SIZE] for start in range(0, len(requests), BATCH_WRITE_SIZE)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WRITE_WORKERS) as executor:
+        # list() re-raises the first failure, if any
+        list(executor.map(lambda batch: _batch_write(ddb_table, {ddb_table.name: batch}), batches))
+    return len(batches)
+
+
+def _batch_write(ddb_table, request_items):
+    for attempt in range(BATCH_MAX_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(ratelimit.backoff_delay(attempt, BATCH_RETRY_DELAY))
+        response = DYNAMODB_WRITES.call(ddb_table.meta.client.batch_write_item, RequestItems=request_items)
+        request_items = response.get("UnprocessedItems")
+        if not request_items:
+            return
+    raise RuntimeError(f"BatchWriteItem left unprocessed items after {BATCH_MAX_ATTEMPTS} attempts")
+
+
+def batch_get_items(ddb_table, keys):
+    # Reads the items with the given keys in BatchGetItem batches; missing keys are omitted
+    for start in range(0, len(keys), BATCH_GET_SIZE):
+        yield from _batch_get_items(ddb_table, {ddb_table.name: {"Keys": keys[start : start + BATCH_GET_SIZE]}})
+
+
+def _batch_get_items(ddb_table, request_items):
+    # The table resource's client speaks the same deserialized types as the table itself.
+    # DynamoDB may return a subset of the keys as UnprocessedKeys when throttled, which we
+    # retry with jittered exponential backoff, as DYNAMODB_READS does for whole requests.
+    for attempt in range(BATCH_MAX_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(ratelimit.backoff_delay(attempt, BATCH_RETRY_DELAY))
+        response = DYNAMODB_READS.call(ddb_table.meta.client.batch_get_item, RequestItems=request_items)
+        yield from response["Responses"].get(ddb_table.name, [])
+        request_items = response.get("UnprocessedKeys")
+        if not request_items:
+            return
+    raise RuntimeError(f"BatchGetItem left unprocessed keys after {BATCH_MAX_ATTEMPTS} attempts")
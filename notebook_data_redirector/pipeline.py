@@ -0,0 +1,172 @@
+import time
+import queue
+import logging
+import threading
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+# items waiting between two stages, unless the stage says otherwise
+QUEUE_SIZE = 1000
+
+# marks the end of the items sent to a stage's queue
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline.  process(item) returns an iterable of the items to pass on to
+    the next stage, which may be empty to drop the item, and runs on `workers` threads at
+    once.  The stage counts the items it receives and emits, and the time its workers
+    spend processing them.
+    """
+
+    def __init__(self, name, process, workers=1, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.process = process
+        self.workers = workers
+        self.queue_size = queue_size
+        self.received = 0
+        self.emitted = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, emitted, busy):
+        with self._lock:
+            self.received += 1
+            self.emitted += emitted
+            self.busy += busy
+
+    def metrics(self, elapsed):
+        # throughput is over the pipeline's whole run, while utilization is the share of the
+        # workers' time spent processing, which shows which stage is the bottleneck
+        return {
+            "received": self.received,
+            "emitted": self.emitted,
+            "per_second": self.received / elapsed if elapsed > 0 else 0.0,
+            "utilization": self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0,
+        }
+
+
+class Pipeline:
+    """
+    Streams the items of `source` through `stages`, each reading from a bounded queue fed by
+    the one before.  A full queue blocks the stage feeding it, so a slow stage holds back
+    those before it rather than letting items pile up in memory.  run() yields what the last
+    stage emits.  If any stage raises, the pipeline stops and run() raises the exception.
+    """
+
+    def __init__(self, source, stages):
+        self.source = source
+        self.stages = stages
+        self.elapsed = 0.0
+        self._queues = [queue.Queue(maxsize=stage.queue_size) for stage in stages]
+        self._output = queue.Queue(maxsize=QUEUE_SIZE)
+        self._remaining = [stage.workers for stage in stages]
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._errors = []
+
+    def run(self):
+        started_at = time.monotonic()
+        threads = [threading.Thread(target=self._feed, daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=self._work, args=(index,), daemon=True) for _ in range(stage.workers)
+            )
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(self._output)
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            # lets the threads exit if we stop early
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+            self.elapsed = time.monotonic() - started_at
+        if self._errors:
+            raise self._errors[0]
+
+    def metrics(self):
+        return {stage.name: stage.metrics(self.elapsed) for stage in self.stages}
+
+    def log_metrics(self):
+        for name, metrics in self.metrics().items():
+            LOGGER.info(
+                "Stage %s: %s in, %s out, %.1f per second, %.0f%% utilized",
+                name,
+                metrics["received"],
+                metrics["emitted"],
+                metrics["per_second"],
+                metrics["utilization"] * 100,
+            )
+
+    def _feed(self):
+        try:
+            for item in self.source:
+                if not self._put(self._queues[0], item):
+                    return
+        except Exception as e:
+            self._fail(e)
+            return
+        for _ in range(self.stages[0].workers):
+            self._put(self._queues[0], _DONE)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        next_queue = self._queues[index + 1] if index + 1 < len(self.stages) else self._output
+        while True:
+            item = self._get(self._queues[index])
+            if item is _DONE or self._stopped.is_set():
+                break
+            started_at = time.monotonic()
+            try:
+                results = list(stage.process(item))
+            except Exception as e:
+                self._fail(e)
+                return
+            stage.record(len(results), time.monotonic() - started_at)
+            for result in results:
+                if not self._put(next_queue, result):
+                    return
+
+        # the last worker of a stage to finish tells the next stage there's nothing more
+        with self._lock:
+            self._remaining[index] -= 1
+            finished = self._remaining[index] == 0
+        if finished:
+            workers = self.stages[index + 1].workers if index + 1 < len(self.stages) else 1
+            for _ in range(workers):
+                self._put(next_queue, _DONE)
+
+    def _fail(self, exception):
+        with self._lock:
+            self._errors.append(exception)
+        self._stopped.set()
+        # wakes run() if it's waiting for output
+        try:
+            self._output.put_nowait(_DONE)
+        except queue.Full:
+            pass
+
+    def _put(self, target, item):
+        # returns False if the pipeline stopped before there was room
+        while not self._stopped.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, source):
+        while not self._stopped.is_set():
+            try:
+                return source.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
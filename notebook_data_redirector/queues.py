@@ -0,0 +1,107 @@
+import os
+import json
+import uuid
+import threading
+import collections
+
+import boto3
+
+# The webhook receiver hands events to the webhook worker through this queue.  When
+# WEBHOOK_QUEUE_URL is unset, an in-process MemoryQueue stands in for SQS in tests and
+# local runs.
+WEBHOOK_QUEUE_URL = os.environ.get("WEBHOOK_QUEUE_URL")
+
+# SendMessageBatch accepts at most 10 messages
+SEND_BATCH_SIZE = 10
+
+_MEMORY_QUEUE = None
+
+
+def get_webhook_queue():
+    global _MEMORY_QUEUE
+    if WEBHOOK_QUEUE_URL:
+        return SQSQueue(WEBHOOK_QUEUE_URL)
+    if _MEMORY_QUEUE is None:
+        _MEMORY_QUEUE = MemoryQueue()
+    return _MEMORY_QUEUE
+
+
+class SQSQueue:
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self._client = boto3.client("sqs")
+
+    def send(self, message):
+        self._client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+    def send_batch(self, messages):
+        for start in range(0, len(messages), SEND_BATCH_SIZE):
+            entries = [
+                {"Id": str(i), "MessageBody": json.dumps(message)}
+                for i, message in enumerate(messages[start : start + SEND_BATCH_SIZE])
+            ]
+            response = self._client.send_message_batch(QueueUrl=self.queue_url, Entries=entries)
+            if response.get("Failed"):
+                raise RuntimeError(f"Failed to queue messages: {response['Failed']}")
+
+
+class MemoryQueue:
+    """
+    In-process stand-in for SQS.  drain() delivers the queued messages to a worker handler
+    in the same shape of event the Lambda SQS integration does, re-queuing the messages
+    the handler reports as failed until they have been received max_receives times.
+    """
+
+    def __init__(self, max_receives=3):
+        self.max_receives = max_receives
+        self.dead_letters = []
+        self._records = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def send(self, message):
+        record = {"messageId": str(uuid.uuid4()), "body": json.dumps(message), "receive_count": 0}
+        with self._lock:
+            self._records.append(record)
+
+    def send_batch(self, messages):
+        for message in messages:
+            self.send(message)
+
+    def receive(self, max_messages=10):
+        with self._lock:
+            records = [self._records.popleft() for _ in range(min(max_messages, len(self._records)))]
+        for record in records:
+            record["receive_count"] += 1
+        return records
+
+    def drain(self, handler, batch_size=10):
+        # returns the number of batches delivered
+        batches = 0
+        while self._records:
+            records = self.receive(batch_size)
+            event = {
+                "Records": [
+                    {
+                        "messageId": record["messageId"],
+                        "body": record["body"],
+                        "attributes": {"ApproximateReceiveCount": str(record["receive_count"])},
+                    }
+                    for record in records
+                ]
+            }
+            response = handler(event, None) or {}
+            batches += 1
+
+            failed = {failure["itemIdentifier"] for failure in response.get("batchItemFailures", [])}
+            for record in records:
+                if record["messageId"] not in failed:
+                    continue
+                if record["receive_count"] >= self.max_receives:
+                    self.dead_letters.append(json.loads(record["body"]))
+                else:
+                    with self._lock:
+                        self._records.append(record)
+        return batches
@@ -0,0 +1,129 @@
+import time
+import random
+import logging
+import threading
+import contextlib
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+# attempts at a throttled call before giving up and raising
+MAX_ATTEMPTS = 8
+BASE_DELAY = 0.05
+MAX_DELAY = 30
+
+# DynamoDB error codes that mean "slow down" rather than "this request is wrong"
+DYNAMODB_THROTTLING_CODES = {"ProvisionedThroughputExceededException", "ThrottlingException", "RequestLimitExceeded"}
+
+
+class TokenBucket:
+    """
+    Limits calls to `rate` per second, allowing bursts of up to `capacity` calls.  The
+    rate adapts to throttling: it halves each time the service pushes back (down to
+    min_rate) and recovers additively with every call that succeeds.  A rate of zero
+    disables the limit, but pauses requested by the service are still honoured.
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=None, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = rate / 20 if min_rate is None else min_rate
+        self.capacity = max(rate, 1) if capacity is None else capacity
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_at = clock()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Takes a token, sleeping until one is due.  Tokens are reserved under the lock and
+        # slept for outside it, so that waiting callers are served in order.
+        with self._lock:
+            now = self._clock()
+            wait = max(self._paused_until - now, 0)
+            if self.rate > 0:
+                self._tokens = min(self._tokens + (now - self._updated_at) * self.rate, self.capacity)
+                self._tokens -= 1
+                wait = max(wait, -self._tokens / self.rate)
+            self._updated_at = now
+        if wait > 0:
+            self._sleep(wait)
+
+    def throttle(self, delay):
+        # the service pushed back, so hold every caller for `delay` seconds and slow down
+        with self._lock:
+            self._paused_until = max(self._paused_until, self._clock() + delay)
+            if self.rate > 0:
+                self.rate = max(self.rate / 2, self.min_rate)
+
+    def recover(self):
+        with self._lock:
+            if 0 < self.rate < self.max_rate:
+                self.rate = min(self.rate + self.max_rate / 100, self.max_rate)
+
+
+class Limiter:
+    """
+    Wraps calls to one endpoint of a service.  Callers share the service's TokenBucket,
+    at most `concurrency` calls run at once (zero for no cap), and throttled calls are
+    retried after the delay the service asks for, or a jittered exponential backoff.
+    """
+
+    def __init__(self, name, bucket, concurrency=0):
+        self.name = name
+        self.bucket = bucket
+        self.throttled = 0
+        self._semaphore = threading.BoundedSemaphore(concurrency) if concurrency > 0 else None
+
+    def call(self, callback, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                with self._slot():
+                    result = callback(*args, **kwargs)
+            except Exception as e:
+                attempt += 1
+                delay = get_retry_delay(e, attempt)
+                if delay is None or attempt >= MAX_ATTEMPTS:
+                    raise
+                self.throttled += 1
+                LOGGER.warning("Throttled by %s, retrying in %.2f seconds (attempt %s)", self.name, delay, attempt)
+                self.bucket.throttle(delay)
+                continue
+            self.bucket.recover()
+            return result
+
+    def _slot(self):
+        return self._semaphore if self._semaphore is not None else contextlib.nullcontext()
+
+
+def get_retry_delay(exception, attempt):
+    # How long to wait before retrying the call that raised `exception`, or None if it
+    # shouldn't be retried.  Recognizes Box's BoxAPIException and botocore's ClientError
+    # by their attributes, so that this module doesn't need either library.
+    if getattr(exception, "status", None) == 429:
+        retry_after = _get_header(getattr(exception, "headers", None), "Retry-After")
+        try:
+            return min(float(retry_after), MAX_DELAY)
+        except (TypeError, ValueError):
+            return backoff_delay(attempt)
+
+    response = getattr(exception, "response", None)
+    if isinstance(response, dict) and response.get("Error", {}).get("Code") in DYNAMODB_THROTTLING_CODES:
+        return backoff_delay(attempt)
+
+    return None
+
+
+def backoff_delay(attempt, base=BASE_DELAY, cap=MAX_DELAY):
+    # "full jitter" exponential backoff, so that throttled callers don't retry in lockstep
+    return random.uniform(0, min(cap, base * 2**attempt))  # nosec B311
+
+
+def _get_header(headers, name):
+    if not headers:
+        return None
+    # boxsdk passes the requests headers, which are case-insensitive, but be safe with plain dicts
+    return headers.get(name, headers.get(name.lower()))
@@ -1,19 +1,57 @@
+import os
+import json
+import time
 import logging
 import urllib.parse
 
-import common
+import bloom
+import cache
+import store
+import manifest
+import snapshot
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
+# Lookups are cached for the lifetime of a warm container.  Misses get a shorter TTL
+# so that newly published files start redirecting quickly.
+CACHE_TTL = float(os.environ.get("REDIRECT_CACHE_TTL", "60"))
+CACHE_NEGATIVE_TTL = float(os.environ.get("REDIRECT_CACHE_NEGATIVE_TTL", "10"))
+CACHE_MAX_ENTRIES = int(os.environ.get("REDIRECT_CACHE_MAX_ENTRIES", "4096"))
+
+CACHE = cache.TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL)
+
+BULK_MAX_FILEPATHS = int(os.environ.get("BULK_MAX_FILEPATHS", "1000"))
+
+# The manifest snapshot and bloom filter written by sync are loaded once per container and
+# re-fetched after this many seconds, so that warm containers pick up later sync runs.
+SNAPSHOT_REFRESH_INTERVAL = float(os.environ.get("SNAPSHOT_REFRESH_INTERVAL", "900"))
+
+# When enabled, paths the bloom filter rules out are answered with a 404 without reading
+# DynamoDB.  Files published by the webhook since the last sync are not in the filter, so
+# they 404 until the next sync; only enable this where that delay is acceptable.
+BLOOM_FILTER_ENABLED = os.environ.get("BLOOM_FILTER_ENABLED", "false").lower() == "true"
+
+_ARTIFACT_STATE = {"snapshot": None, "bloom_filter": None, "loaded_at": None, "bloom_rejections": 0}
+
 
 def lambda_handler(event, context):
     filepath = urllib.parse.unquote(event["pathParameters"]["filepath"])
 
     LOGGER.info("Received request for %s", filepath)
 
-    ddb_table = common.get_ddb_table()
-    download_url = common.get_download_url(ddb_table, filepath)
+    manifest_snapshot = get_snapshot()
+    download_url = manifest_snapshot.get(filepath) if manifest_snapshot else None
+    if download_url is None and _is_unpublished(filepath):
+        LOGGER.info("Ruled out by bloom filter (%s rejections so far)", _ARTIFACT_STATE["bloom_rejections"])
+    elif download_url is None:
+        # not in the snapshot, so possibly published since the last sync
+        download_url = CACHE.get(filepath)
+        if download_url is cache.MISSING:
+            ddb_table = manifest.get_ddb_table()
+            download_url = manifest.get_download_url(ddb_table, filepath)
+            CACHE.put(filepath, download_url)
+        LOGGER.info("Cache stats: %s", CACHE.stats())
 
     if download_url is None:
         LOGGER.info("Not found, returning 404")
@@ -21,3 +59,95 @@ def lambda_handler(event, context):
     else:
         LOGGER.info("Redirecting to %s", download_url)
         return {"statusCode": 302, "headers": {"Location": download_url}}
+
+
+def bulk_lambda_handler(event, context):
+    # Resolves many filepaths in one request, so that notebooks can fetch all of their
+    # download URLs at startup with a single round trip.
+    try:
+        filepaths = json.loads(event["body"])["filepaths"]
+    except (TypeError, KeyError, ValueError):
+        filepaths = None
+    if not isinstance(filepaths, list) or not all(isinstance(f, str) for f in filepaths):
+        LOGGER.info("Malformed request, returning 400")
+        return _json_response(400, {"message": "request body must be a JSON object with a filepaths list"})
+    if len(filepaths) > BULK_MAX_FILEPATHS:
+        LOGGER.info("Received %s filepaths, returning 400", len(filepaths))
+        return _json_response(400, {"message": f"at most {BULK_MAX_FILEPATHS} filepaths may be resolved at once"})
+
+    LOGGER.info("Received bulk request for %s filepaths", len(filepaths))
+
+    manifest_snapshot = get_snapshot()
+    download_urls = {}
+    uncached_filepaths = []
+    for filepath in filepaths:
+        download_url = manifest_snapshot.get(filepath) if manifest_snapshot else None
+        if download_url is not None:
+            download_urls[filepath] = download_url
+            continue
+        if _is_unpublished(filepath):
+            continue
+
+        download_url = CACHE.get(filepath)
+        if download_url is cache.MISSING:
+            uncached_filepaths.append(filepath)
+        elif download_url is not None:
+            download_urls[filepath] = download_url
+
+    if uncached_filepaths:
+        ddb_table = manifest.get_ddb_table()
+        found = manifest.get_download_urls(ddb_table, uncached_filepaths)
+        for filepath in uncached_filepaths:
+            CACHE.put(filepath, found.get(filepath))
+        download_urls.update(found)
+    LOGGER.info("Cache stats: %s", CACHE.stats())
+
+    missing = [f for f in dict.fromkeys(filepaths) if f not in download_urls]
+    LOGGER.info("Resolved %s filepaths, %s not found", len(download_urls), len(missing))
+    return _json_response(200, {"download_urls": download_urls, "missing": missing})
+
+
+def get_snapshot():
+    _refresh_artifacts()
+    return _ARTIFACT_STATE["snapshot"]
+
+
+def get_bloom_filter():
+    _refresh_artifacts()
+    return _ARTIFACT_STATE["bloom_filter"]
+
+
+def _is_unpublished(filepath):
+    bloom_filter = get_bloom_filter() if BLOOM_FILTER_ENABLED else None
+    if bloom_filter is not None and filepath not in bloom_filter:
+        _ARTIFACT_STATE["bloom_rejections"] += 1
+        return True
+    return False
+
+
+def _refresh_artifacts():
+    if store.ARTIFACT_LOCATION is None:
+        return
+
+    loaded_at = _ARTIFACT_STATE["loaded_at"]
+    if loaded_at is None or time.monotonic() - loaded_at >= SNAPSHOT_REFRESH_INTERVAL:
+        _ARTIFACT_STATE["loaded_at"] = time.monotonic()
+        try:
+            manifest_snapshot = snapshot.load_snapshot(store.ARTIFACT_LOCATION)
+            bloom_filter = bloom.load_bloom_filter(store.ARTIFACT_LOCATION)
+        except Exception:
+            # the artifacts are only an optimization, DynamoDB can serve every request without them
+            LOGGER.exception("Failed to load the manifest snapshot or bloom filter")
+            return
+
+        if manifest_snapshot is not None:
+            if _ARTIFACT_STATE["snapshot"] is not None:
+                _ARTIFACT_STATE["snapshot"].close()
+            _ARTIFACT_STATE["snapshot"] = manifest_snapshot
+            LOGGER.info("Loaded manifest snapshot of %s items", len(manifest_snapshot))
+        if bloom_filter is not None:
+            _ARTIFACT_STATE["bloom_filter"] = bloom_filter
+
+
+def _json_response(status_code, body):
+    return {"statusCode": status_code, "headers": {"Content-Type": "application/json"}, "body": json.dumps(body)}
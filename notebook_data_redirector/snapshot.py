@@ -0,0 +1,97 @@
+import mmap
+import time
+import struct
+import logging
+
+import store
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+SNAPSHOT_NAME = "manifest.snapshot"
+
+# Snapshot layout, all integers little-endian:
+#
+#   header  MAGIC, record count (u64), creation time in epoch seconds (u64)
+#   index   count + 1 u64 offsets into the data section, the last marking its end
+#   data    records of utf-8 filepath + NUL + utf-8 download_url, sorted by filepath bytes
+#
+# Sorting on the encoded filepath lets readers binary search the mapped file directly
+# without deserializing it.
+MAGIC = b"NDRSNAP1"
+HEADER = struct.Struct("<8sQQ")
+OFFSET = struct.Struct("<Q")
+
+
+def encode_snapshot(download_urls, created_at=None):
+    if created_at is None:
+        created_at = int(time.time())
+
+    records = sorted(
+        (filepath.encode("utf-8"), download_url.encode("utf-8")) for filepath, download_url in download_urls.items()
+    )
+    offsets = [0]
+    for filepath, download_url in records:
+        offsets.append(offsets[-1] + len(filepath) + 1 + len(download_url))
+
+    return b"".join(
+        [HEADER.pack(MAGIC, len(records), created_at)]
+        + [OFFSET.pack(o) for o in offsets]
+        + [filepath + b"\0" + download_url for filepath, download_url in records]
+    )
+
+
+def write_snapshot(location, download_urls):
+    data = encode_snapshot(download_urls)
+    store.put_artifact(location, SNAPSHOT_NAME, data)
+    LOGGER.info("Wrote manifest snapshot of %s items (%s bytes) to %s", len(download_urls), len(data), location)
+
+
+def load_snapshot(location):
+    path = store.fetch_artifact(location, SNAPSHOT_NAME)
+    if path is None:
+        LOGGER.warning("No manifest snapshot found at %s", location)
+        return None
+    return Snapshot(path)
+
+
+class Snapshot:
+    """Read-only view of a snapshot file, memory-mapped so that only the pages touched by lookups are read."""
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, self.created_at = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError(f"{path} is not a manifest snapshot")
+        self._data_start = HEADER.size + OFFSET.size * (self.count + 1)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, filepath):
+        key = filepath.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            start, end = self._record_bounds(middle)
+            separator = self._mmap.find(b"\0", start, end)
+            record_key = self._mmap[start:separator]
+            if record_key < key:
+                low = middle + 1
+            elif record_key > key:
+                high = middle
+            else:
+                return self._mmap[separator + 1 : end].decode("utf-8")
+        return None
+
+    def close(self):
+        self._mmap.close()
+
+    def _record_bounds(self, index):
+        position = HEADER.size + OFFSET.size * index
+        start = OFFSET.unpack_from(self._mmap, position)[0]
+        end = OFFSET.unpack_from(self._mmap, position + OFFSET.size)[0]
+        return self._data_start + start, self._data_start + end
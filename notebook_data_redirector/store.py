@@ -0,0 +1,65 @@
+import os
+import tempfile
+import urllib.parse
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Sync publishes derived artifacts (such as the manifest snapshot) for the redirector to
+# read.  ARTIFACT_LOCATION is either an s3://bucket/prefix URL or a local directory, the
+# latter standing in for S3 in tests and local runs.  When unset, no artifacts are used.
+ARTIFACT_LOCATION = os.environ.get("ARTIFACT_LOCATION")
+
+# S3 artifacts are downloaded here before use, since Lambda only allows writes to /tmp
+ARTIFACT_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR", tempfile.gettempdir())
+
+
+def put_artifact(location, name, data):
+    if _is_s3(location):
+        bucket, key = _parse_s3(location, name)
+        boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=data)
+    else:
+        os.makedirs(location, exist_ok=True)
+        _write_atomic(os.path.join(location, name), data)
+
+
+def fetch_artifact(location, name):
+    # returns the path of a local copy of the artifact, or None if it doesn't exist
+    if _is_s3(location):
+        bucket, key = _parse_s3(location, name)
+        try:
+            response = boto3.client("s3").get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                return None
+            raise e
+        path = os.path.join(ARTIFACT_CACHE_DIR, name)
+        _write_atomic(path, response["Body"].read())
+        return path
+    else:
+        path = os.path.join(location, name)
+        return path if os.path.exists(path) else None
+
+
+def _write_atomic(path, data):
+    # Readers may have the previous version memory-mapped, so we never modify it in place.
+    # os.replace swaps the directory entry, leaving existing mappings of the old file intact.
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def _is_s3(location):
+    return location.startswith("s3://")
+
+
+def _parse_s3(location, name):
+    parsed = urllib.parse.urlparse(location)
+    prefix = parsed.path.strip("/")
+    key = f"{prefix}/{name}" if prefix else name
+    return parsed.netloc, key
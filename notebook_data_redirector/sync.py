@@ -1,55 +1,487 @@
+import os
+import json
+import time
+import zlib
+import base64
+import bisect
 import logging
+import itertools
+import collections
+import concurrent.futures
 
+import boto3
+import botocore.config
+from boxsdk.object.events import UserEventsStreamType
+
+import bloom
 import common
+import store
+import manifest
+import pipeline
+import snapshot
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.INFO)
 
+# false positive rate of the bloom filter the redirector uses to reject unknown paths
+BLOOM_FALSE_POSITIVE_RATE = float(os.environ.get("BLOOM_FALSE_POSITIVE_RATE", "0.01"))
+
+# Between full walks of the Box tree, sync only reconciles the items named in the Box
+# events stream since its last run.  A full walk still runs this often (in seconds) as a
+# safety net for anything the events stream misses, such as trashed files.
+FULL_SYNC_INTERVAL = int(os.environ.get("FULL_SYNC_INTERVAL", "86400"))
+
+SYNC_STATE_KEY = "sync"
+
+# Full syncs pass over folders whose fingerprint (see common.get_folder_fingerprint) hasn't
+# changed since they were last walked, keeping the rows beneath them, unless they were last
+# walked more than this many seconds ago.  Zero walks every folder on every full sync.
+FULL_DESCENT_INTERVAL = int(os.environ.get("FULL_DESCENT_INTERVAL", "604800"))
+
+# A full sync that can't finish within one invocation stops walking once this many seconds
+# remain, saves the folders it hasn't listed yet under CHECKPOINT_STATE_KEY, and the next
+# invocation resumes from there.
+CHECKPOINT_MARGIN = int(os.environ.get("CHECKPOINT_MARGIN", "120"))
+CHECKPOINT_STATE_KEY = "sync_checkpoint"
+# DynamoDB items hold at most 400KB, so the checkpoint is split across as many state items
+# of this many bytes as it needs, which the item under CHECKPOINT_STATE_KEY counts
+CHECKPOINT_CHUNK_SIZE = 300 * 1024
+
+# The checkpoint remembers which filepaths earlier invocations saw with a bloom filter, so
+# that it stays small.  A false positive only delays deleting a stale row to the next pass.
+SEEN_FALSE_POSITIVE_RATE = 0.001
+SEEN_MIN_CAPACITY = 10000
+
+# How full syncs are carried out.  "inline" walks the whole tree in this invocation, saving
+# checkpoints as needed.  "lambda" shards the tree by top-level folder and reconciles the
+# shards in parallel invocations of SYNC_WORKER_FUNCTION, and "process" does the same in a
+# local process pool, standing in for Lambda in tests and benchmarks.
+SYNC_DISPATCH = os.environ.get("SYNC_DISPATCH", "inline")
+SYNC_WORKER_FUNCTION = os.environ.get("SYNC_WORKER_FUNCTION")
+# shards reconciled at once
+SYNC_WORKERS = int(os.environ.get("SYNC_WORKERS", "4"))
+
+# Full sync walks stream files through a pipeline.  The walk lists TRAVERSAL_WORKERS folders
+# at once, "classify" passes over files that match their rows, "link" fixes shared links on
+# SHARED_LINK_WORKERS threads and "write" puts changed rows on SYNC_WRITE_WORKERS threads.
+# At most PIPELINE_QUEUE_SIZE files wait before each stage.
+SYNC_WRITE_WORKERS = int(os.environ.get("SYNC_WRITE_WORKERS", "4"))
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", "1000"))
+
+# the user events API returns at most 500 events per request
+EVENTS_PAGE_LIMIT = 500
+
+# user event types that can change a file's path, existence or shared link
+INCREMENTAL_EVENT_TYPES = {
+    "ITEM_CREATE",
+    "ITEM_UPLOAD",
+    "ITEM_COPY",
+    "ITEM_MOVE",
+    "ITEM_RENAME",
+    "ITEM_TRASH",
+    "ITEM_UNDELETE_VIA_TRASH",
+    "ITEM_SHARED_CREATE",
+    "ITEM_SHARED_UPDATE",
+    "ITEM_SHARED_UNSHARE",
+}
 
+
+@common.invalidating_box_client
 def lambda_handler(event, context):
     ddb_table = common.get_ddb_table()
+    state_table = common.get_state_table()
     box_client, _ = common.get_box_client()
+
+    state = common.get_state(state_table, SYNC_STATE_KEY) or {}
+    checkpoint = _load_checkpoint(state_table)
+    now = int(time.time())
+    if checkpoint is None and (
+        event.get("full_sync") or "stream_position" not in state or now - state["last_full_sync"] >= FULL_SYNC_INTERVAL
+    ):
+        # Record the stream position before walking, so that changes made during the walk are
+        # replayed by the next incremental run rather than lost.
+        stream_position = box_client.events().get_latest_stream_position(stream_type=UserEventsStreamType.ALL)
+        if SYNC_DISPATCH != "inline":
+            if sharded_full_sync(box_client, ddb_table):
+                common.put_state(
+                    state_table, SYNC_STATE_KEY, {"stream_position": stream_position, "last_full_sync": now}
+                )
+            else:
+                LOGGER.warning("Some shards ran out of time, the full sync will run again")
+            return
+        checkpoint = {"stream_position": stream_position, "started_at": now, "pending": None, "seen": None}
+
+    if checkpoint is not None:
+        checkpoint = full_sync(box_client, ddb_table, checkpoint, context)
+        if checkpoint["pending"]:
+            _save_checkpoint(state_table, checkpoint)
+            return
+        _delete_checkpoint(state_table)
+        state = {"stream_position": checkpoint["stream_position"], "last_full_sync": checkpoint["started_at"]}
+    else:
+        state["stream_position"] = incremental_sync(box_client, ddb_table, int(state["stream_position"]))
+
+    common.put_state(state_table, SYNC_STATE_KEY, state)
+
+
+def full_sync(box_client, ddb_table, checkpoint, context=None):
+    # Loads the whole manifest up front, so that the Box walk only has to write the rows that
+    # differ as it goes, and then deletes the rows it didn't find.  If the invocation
+    # runs low on time, the walk stops early and the returned checkpoint lists the folders
+    # still pending.  Rows are only deleted once a pass has covered the whole tree.
+    LOGGER.info("Loading items from DynamoDB")
+    existing_items = {item["filepath"]: item for item in common.scan_items(ddb_table, common.MANIFEST_ATTRIBUTES)}
+    LOGGER.info("Loaded %s items", len(existing_items))
+
+    if checkpoint["pending"] is None:
+        root_folder = common.get_folder(box_client, common.BOX_FOLDER_ID)
+        pending = collections.deque([(root_folder, common.is_box_object_public(root_folder))])
+        seen = bloom.BloomFilter.for_capacity(max(2 * len(existing_items), SEEN_MIN_CAPACITY), SEEN_FALSE_POSITIVE_RATE)
+        LOGGER.info("Checking files in Box")
+    else:
+        pending = collections.deque(common.load_folder(box_client, record) for record in checkpoint["pending"])
+        seen = bloom.BloomFilter.from_bytes(base64.b64decode(checkpoint["seen"]))
+        LOGGER.info("Resuming check of files in Box with %s folders pending", len(pending))
+
+    expected_items, _ = _walk(box_client, ddb_table, pending, context, existing_items=existing_items)
+    delete_items = []
+    if not pending:
+        # rows seen by earlier invocations of this pass were written then, so they're kept too
+        delete_items = [
+            item for filepath, item in existing_items.items() if filepath not in expected_items and filepath not in seen
+        ]
+    skipped = manifest.write_items(ddb_table, delete_items=delete_items)
+    LOGGER.info("Deleted %s items, skipping %s changed since", len(delete_items) - skipped, skipped)
+
+    if pending:
+        for filepath in expected_items:
+            seen.add(filepath)
+        LOGGER.info("Out of time with %s folders pending, saving checkpoint", len(pending))
+        return dict(
+            checkpoint,
+            pending=[common.dump_folder(folder, shared) for folder, shared in pending],
+            seen=base64.b64encode(seen.to_bytes()).decode("ascii"),
+        )
+
+    download_urls = {filepath: item["download_url"] for filepath, item in existing_items.items()}
+    for item in delete_items:
+        del download_urls[item["filepath"]]
+    download_urls.update((filepath, item["download_url"]) for filepath, item in expected_items.items())
+    _publish_artifacts(download_urls)
+    return dict(checkpoint, pending=[], seen=None)
+
+
+def sharded_full_sync(box_client, ddb_table):
+    # Each top-level folder of the managed folder is a shard, which a worker walks and then
+    # reconciles with the rows under its path prefix.  The coordinator reconciles the files
+    # directly in the managed folder itself, along with the rows under no current shard,
+    # such as those of a deleted top-level folder.  Returns whether every shard finished.
+    LOGGER.info("Loading items from DynamoDB")
+    existing_items = {item["filepath"]: item for item in common.scan_items(ddb_table, common.MANIFEST_ATTRIBUTES)}
+    LOGGER.info("Loaded %s items", len(existing_items))
+
     root_folder = common.get_folder(box_client, common.BOX_FOLDER_ID)
-    root_shared = common.is_box_object_public(root_folder)
+    files, subfolders = common.list_folder(root_folder, common.is_box_object_public(root_folder))
+    shards = {common.get_filepath(folder) + "/": common.dump_folder(folder, shared) for folder, shared in subfolders}
+    common.put_folder_publicity(common.get_folder_table(), [root_folder] + [folder for folder, _ in subfolders])
 
-    LOGGER.info("Checking files in Box")
-    shared_file_ids = set()
-    shared_filepaths = set()
-    count = 0
-    for file, shared in common.iterate_files(root_folder, shared=root_shared):
-        count += 1
-        if (not common.is_box_object_public(file)) and shared:
-            # this includes an API call
-            file = common.create_shared_link(box_client, file, access="open", allow_download=True)
-        elif (common.is_box_object_public(file)) and (not shared):
-            file = common.remove_shared_link(box_client, file)
-
-        if common.is_box_object_public(file):
-            shared_file_ids.add(file.id)
-            shared_filepaths.add(common.get_filepath(file))
-            common.put_file_item(ddb_table, file)
-        else:
-            common.delete_file_item(ddb_table, file)
-    LOGGER.info("Processed %s files", count)
-
-    LOGGER.info("Checking items in DynamoDB")
+    # start the shards with the most rows first, so that a large one doesn't hold up the end
+    sizes = collections.Counter(_get_shard_prefix(filepath) for filepath in existing_items)
+    prefixes = sorted(shards, key=lambda prefix: sizes[prefix], reverse=True)
+    LOGGER.info("Dispatching %s shards to %s workers (%s)", len(prefixes), SYNC_WORKERS, SYNC_DISPATCH)
+    results = DISPATCHERS[SYNC_DISPATCH]([shards[prefix] for prefix in prefixes])
+    for result in results:
+        LOGGER.info("Shard %s", result)
+
+    expected_items, _ = _walk(box_client, ddb_table, collections.deque(), None, files, existing_items)
+    delete_items = [
+        item
+        for filepath, item in existing_items.items()
+        if filepath not in expected_items and _get_shard_prefix(filepath) not in shards
+    ]
+    if all(result["complete"] for result in results):
+        # Rows written before path_root was are left out of the index the workers read, but
+        # a worker rewrites the row of every file it finds with one, so any still without
+        # are of files that are gone
+        keys = [
+            {"filepath": filepath}
+            for filepath, item in existing_items.items()
+            if "path_root" not in item and _get_shard_prefix(filepath) in shards
+        ]
+        rows = common.batch_get_items(ddb_table, keys) if keys else []
+        delete_items.extend(row for row in rows if "path_root" not in row and not common.is_deleted(row))
+    skipped = manifest.write_items(ddb_table, delete_items=delete_items)
+    LOGGER.info("Deleted %s items, skipping %s changed since", len(delete_items) - skipped, skipped)
+
+    if store.ARTIFACT_LOCATION:
+        # the rows were written by the workers, so rebuild the artifacts from the table
+        items = common.scan_items(ddb_table, ["filepath", "download_url"])
+        _publish_artifacts({item["filepath"]: item["download_url"] for item in items})
+
+    return all(result["complete"] for result in results)
+
+
+@common.invalidating_box_client
+def sync_shard(shard, context=None):
+    # Walks one shard of a sharded full sync, see sharded_full_sync.  Rows are only deleted
+    # if the walk finishes before the invocation runs low on time.
+    box_client, _ = common.get_box_client()
+    ddb_table = common.get_ddb_table()
+    folder, shared = common.load_folder(box_client, shard)
+    prefix = common.get_filepath(folder) + "/"
+
+    # the shard's rows share its path_root, so the index reads them alone
+    existing_items = {
+        item["filepath"]: item for item in common.query_folder_items(ddb_table, common.get_filepath(folder))
+    }
+    pending = collections.deque([(folder, shared)])
+    expected_items, written = _walk(box_client, ddb_table, pending, context, existing_items=existing_items)
+
+    delete_items = []
+    if not pending:
+        delete_items = [item for filepath, item in existing_items.items() if filepath not in expected_items]
+    skipped = manifest.write_items(ddb_table, delete_items=delete_items)
+    return {
+        "prefix": prefix,
+        "complete": not pending,
+        "written": written,
+        "deleted": len(delete_items),
+        "skipped": skipped,
+    }
+
+
+def shard_lambda_handler(event, context):
+    return sync_shard(event["shard"], context)
+
+
+def _dispatch_processes(shards):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        return list(executor.map(sync_shard, shards))
+
+
+def _dispatch_lambda(shards):
+    # a worker may run for as long as Lambda allows, so wait for it rather than retrying
+    config = botocore.config.Config(read_timeout=900, retries={"max_attempts": 0})
+    lambda_client = boto3.client("lambda", config=config)
+
+    def invoke(shard):
+        response = lambda_client.invoke(FunctionName=SYNC_WORKER_FUNCTION, Payload=json.dumps({"shard": shard}))
+        result = json.loads(response["Payload"].read())
+        if "FunctionError" in response:
+            raise RuntimeError(f"Sync worker failed: {result}")
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        return list(executor.map(invoke, shards))
+
+
+DISPATCHERS = {"process": _dispatch_processes, "lambda": _dispatch_lambda}
+
+
+def incremental_sync(box_client, ddb_table, stream_position):
+    LOGGER.info("Checking Box events since stream position %s", stream_position)
+    events = box_client.events()
+    changed_items = {}
     count = 0
-    scan_response = ddb_table.scan()
-    delete_keys = set()
     while True:
-        for item in scan_response["Items"]:
+        response = common.BOX_ITEMS.call(
+            events.get_events,
+            limit=EVENTS_PAGE_LIMIT,
+            stream_position=stream_position,
+            stream_type=UserEventsStreamType.ALL,
+        )
+        stream_position = response["next_stream_position"]
+        for box_event in response["entries"]:
             count += 1
-            if (item["box_file_id"] not in shared_file_ids) or (item["filepath"] not in shared_filepaths):
-                delete_keys.add(item["filepath"])
-
-        # If the data returned by a scan would exceed 1MB, DynamoDB will begin paging.
-        # The LastEvaluatedKey field is the placeholder used to request the next page.
-        if scan_response.get("LastEvaluatedKey"):
-            scan_response = ddb_table.scan(ExclusiveStartKey=scan_response["LastEvaluatedKey"])
-        else:
-            # this clause isn't reached by testing atm
+            source = box_event["source"] if "source" in box_event else None
+            if box_event["event_type"] in INCREMENTAL_EVENT_TYPES and source and "type" in source:
+                # many events may name the same item, but reconciling it once is enough
+                changed_items[(source["type"], source["id"])] = None
+        if len(response["entries"]) < EVENTS_PAGE_LIMIT:
             break
+    LOGGER.info("Processed %s events affecting %s items", count, len(changed_items))
+
+    folder_table = common.get_folder_table()
+    changed_rows = 0
+    for box_type, box_id in changed_items:
+        if box_type == "file":
+            changed_rows += common.sync_box_file(box_client, ddb_table, box_id, folder_table)
+        elif box_type == "folder":
+            changed_rows += common.sync_box_folder(box_client, ddb_table, box_id, folder_table)
+    LOGGER.info("Changed %s items", changed_rows)
+
+    if store.ARTIFACT_LOCATION and changed_rows:
+        # the published artifacts must describe the whole manifest, so rebuild them from the
+        # table, which is only worth it when the events changed some of its rows
+        items = common.scan_items(ddb_table, ["filepath", "download_url"])
+        _publish_artifacts({item["filepath"]: item["download_url"] for item in items})
+
+    return stream_position
+
+
+def _walk(box_client, ddb_table, pending, context, files=(), existing_items=None):
+    # Fixes the shared links of `files` and of every file under the `pending` folders, and
+    # writes the rows the public ones should have where they differ from `existing_items`.
+    # Returns the rows that should exist and how many were written.  Files that still match
+    # their rows are passed over, keeping their rows, as are folders whose fingerprint is
+    # unchanged, see FULL_DESCENT_INTERVAL.  The walk leaves folders in `pending` if the
+    # invocation runs low on time.  Every folder walked is recorded in the folder table
+    # along the way, which keeps the webhook's ancestor checks away from Box.
+    def should_stop():
+        return context is not None and context.get_remaining_time_in_millis() < CHECKPOINT_MARGIN * 1000
+
+    existing_items = existing_items or {}
+    folder_table = common.get_folder_table()
+    now = int(time.time())
+    fingerprints = {}
+    pruned = []
+
+    def prune(subfolders):
+        # runs on the walking thread, between listings
+        states = common.get_folder_states(folder_table, [folder.id for folder, _ in subfolders])
+        descend = []
+        for folder, shared in subfolders:
+            fingerprint = common.get_folder_fingerprint(folder, shared)
+            state = states.get(folder.id, {})
+            descended_at = state.get("descended_at", 0)
+            if state.get("fingerprint") == fingerprint and now - descended_at < FULL_DESCENT_INTERVAL:
+                pruned.append(folder)
+                fingerprints[folder.id] = (fingerprint, descended_at)
+            else:
+                descend.append((folder, shared))
+                fingerprints[folder.id] = (fingerprint, now)
+        return descend
+
+    discovered = [(folder, shared) for folder, shared in pending if hasattr(folder, "shared_link")]
+    walk = common.walk_folders(
+        pending, should_stop=should_stop, discovered=discovered, prune=prune if FULL_DESCENT_INTERVAL > 0 else None
+    )
+    unchanged_items = {}
+
+    def classify(file_shared):
+        # one worker, which alone writes unchanged_items
+        file, shared = file_shared
+        filepath = common.get_filepath(file)
+        row = existing_items.get(filepath)
+        if not common.is_unchanged(file, shared, row):
+            return [file_shared]
+        if row is not None:
+            unchanged_items[filepath] = row
+        return []
+
+    def fix_link(file_shared):
+        file = common.fix_shared_link(box_client, *file_shared)
+        return [file] if common.is_box_object_public(file) else []
+
+    def write(file):
+        item = common.make_ddb_item(file)
+        if existing_items.get(item["filepath"]) == item:
+            return [(item, "unchanged")]
+        return [(item, "skipped" if manifest.put_item(ddb_table, item) is None else "written")]
+
+    stages = [
+        pipeline.Stage("classify", classify, queue_size=PIPELINE_QUEUE_SIZE),
+        pipeline.Stage("link", fix_link, common.SHARED_LINK_WORKERS, PIPELINE_QUEUE_SIZE),
+        pipeline.Stage("write", write, SYNC_WRITE_WORKERS, PIPELINE_QUEUE_SIZE),
+    ]
+    files_pipeline = pipeline.Pipeline(itertools.chain(files, walk), stages)
+    expected_items = {}
+    outcomes = collections.Counter()
+    for item, outcome in files_pipeline.run():
+        expected_items[item["filepath"]] = item
+        outcomes[outcome] += 1
+    expected_items.update(unchanged_items)
+    files_pipeline.log_metrics()
+    LOGGER.info(
+        "Processed %s files: %s unchanged, wrote %s items, skipping %s changed since",
+        stages[0].received,
+        stages[0].received - stages[0].emitted,
+        outcomes["written"],
+        outcomes["skipped"],
+    )
+
+    if pruned:
+        kept = _keep_pruned_items(existing_items, pruned, expected_items)
+        LOGGER.info("Passed over %s unchanged folders, keeping their %s rows", len(pruned), kept)
+
+    # A fingerprint vouches for the folder's whole subtree, so folders left to walk, and
+    # their ancestors, keep the ones they had until a later walk finishes them
+    for folder, _ in pending:
+        for folder_id in [entry["id"] for entry in folder.path_collection["entries"]] + [folder.id]:
+            fingerprints.pop(folder_id, None)
+    folders = [folder for folder, _ in discovered]
+    common.put_folder_publicity(folder_table, folders, fingerprints, {f.id: shared for f, shared in discovered})
+    return expected_items, outcomes["written"]
+
+
+def _keep_pruned_items(existing_items, pruned, expected_items):
+    # copies the existing rows beneath the pruned folders into expected_items, returning how many
+    filepaths = sorted(existing_items)
+    kept = 0
+    for folder in pruned:
+        prefix = common.get_filepath(folder) + "/"
+        index = bisect.bisect_left(filepaths, prefix)
+        while index < len(filepaths) and filepaths[index].startswith(prefix):
+            expected_items[filepaths[index]] = existing_items[filepaths[index]]
+            index += 1
+            kept += 1
+    return kept
+
+
+def _get_shard_prefix(filepath):
+    # the prefix of the shard a row belongs to, or the filepath itself for files in the managed folder
+    return filepath.split("/", 1)[0] + "/" if "/" in filepath else filepath
+
+
+def _publish_artifacts(download_urls):
+    # Publish the manifest as a snapshot the redirector can serve without DynamoDB,
+    # and a bloom filter that lets it reject paths that were never published.  The rows are
+    # written by now, so a failure here mustn't keep the sync from recording its progress;
+    # the redirector keeps serving the last artifacts until a later sync replaces them.
+    if not store.ARTIFACT_LOCATION:
+        return
+    try:
+        snapshot.write_snapshot(store.ARTIFACT_LOCATION, download_urls)
+        bloom.write_bloom_filter(store.ARTIFACT_LOCATION, download_urls.keys(), BLOOM_FALSE_POSITIVE_RATE)
+    except Exception:
+        LOGGER.exception("Failed to publish the manifest snapshot or bloom filter to %s", store.ARTIFACT_LOCATION)
+
+
+def _load_checkpoint(state_table):
+    header = common.get_state(state_table, CHECKPOINT_STATE_KEY)
+    if header is None:
+        return None
+    generation, chunks = int(header["generation"]), int(header["chunks"])
+    data = b"".join(bytes(common.get_state(state_table, _get_chunk_key(generation, index))) for index in range(chunks))
+    return json.loads(zlib.decompress(data))
+
+
+def _save_checkpoint(state_table, checkpoint):
+    # Compressed, since the folder records repeat their ancestors' names and ids many times
+    # over.  Each checkpoint's chunks are written under keys of their own before the header
+    # that points to them, so that an invocation that dies part way leaves the last one whole.
+    data = zlib.compress(json.dumps(checkpoint).encode("utf-8"))
+    chunks = [data[start : start + CHECKPOINT_CHUNK_SIZE] for start in range(0, len(data), CHECKPOINT_CHUNK_SIZE)]
+    header = common.get_state(state_table, CHECKPOINT_STATE_KEY)
+    generation = int(header["generation"]) + 1 if header else 0
+    for index, chunk in enumerate(chunks):
+        common.put_state(state_table, _get_chunk_key(generation, index), chunk)
+    common.put_state(state_table, CHECKPOINT_STATE_KEY, {"generation": generation, "chunks": len(chunks)})
+    if header:
+        _delete_chunks(state_table, header)
+
+
+def _delete_checkpoint(state_table):
+    header = common.get_state(state_table, CHECKPOINT_STATE_KEY)
+    common.delete_state(state_table, CHECKPOINT_STATE_KEY)
+    if header:
+        _delete_chunks(state_table, header)
+
+
+def _delete_chunks(state_table, header):
+    for index in range(int(header["chunks"])):
+        common.delete_state(state_table, _get_chunk_key(int(header["generation"]), index))
+
 
-    for key in delete_keys:
-        ddb_table.delete_item(Key={"filepath": key})
-    LOGGER.info("Processed %s items", count)
+def _get_chunk_key(generation, index):
+    return f"{CHECKPOINT_STATE_KEY}/{generation}/{index}"
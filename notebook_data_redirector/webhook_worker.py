@@ -0,0 +1,92 @@
+import logging
+import json
+
+from boxsdk.exception import BoxAPIException
+
+import coalesce
+import common
+
+LOGGER = logging.getLogger(__name__)
+LOGGER.setLevel(logging.INFO)
+
+# drops repeat deliveries and already-processed events across warm invocations
+COALESCER = coalesce.Coalescer()
+
+
+@common.invalidating_box_client
+def lambda_handler(event, context):
+    # Processes a batch of webhook events queued by webhook_receiver.  Events that fail are
+    # reported back individually, so that only they are redelivered.
+    records = event["Records"]
+    messages = [(record["messageId"], json.loads(record["body"])) for record in records]
+    items = COALESCER.coalesce((message_id, message) for message_id, message in messages if is_handled(message))
+    LOGGER.info("Received %s webhook events on %s items", len(records), len(items))
+
+    client, _ = common.get_box_client()
+    ddb = common.get_ddb_table()
+    folder_table = common.get_folder_table()
+
+    failures = []
+    for box_type, box_id, covered in plan_work(client, items):
+        for covered_type, covered_id in covered:
+            COALESCER.start_processing(covered_type, covered_id)
+        try:
+            process_item(client, ddb, folder_table, box_type, box_id)
+        except Exception as e:
+            if isinstance(e, BoxAPIException) and e.status == 401:
+                # our credentials are bad, so every event would fail; retry the whole batch
+                raise
+            LOGGER.exception("Failed to process %s id %s", box_type, box_id)
+            for covered_type, covered_id in covered:
+                COALESCER.forget(covered_type, covered_id)
+                failures.extend({"itemIdentifier": message_id} for message_id in items[(covered_type, covered_id)])
+        else:
+            for covered_type, covered_id in covered:
+                COALESCER.finish(covered_type, covered_id)
+
+    return {"batchItemFailures": failures}
+
+
+def plan_work(client, items):
+    # Yields (box_type, box_id, covered) for each item to process, where covered lists the
+    # (box_type, box_id) keys of the events its processing settles.  Folders nested in
+    # other folders of the batch are left to the walk of their highest affected ancestor.
+    folders = {}
+    for box_type, box_id in items:
+        if box_type != "folder":
+            continue
+        try:
+            folder = common.get_folder(client, box_id)
+        except BoxAPIException as e:
+            if e.status == 401:
+                raise
+            # processing the folder on its own will report the failure
+            LOGGER.warning("Failed to look up folder %s: %s", box_id, e)
+            continue
+        if folder:
+            folders[box_id] = folder
+
+    roots = coalesce.collapse_folders(folders)
+    for box_type, box_id in items:
+        if box_type == "folder" and box_id in folders:
+            if box_id in roots:
+                yield box_type, box_id, [("folder", folder_id) for folder_id in roots[box_id]]
+        else:
+            yield box_type, box_id, [(box_type, box_id)]
+
+
+def is_handled(message):
+    trigger, box_type = message["trigger"], message["box_type"]
+    if box_type == "file":
+        return trigger in common.HANDLED_FILE_TRIGGERS
+    if box_type == "folder":
+        return trigger in common.HANDLED_FOLDER_TRIGGERS
+    return False
+
+
+def process_item(client, ddb, folder_table, box_type, box_id):
+    LOGGER.info("Processing %s id %s", box_type, box_id)
+    if box_type == "file":
+        common.sync_box_file(client, ddb, box_id, folder_table)
+    elif box_type == "folder":
+        common.sync_box_folder(client, ddb, box_id, folder_table)
@@ -5,6 +5,7 @@ import subprocess
 import boto3
 from pathlib import Path
 import os
+import sys
 
 def parse_args():
     parser = argparse.ArgumentParser("install_webhook.py", description="install a webhook on a Box folder that points to a notebook-data-redirector stack")
@@ -22,9 +23,13 @@ webhook_url = next(o["OutputValue"] for o in stack["Outputs"] if o["OutputKey"]
 
 os.environ["SECRET_ARN"] = args.secret_arn
 os.environ["MANIFEST_TABLE_NAME"] = "dummy"
+os.environ["STATE_TABLE_NAME"] = "dummy"
+os.environ["FOLDER_TABLE_NAME"] = "dummy"
 os.environ["BOX_FOLDER_ID"] = args.box_folder_id
 
-from notebook_data_redirector import common
+# the lambda modules import each other as top-level modules
+sys.path.append(str(Path(__file__).resolve().parent.parent / "notebook_data_redirector"))
+import common
 
 client, _ = common.get_box_client()
 folder = client.folder(args.box_folder_id)
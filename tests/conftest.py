@@ -5,12 +5,15 @@ import string
 import hashlib
 import hmac
 import base64
+import threading
+import types
 from pathlib import Path
 
 import boxsdk
 import boxsdk.object.file
 import boxsdk.object.folder
 import pytest
+from botocore.exceptions import ClientError
 
 redirector_path = Path(__file__).resolve().parent.parent / "notebook_data_redirector"
 sys.path.append(str(redirector_path))
@@ -33,13 +36,18 @@ SECRET_ARN = "arn:aws:secretsmanager:test-region:000000000000:secret:test-secret
 SHARED_BOX_FOLDER_ID = "5"
 MANIFEST_TABLE_NAME = "test-manifest-table"
 SECRET_ROLE_ARN = "arn:aws:iam::000000000000:role/SecretsManager-User-mm-urlrd-ops"
+STATE_TABLE_NAME = "test-state-table"
+FOLDER_TABLE_NAME = "test-folder-table"
 
 
 os.environ["SECRET_ARN"] = SECRET_ARN
 os.environ["BOX_FOLDER_ID"] = SHARED_BOX_FOLDER_ID
 os.environ["MANIFEST_TABLE_NAME"] = MANIFEST_TABLE_NAME
 os.environ["SECRET_ROLE_ARN"] = SECRET_ROLE_ARN
+os.environ["STATE_TABLE_NAME"] = STATE_TABLE_NAME
+os.environ["FOLDER_TABLE_NAME"] = FOLDER_TABLE_NAME
 os.environ["AWS_DEFAULT_REGION"] = "gl-north-14"
+os.environ["BOX_REQUESTS_PER_SECOND"] = "0"
 
 
 @pytest.fixture(autouse=True)
@@ -63,6 +71,27 @@ def ddb_items():
     return []
 
 
+@pytest.fixture
+def ddb_tombstones():
+    # the manifest table's tombstones of deleted rows, kept apart from the live ddb_items
+    return []
+
+
+@pytest.fixture
+def state_items():
+    return {}
+
+
+@pytest.fixture
+def folder_items():
+    return {}
+
+
+@pytest.fixture
+def box_events():
+    return []
+
+
 @pytest.fixture
 def box_webhook_signature_key():
     return "".join(random.choices(string.ascii_letters + string.digits, k=32))
@@ -103,12 +132,13 @@ def create_file(box_files, create_shared_link, monkeypatch):
             file.shared_link = shared_link
             return file
 
-        def file_remove_shared_link():
-            file.shared_link = None
-            return True
+        def file_update_info(data, **kwargs):
+            for name, value in data.items():
+                setattr(file, name, value)
+            return file
 
         monkeypatch.setattr(file, "create_shared_link", file_create_shared_link)
-        monkeypatch.setattr(file, "remove_shared_link", file_remove_shared_link)
+        monkeypatch.setattr(file, "update_info", file_update_info)
 
         box_files.append(file)
         return file
@@ -138,27 +168,31 @@ def create_folder(box_folders, box_files, create_shared_link, monkeypatch):
 
         folder = boxsdk.object.folder.Folder(None, object_id, response_object)
 
-        def get_items(limit=100, offset=0, fields=None):
+        def get_items(limit=None, offset=0, marker=None, use_marker=False, fields=None):
+            # a trashed folder 404s, found by identity as siblings compare equal once get_url is patched
+            if not any(f is folder for f in box_folders):
+                raise boxsdk.exception.BoxAPIException(404)
             folder_items = [
                 f
                 for f in box_files + box_folders
                 if f.path_collection["total_count"] > 0 and f.path_collection["entries"][-1]["id"] == folder.id
             ]
-            return folder_items[offset : offset + limit]
+            return MockItems(folder_items[offset:], limit, marker)
 
         def folder_create_shared_link(**kwargs):
             shared_link = create_shared_link(**kwargs)
             folder.shared_link = shared_link
             return folder
 
-        def folder_remove_shared_link():
-            folder.shared_link = None
-            return True
+        def folder_update_info(data, **kwargs):
+            for name, value in data.items():
+                setattr(folder, name, value)
+            return folder
 
         monkeypatch.setattr(folder, "get_items", get_items)
         monkeypatch.setattr(folder, "get", lambda: folder)
         monkeypatch.setattr(folder, "create_shared_link", folder_create_shared_link)
-        monkeypatch.setattr(folder, "remove_shared_link", folder_remove_shared_link)
+        monkeypatch.setattr(folder, "update_info", folder_update_info)
         monkeypatch.setattr(folder, "get_url", lambda: folder.path_collection)
 
         box_folders.append(folder)
@@ -211,44 +245,238 @@ def create_shared_folder(create_folder, create_shared_link):
     return _create_shared_folder
 
 
+def _check_condition(item, condition, values):
+    # evaluates the few conditions the manifest module writes with
+    if condition is None:
+        return
+    import manifest
+
+    same_file = item.get("box_file_id") == values[":box_file_id"]
+    live_file = same_file and not item.get("deleted")
+    not_newer = ":sequence_id" not in values or item.get("sequence_id", 0) <= values[":sequence_id"]
+    passed = {
+        manifest.NOT_NEWER_CONDITION: not same_file or not_newer,
+        manifest.SAME_FILE_CONDITION: live_file,
+        manifest.SAME_FILE_NOT_NEWER_CONDITION: live_file and not_newer,
+    }[condition]
+    if not passed:
+        raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": "failed"}}, "PutItem")
+
+
 @pytest.fixture
-def mock_ddb_table(ddb_items):
+def mock_ddb_table(ddb_items, ddb_tombstones):
+    class MockTableClient:
+        # the most keys processed per batch call, the remainder are returned as unprocessed
+        BATCH_PROCESSED_LIMIT = None
+
+        def __init__(self, table):
+            self._table = table
+            # batches are written from several threads at once
+            self._lock = threading.Lock()
+
+        def batch_write_item(self, RequestItems):
+            requests = RequestItems[MockTable.name][: self.BATCH_PROCESSED_LIMIT]
+            unprocessed_requests = RequestItems[MockTable.name][len(requests) :]
+            assert len(requests) + len(unprocessed_requests) <= 25
+
+            with self._lock:
+                for request in requests:
+                    if "PutRequest" in request:
+                        self._table.put_item(Item=request["PutRequest"]["Item"])
+                    else:
+                        self._table.delete_item(Key=request["DeleteRequest"]["Key"])
+
+            response = {"UnprocessedItems": {}}
+            if unprocessed_requests:
+                response["UnprocessedItems"][MockTable.name] = unprocessed_requests
+            return response
+
+        def batch_get_item(self, RequestItems):
+            request = RequestItems[MockTable.name]
+            keys = request["Keys"][: self.BATCH_PROCESSED_LIMIT]
+            unprocessed_keys = request["Keys"][len(keys) :]
+
+            items = [self._table.get_item(Key=k).get("Item") for k in keys]
+            response = {"Responses": {MockTable.name: [i for i in items if i]}, "UnprocessedKeys": {}}
+            if unprocessed_keys:
+                response["UnprocessedKeys"][MockTable.name] = dict(request, Keys=unprocessed_keys)
+            return response
+
     class MockTable:
         BATCH_SIZE = 5
+        name = MANIFEST_TABLE_NAME
 
-        def put_item(self, Item):
-            self.delete_item({"filepath": Item["filepath"]})
+        def __init__(self):
+            self.meta = types.SimpleNamespace(client=MockTableClient(self))
+
+        def _items(self):
+            return ddb_items + ddb_tombstones
+
+        def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, ReturnValues=None):
+            old_item = next((i for i in self._items() if i["filepath"] == Item["filepath"]), {})
+            _check_condition(old_item, ConditionExpression, ExpressionAttributeValues)
+            if old_item:
+                (ddb_tombstones if old_item.get("deleted") else ddb_items).remove(old_item)
             ddb_items.append(Item)
+            return {"Attributes": old_item} if old_item and ReturnValues == "ALL_OLD" else {}
 
-        def delete_item(self, Key):
+        def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None):
             item = next((i for i in ddb_items if {i[k] for k in Key.keys()} == set(Key.values())), None)
+            _check_condition(item or {}, ConditionExpression, ExpressionAttributeValues)
             if item:
                 ddb_items.remove(item)
+            return {}
+
+        def update_item(
+            self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues
+        ):
+            # only the tombstones manifest.delete_item leaves
+            import manifest
+
+            assert UpdateExpression in [manifest.DELETE_EXPRESSION, manifest.DELETE_NEWER_EXPRESSION]
+            item = next((i for i in self._items() if i["filepath"] == Key["filepath"]), {})
+            _check_condition(item, ConditionExpression, ExpressionAttributeValues)
+            ddb_items.remove(item)
+            tombstone = {k: v for k, v in item.items() if k != "download_url"}
+            tombstone.update(deleted=True, expires_at=ExpressionAttributeValues[":expires_at"])
+            if UpdateExpression == manifest.DELETE_NEWER_EXPRESSION:
+                tombstone["sequence_id"] = ExpressionAttributeValues[":sequence_id"]
+            ddb_tombstones.append(tombstone)
+            return {}
 
         def get_item(self, Key):
             result = {}
-            item = next((i for i in ddb_items if {i[k] for k in Key.keys()} == set(Key.values())), None)
+            item = next((i for i in self._items() if {i[k] for k in Key.keys()} == set(Key.values())), None)
             if item:
                 result["Item"] = item
             return result
 
-        def scan(self, ExclusiveStartKey=None):
+        def query(
+            self,
+            IndexName,
+            KeyConditionExpression,
+            FilterExpression,
+            ExpressionAttributeNames,
+            ExpressionAttributeValues,
+            ExclusiveStartKey=None,
+        ):
+            # only the index queries manifest makes, paged like scan
+            if IndexName == "box_file_id":
+                assert KeyConditionExpression == "#box_file_id = :box_file_id"
+                box_file_id = ExpressionAttributeValues[":box_file_id"]
+                matches = [i for i in self._items() if i["box_file_id"] == box_file_id]
+            else:
+                assert IndexName == "path_root"
+                assert KeyConditionExpression == "#path_root = :path_root AND begins_with(#filepath, :prefix)"
+                path_root, prefix = ExpressionAttributeValues[":path_root"], ExpressionAttributeValues[":prefix"]
+                # the index is sparse, leaving out rows without a path_root
+                matches = sorted(
+                    (i for i in self._items() if i.get("path_root") == path_root and i["filepath"].startswith(prefix)),
+                    key=lambda i: i["filepath"],
+                )
+            start_index = ExclusiveStartKey["index"] if ExclusiveStartKey else 0
+            page = matches[start_index : start_index + MockTable.BATCH_SIZE]
+            # tombstones are filtered out after paging, as DynamoDB does
+            assert FilterExpression == "attribute_not_exists(#deleted)"
+            projected = {"box_file_id": ["filepath", "box_file_id"]}.get(
+                IndexName, ["filepath", "path_root", "box_file_id", "download_url", "sequence_id"]
+            )
+            response = {"Items": [{a: i[a] for a in projected if a in i} for i in page if not i.get("deleted")]}
+            if len(matches) > start_index + MockTable.BATCH_SIZE:
+                response["LastEvaluatedKey"] = {"index": start_index + MockTable.BATCH_SIZE}
+            return response
+
+        def scan(
+            self,
+            ExclusiveStartKey=None,
+            Segment=0,
+            TotalSegments=1,
+            ProjectionExpression=None,
+            ExpressionAttributeNames=None,
+            FilterExpression=None,
+        ):
+            segment_items = [i for i in self._items() if _get_segment(i["filepath"], TotalSegments) == Segment]
             if ExclusiveStartKey:
                 start_index = (
-                    next(idx for idx, item in enumerate(ddb_items) if item["filepath"] == ExclusiveStartKey) + 1
+                    next(
+                        idx
+                        for idx, item in enumerate(segment_items)
+                        if item["filepath"] == ExclusiveStartKey["filepath"]
+                    )
+                    + 1
                 )
             else:
                 start_index = 0
 
-            response = {"Items": ddb_items[start_index : start_index + MockTable.BATCH_SIZE]}
-            if len(ddb_items) >= start_index + MockTable.BATCH_SIZE:
-                response["LastEvaluatedKey"] = response["Items"][-1]["filepath"]
+            page = segment_items[start_index : start_index + MockTable.BATCH_SIZE]
+            items = page
+            if FilterExpression:
+                # only the filter scan_items uses, applied after paging as DynamoDB does
+                assert FilterExpression == "attribute_not_exists(#deleted)"
+                items = [i for i in items if not i.get("deleted")]
+            if ProjectionExpression:
+                attributes = [ExpressionAttributeNames[n] for n in ProjectionExpression.split(", ")]
+                items = [{a: i[a] for a in attributes if a in i} for i in items]
+
+            response = {"Items": items}
+            if len(segment_items) >= start_index + MockTable.BATCH_SIZE:
+                response["LastEvaluatedKey"] = {"filepath": page[-1]["filepath"]}
 
             return response
 
     return MockTable()
 
 
+@pytest.fixture
+def mock_state_table(state_items):
+    class MockStateTable:
+        name = STATE_TABLE_NAME
+
+        def put_item(self, Item):
+            state_items[Item["state_key"]] = Item
+
+        def delete_item(self, Key):
+            state_items.pop(Key["state_key"], None)
+
+        def get_item(self, Key):
+            result = {}
+            if Key["state_key"] in state_items:
+                result["Item"] = state_items[Key["state_key"]]
+            return result
+
+    return MockStateTable()
+
+
+@pytest.fixture
+def mock_folder_table(folder_items):
+    class MockFolderTableClient:
+        def batch_write_item(self, RequestItems):
+            for request in RequestItems[FOLDER_TABLE_NAME]:
+                if "PutRequest" in request:
+                    item = request["PutRequest"]["Item"]
+                    folder_items[item["folder_id"]] = item
+                else:
+                    folder_items.pop(request["DeleteRequest"]["Key"]["folder_id"], None)
+            return {"UnprocessedItems": {}}
+
+        def batch_get_item(self, RequestItems):
+            keys = RequestItems[FOLDER_TABLE_NAME]["Keys"]
+            items = [folder_items[k["folder_id"]] for k in keys if k["folder_id"] in folder_items]
+            return {"Responses": {FOLDER_TABLE_NAME: items}, "UnprocessedKeys": {}}
+
+    class MockFolderTable:
+        name = FOLDER_TABLE_NAME
+        meta = types.SimpleNamespace(client=MockFolderTableClient())
+
+        def scan(self, FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues, ExclusiveStartKey=None):
+            # only the path filter move_folder_paths uses, in a single page
+            assert FilterExpression == "begins_with(#path, :prefix)"
+            prefix = ExpressionAttributeValues[":prefix"]
+            return {"Items": [i for i in folder_items.values() if i.get("path", "").startswith(prefix)]}
+
+    return MockFolderTable()
+
+
 @pytest.fixture
 def compute_webhook_signature(box_webhook_signature_key):
     def _compute_webhook_signature(body):
@@ -260,17 +488,29 @@ def compute_webhook_signature(box_webhook_signature_key):
 
 
 @pytest.fixture
-def mock_box_webhook(compute_webhook_signature):
-    class MockBoxWebhook:
-        def validate_message(self, body, headers, primary_signature_key, secondary_signature_key=None):
-            return compute_webhook_signature(body) == headers["box-signature-primary"]
+def mock_box_events(box_events):
+    # the stream position is simply an index into box_events
+    class MockBoxEvents:
+        def get_events(self, limit=100, stream_position=0, stream_type=None):
+            entries = box_events[stream_position : stream_position + limit]
+            return {
+                "chunk_size": len(entries),
+                "next_stream_position": stream_position + len(entries),
+                "entries": entries,
+            }
+
+        def get_latest_stream_position(self, stream_type=None):
+            return len(box_events)
 
-    return MockBoxWebhook()
+    return MockBoxEvents()
 
 
 @pytest.fixture
-def mock_box_client(box_folders, box_files, mock_box_webhook, box_webhook_id):
+def mock_box_client(box_folders, box_files, mock_box_events):
     class MockBoxClient:
+        def events(self):
+            return mock_box_events
+
         def file(self, file_id):
             try:
                 return next(f for f in box_files if f.object_id == file_id)
@@ -278,20 +518,50 @@ def mock_box_client(box_folders, box_files, mock_box_webhook, box_webhook_id):
                 raise boxsdk.exception.BoxAPIException(404)
 
         def folder(self, folder_id):
-            try:
-                return next(f for f in box_folders if f.object_id == folder_id)
-            except StopIteration:
-                raise boxsdk.exception.BoxAPIException(404)
+            # like boxsdk, this makes no request, so a missing folder only fails once it's used
+            return next((f for f in box_folders if f.object_id == folder_id), MissingFolder(folder_id))
 
-        def webhook(self, webhook_id):
-            if webhook_id == box_webhook_id:
-                return mock_box_webhook
-            else:
-                raise boxsdk.exception.BoxAPIException(404)
+    class MissingFolder:
+        def __init__(self, folder_id):
+            self.id = self.object_id = folder_id
+
+        def get(self, *args, **kwargs):
+            raise boxsdk.exception.BoxAPIException(404)
+
+        def get_items(self, *args, **kwargs):
+            raise boxsdk.exception.BoxAPIException(404)
 
     return MockBoxClient()
 
 
+class MockItems:
+    """
+    Like the marker-paged collections boxsdk's get_items returns, fetching a page of `limit`
+    items whenever the last is used up, with the markers being offsets.
+    """
+
+    def __init__(self, items, limit=None, marker=None):
+        self.items = items
+        self.limit = limit or max(len(items), 1)
+        self._marker = int(marker or 0)
+        self._page = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._page:
+            if self._marker is None:
+                raise StopIteration
+            start = self._marker
+            self._page = self.items[start : start + self.limit]
+            self._marker = start + self.limit if start + self.limit < len(self.items) else None
+        return self._page.pop(0)
+
+    def next_pointer(self):
+        return None if self._marker is None else str(self._marker)
+
+
 def _next_box_object_id():
     result = str(_next_box_object_id._next_id)
     _next_box_object_id._next_id += 1
@@ -304,6 +574,10 @@ def _next_box_object_id():
 _next_box_object_id._next_id = 500000000000
 
 
+def _get_segment(filepath, total_segments):
+    return int(hashlib.md5(filepath.encode("utf-8"), usedforsecurity=False).hexdigest(), 16) % total_segments
+
+
 def _get_path_collection(parent_folder):
     total_count = parent_folder.response_object["path_collection"]["total_count"] + 1
     entries = parent_folder.response_object["path_collection"]["entries"] + [
@@ -0,0 +1,49 @@
+import pytest
+
+import bloom
+
+
+def test_bloom_filter():
+    bloom_filter = bloom.BloomFilter.for_capacity(1000, 0.01)
+    added = [f"folder/file-{i}.dat" for i in range(1000)]
+    for key in added:
+        bloom_filter.add(key)
+
+    # no false negatives, ever
+    assert all(key in bloom_filter for key in added)
+
+    absent = [f"other-folder/file-{i}.dat" for i in range(10000)]
+    false_positives = sum(key in bloom_filter for key in absent)
+    assert false_positives / len(absent) < 0.02
+
+    stats = bloom_filter.stats()
+    assert stats["items"] == 1000
+    assert stats["false_positive_rate"] == pytest.approx(0.01, rel=0.2)
+
+
+def test_empty_bloom_filter():
+    bloom_filter = bloom.BloomFilter.for_capacity(0, 0.01)
+    assert "some/file.dat" not in bloom_filter
+    assert bloom_filter.false_positive_rate() == 0
+
+
+def test_serialization():
+    bloom_filter = bloom.BloomFilter.for_capacity(10, 0.01)
+    bloom_filter.add("some/file.dat")
+
+    restored = bloom.BloomFilter.from_bytes(bloom_filter.to_bytes())
+    assert "some/file.dat" in restored
+    assert restored.stats() == bloom_filter.stats()
+
+    with pytest.raises(ValueError):
+        bloom.BloomFilter.from_bytes(b"\0" * bloom.HEADER.size)
+
+
+def test_write_and_load(tmp_path):
+    assert bloom.load_bloom_filter(str(tmp_path)) is None
+
+    bloom.write_bloom_filter(str(tmp_path), {"a.dat", "folder/b.dat"}, 0.001)
+    bloom_filter = bloom.load_bloom_filter(str(tmp_path))
+    assert "a.dat" in bloom_filter
+    assert "folder/b.dat" in bloom_filter
+    assert "c.dat" not in bloom_filter
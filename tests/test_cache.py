@@ -0,0 +1,73 @@
+import cache
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_put():
+    ttl_cache = cache.TTLCache(10, 60)
+    assert ttl_cache.get("missing") is cache.MISSING
+
+    ttl_cache.put("some/file.dat", "some-download-url")
+    assert ttl_cache.get("some/file.dat") == "some-download-url"
+    assert ttl_cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "entries": 1}
+
+
+def test_expiry():
+    clock = MockClock()
+    ttl_cache = cache.TTLCache(10, 60, negative_ttl=5, clock=clock)
+    ttl_cache.put("found.dat", "some-download-url")
+    ttl_cache.put("missing.dat", None)
+
+    clock.now = 4
+    assert ttl_cache.get("found.dat") == "some-download-url"
+    assert ttl_cache.get("missing.dat") is None
+
+    clock.now = 6
+    assert ttl_cache.get("found.dat") == "some-download-url"
+    assert ttl_cache.get("missing.dat") is cache.MISSING
+
+    clock.now = 61
+    assert ttl_cache.get("found.dat") is cache.MISSING
+    assert len(ttl_cache) == 0
+
+
+def test_lru_eviction():
+    ttl_cache = cache.TTLCache(2, 60)
+    ttl_cache.put("a", 1)
+    ttl_cache.put("b", 2)
+    # touching a makes b the least recently used entry
+    assert ttl_cache.get("a") == 1
+    ttl_cache.put("c", 3)
+
+    assert ttl_cache.get("b") is cache.MISSING
+    assert ttl_cache.get("a") == 1
+    assert ttl_cache.get("c") == 3
+    assert ttl_cache.evictions == 1
+
+
+def test_disabled():
+    ttl_cache = cache.TTLCache(0, 60)
+    ttl_cache.put("a", 1)
+    assert ttl_cache.get("a") is cache.MISSING
+
+    ttl_cache = cache.TTLCache(10, 60, negative_ttl=0)
+    ttl_cache.put("a", None)
+    assert ttl_cache.get("a") is cache.MISSING
+
+
+def test_invalidate_and_clear():
+    ttl_cache = cache.TTLCache(10, 60)
+    ttl_cache.put("a", 1)
+    ttl_cache.put("b", 2)
+    ttl_cache.invalidate("a")
+    assert ttl_cache.get("a") is cache.MISSING
+    assert ttl_cache.get("b") == 2
+
+    ttl_cache.clear()
+    assert ttl_cache.stats() == {"hits": 0, "misses": 0, "evictions": 0, "entries": 0}
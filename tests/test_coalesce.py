@@ -0,0 +1,78 @@
+import types
+
+import coalesce
+
+
+class MockClock:
+    def __init__(self):
+        self.now = 1577836800.0  # 2020-01-01T00:00:00Z
+
+    def __call__(self):
+        return self.now
+
+
+def _folder(*ancestor_ids):
+    return types.SimpleNamespace(path_collection={"entries": [{"id": i} for i in ancestor_ids]})
+
+
+def _message(box_id, delivery_id=None, delivered_at=None, box_type="file"):
+    return {"box_type": box_type, "box_id": box_id, "delivery_id": delivery_id, "delivered_at": delivered_at}
+
+
+def test_coalesce():
+    coalescer = coalesce.Coalescer(clock=MockClock())
+    items = coalescer.coalesce(
+        [
+            ("m1", _message("1", "d1")),
+            ("m2", _message("2", "d2")),
+            ("m3", _message("1", "d3")),
+            ("m4", _message("1", "d1")),
+            ("m5", _message("1", box_type="folder")),
+        ]
+    )
+    assert items == {("file", "1"): ["m1", "m3"], ("file", "2"): ["m2"], ("folder", "1"): ["m5"]}
+    assert coalescer.dropped == 1
+
+    # deliveries whose item was processed are remembered across batches, and those whose
+    # processing failed aren't
+    coalescer.finish("file", "2")
+    coalescer.forget("file", "1")
+    items = coalescer.coalesce([("m6", _message("2", "d2")), ("m7", _message("1", "d1"))])
+    assert items == {("file", "1"): ["m7"]}
+
+
+def test_coalesce_processed():
+    clock = MockClock()
+    coalescer = coalesce.Coalescer(window=60, clock=clock)
+    coalescer.start_processing("file", "1")
+    clock.now += 30
+
+    before = "2019-12-31T23:59:50+00:00"
+    after = "2020-01-01T00:00:10+00:00"
+    items = coalescer.coalesce([("m1", _message("1", delivered_at=before)), ("m2", _message("1", delivered_at=after))])
+    assert items == {("file", "1"): ["m2"]}
+
+    # within the allowance for clock skew, the event isn't assumed to be settled
+    items = coalescer.coalesce([("m3", _message("1", delivered_at="2019-12-31T23:59:57+00:00"))])
+    assert items == {("file", "1"): ["m3"]}
+
+    coalescer.forget("file", "1")
+    assert coalescer.coalesce([("m4", _message("1", delivered_at=before))]) == {("file", "1"): ["m4"]}
+
+    # past the window, nothing is remembered
+    coalescer.start_processing("file", "1")
+    clock.now += 61
+    assert coalescer.coalesce([("m5", _message("1", delivered_at=before))]) == {("file", "1"): ["m5"]}
+
+
+def test_collapse_folders():
+    folders = {
+        "10": _folder("0", "5"),
+        "11": _folder("0", "5", "10"),
+        "12": _folder("0", "5", "10", "11"),
+        "13": _folder("0", "5", "10", "11"),
+        "20": _folder("0", "5"),
+    }
+    roots = coalesce.collapse_folders(folders)
+    assert roots == {"10": ["10", "11", "12", "13"], "20": ["20"]}
+    assert list(roots) == ["10", "20"]
@@ -1,4 +1,8 @@
 import json
+import types
+import datetime
+import threading
+import collections
 
 import pytest
 from botocore.exceptions import ClientError
@@ -6,6 +10,7 @@ import boxsdk
 
 from . import conftest
 import common
+import ratelimit
 
 
 def test_get_box_client(monkeypatch):
@@ -18,7 +23,10 @@ def test_get_box_client(monkeypatch):
     webhook_signature_key = "webhook_signature_key"
 
     class MockSecretsClient:
+        calls = 0
+
         def get_secret_value(self, SecretId):
+            MockSecretsClient.calls += 1
             if SecretId == conftest.SECRET_ARN:
                 secret = {
                     "box_client_id": client_id,
@@ -70,8 +78,9 @@ def test_get_box_client(monkeypatch):
     class MockClient:
         USERS = []
 
-        def __init__(self, auth):
+        def __init__(self, auth, session=None):
             self._auth = auth
+            self._session = session
             self._as_user = None
 
         def users(self):
@@ -82,27 +91,98 @@ def test_get_box_client(monkeypatch):
             return self
 
     monkeypatch.setattr(common, "Client", MockClient)
+    common.invalidate_box_client()
 
     client, key = common.get_box_client()
     assert client._auth._authenticated is True
+    assert isinstance(client._session, common.LimitedSession)
     assert client._as_user is None
     assert key == webhook_signature_key
 
+    # warm invocations reuse the client and secret
+    assert common.get_box_client() == (client, key)
+    assert common.get_secret()["box_webhook_signature_key"] == webhook_signature_key
+    assert MockSecretsClient.calls == 1
+
     user = object()
     MockClient.USERS.append(user)
+    common.invalidate_box_client()
     client, key = common.get_box_client()
     assert client._auth._authenticated is True
     assert client._as_user is user
     assert key == webhook_signature_key
+    assert MockSecretsClient.calls == 2
 
     def get_secret_value_binary(SecretId):
         return {"SecretBinary": b"super-secret-bytes"}
 
     monkeypatch.setattr(mock_secrets_client, "get_secret_value", get_secret_value_binary)
+    common.invalidate_box_client()
     with pytest.raises(NotImplementedError):
         common.get_box_client()
 
 
+def test_invalidating_box_client(monkeypatch):
+    clients = []
+    monkeypatch.setattr(common, "_get_secret", lambda: {"some": "secret"})
+    monkeypatch.setattr(common, "_create_box_client", lambda secret: clients.append(object()) or clients[-1])
+    common.invalidate_box_client()
+
+    @common.invalidating_box_client
+    def handler(status):
+        common.get_box_client()
+        if status:
+            raise boxsdk.exception.BoxAPIException(status)
+
+    handler(None)
+    with pytest.raises(boxsdk.exception.BoxAPIException):
+        handler(404)
+    assert len(clients) == 1
+
+    # a 401 means the cached credentials no longer work
+    with pytest.raises(boxsdk.exception.BoxAPIException):
+        handler(401)
+    handler(None)
+    assert len(clients) == 2
+    common.invalidate_box_client()
+
+
+def test_validate_webhook_message(compute_webhook_signature, box_webhook_signature_key):
+    body = b'{"trigger": "FILE.TRASHED"}'
+    timestamp = "2020-01-01T00:00:00-08:00"
+    now = datetime.datetime.fromisoformat(timestamp) + datetime.timedelta(seconds=30)
+    headers = {
+        "box-signature-version": "1",
+        "box-signature-algorithm": "HmacSHA256",
+        "box-delivery-timestamp": timestamp,
+        "box-signature-primary": compute_webhook_signature(body + timestamp.encode("utf-8")),
+    }
+
+    def validate(headers, primary_key=box_webhook_signature_key, secondary_key=None, now=now):
+        return common.validate_webhook_message(body, headers, primary_key, secondary_key, now=now)
+
+    # agrees with boxsdk, which doesn't check the timestamp
+    assert boxsdk.object.webhook.Webhook.validate_message(body, headers, box_webhook_signature_key)
+    assert validate(headers)
+    assert validate({name.title(): value for name, value in headers.items()})
+
+    assert not validate(headers, primary_key="some-other-key")
+    assert not validate(dict(headers, **{"box-signature-version": "2"}))
+    assert not validate(dict(headers, **{"box-signature-algorithm": "HmacSHA1"}))
+    assert not validate(dict(headers, **{"box-delivery-timestamp": "2020-01-01T00:00:01-08:00"}))
+    assert not validate(dict(headers, **{"box-delivery-timestamp": "2020-01-01T00:00:00"}))
+    assert not validate(dict(headers, **{"box-delivery-timestamp": "yesterday"}))
+    assert not validate({})
+    assert not validate(headers, now=now + datetime.timedelta(seconds=common.WEBHOOK_MAX_AGE))
+    assert not validate(headers, now=now - datetime.timedelta(seconds=common.WEBHOOK_MAX_AGE + 60))
+
+    # the secondary key is accepted while the primary is being rotated
+    secondary_headers = dict(
+        headers, **{"box-signature-primary": "nope", "box-signature-secondary": headers["box-signature-primary"]}
+    )
+    assert validate(secondary_headers, primary_key="some-new-key", secondary_key=box_webhook_signature_key)
+
+
 def test_is_box_object_public(create_file, create_shared_link, monkeypatch):
     bad_file = create_file()
     monkeypatch.delattr(bad_file, "shared_link")
@@ -122,7 +202,7 @@ def test_is_box_object_public(create_file, create_shared_link, monkeypatch):
     assert common.is_box_object_public(shared_file) is True
 
 
-def test_is_any_parent_public(create_file, create_folder, create_shared_folder, mock_box_client):
+def test_is_any_parent_public(create_file, create_folder, create_shared_folder, mock_box_client, box_folders):
     client = mock_box_client
 
     unshared_folder = create_folder(id=common.BOX_FOLDER_ID)
@@ -139,6 +219,51 @@ def test_is_any_parent_public(create_file, create_folder, create_shared_folder,
     assert common.is_any_parent_public(client, unshared_file) is False
     assert common.is_any_parent_public(client, shared_file) is True
 
+    # parents deleted since the file was fetched are passed over
+    box_folders.remove(unshared_child_folder)
+    assert common.is_any_parent_public(client, unshared_file) is False
+
+
+def test_is_any_parent_public_cached(
+    create_file, create_folder, create_shared_folder, managed_folder, mock_box_client, mock_folder_table, folder_items
+):
+    unshared_folder = create_folder(parent_folder=managed_folder)
+    nested_folder = create_folder(parent_folder=unshared_folder)
+    unshared_file = create_file(parent_folder=nested_folder)
+    shared_file = create_file(parent_folder=create_shared_folder(parent_folder=unshared_folder))
+
+    fetched = []
+    get_folder = mock_box_client.folder
+
+    def counting_folder(folder_id):
+        fetched.append(folder_id)
+        return get_folder(folder_id)
+
+    mock_box_client.folder = counting_folder
+
+    assert common.is_any_parent_public(mock_box_client, unshared_file, mock_folder_table) is False
+    assert fetched == [managed_folder.id, unshared_folder.id, nested_folder.id]
+    assert {folder_id: item["public"] for folder_id, item in folder_items.items()} == {
+        managed_folder.id: False,
+        unshared_folder.id: False,
+        nested_folder.id: False,
+    }
+
+    # the cached parents are answered without Box
+    fetched.clear()
+    assert common.is_any_parent_public(mock_box_client, unshared_file, mock_folder_table) is False
+    assert common.is_any_parent_public(mock_box_client, shared_file, mock_folder_table) is True
+    assert fetched == [shared_file.path_collection["entries"][-1]["id"]]
+    assert common.is_any_parent_public(mock_box_client, shared_file, mock_folder_table) is True
+    assert len(fetched) == 1
+
+    # entries whose folder has changed since, or that have expired, are fetched again
+    fetched.clear()
+    unshared_file.path_collection["entries"][-1]["etag"] = "1"
+    folder_items[unshared_folder.id]["expires_at"] = 0
+    assert common.is_any_parent_public(mock_box_client, unshared_file, mock_folder_table) is False
+    assert fetched == [unshared_folder.id, nested_folder.id]
+
 
 def test_create_shared_link(create_folder, create_file, create_shared_link, mock_box_client, monkeypatch):
     client = mock_box_client
@@ -163,6 +288,35 @@ def test_create_shared_link(create_folder, create_file, create_shared_link, mock
     assert folder.shared_link["effective_permission"] == "can_download"
 
 
+def test_fix_shared_links(create_file, create_shared_file, managed_folder, mock_box_client, monkeypatch):
+    unshared_files = [create_file(parent_folder=managed_folder) for _ in range(20)]
+    shared_files = [create_shared_file(parent_folder=managed_folder) for _ in range(5)]
+
+    lock = threading.Lock()
+    running = []
+    peak = []
+    fix_shared_link = common.fix_shared_link
+
+    def slow_fix_shared_link(client, file, shared):
+        with lock:
+            running.append(None)
+            peak.append(len(running))
+        threading.Event().wait(0.005)
+        with lock:
+            running.pop()
+        return fix_shared_link(client, file, shared)
+
+    monkeypatch.setattr(common, "fix_shared_link", slow_fix_shared_link)
+
+    # files to share and files to unshare go through the pool, the rest pass straight through
+    files = [(f, True) for f in unshared_files] + [(f, False) for f in shared_files[:2]] + [(shared_files[2], True)]
+    results = list(common.fix_shared_links(mock_box_client, iter(files), workers=3))
+    assert sorted(f.id for f, _ in results) == sorted(f.id for f, _ in files)
+    assert all(common.is_box_object_public(f) == shared for f, shared in results)
+    assert len(peak) == len(unshared_files) + 2
+    assert 1 < max(peak) <= 3
+
+
 def test_remove_shared_link(
     create_shared_folder, create_shared_file, create_file, managed_folder, mock_box_client, monkeypatch
 ):
@@ -186,11 +340,6 @@ def test_remove_shared_link(
     assert common.is_box_object_public(unshared_folder) is False
 
 
-def test_get_ddb_table():
-    table = common.get_ddb_table()
-    assert table.name == conftest.MANIFEST_TABLE_NAME
-
-
 def test_get_filepath(create_folder, create_shared_file, managed_folder):
     shared_file = create_shared_file()
     assert common.get_filepath(shared_file) == shared_file.name
@@ -214,6 +363,7 @@ def test_make_ddb_item(create_folder, create_shared_file, managed_folder):
     assert item["filepath"] == f"{folder.name}/{file.name}"
     assert item["box_file_id"] == file.id
     assert item["download_url"] == file.shared_link["download_url"]
+    assert item["path_root"] == folder.name
 
 
 def test_put_file_item(create_file, create_shared_file, mock_ddb_table, ddb_items, managed_folder):
@@ -237,13 +387,41 @@ def test_delete_file_item(create_shared_file, mock_ddb_table, ddb_items):
     assert len(ddb_items) == 0
 
 
-def test_get_download_url(create_shared_file, mock_ddb_table, ddb_items):
+def test_delete_box_file_items(create_shared_file, mock_ddb_table, ddb_items):
     file = create_shared_file()
     ddb_items.append(common.make_ddb_item(file))
+    ddb_items.append({"filepath": "some/old/path.dat", "box_file_id": file.id, "download_url": "some-download-url"})
+    other_file = create_shared_file()
+    ddb_items.append(common.make_ddb_item(other_file))
+
+    assert common.delete_box_file_items(mock_ddb_table, file.id, keep=common.get_filepath(file)) == 1
+    assert {i["filepath"] for i in ddb_items} == {common.get_filepath(file), common.get_filepath(other_file)}
 
-    assert common.get_download_url(mock_ddb_table, common.get_filepath(file)) == file.shared_link["download_url"]
+    assert common.delete_box_file_items(mock_ddb_table, file.id) == 1
+    assert [i["box_file_id"] for i in ddb_items] == [other_file.id]
 
-    assert common.get_download_url(mock_ddb_table, "non/existant/file.dat") is None
+
+def test_delete_folder_items(create_folder, create_shared_file, managed_folder, mock_ddb_table, ddb_items, monkeypatch):
+    folder = create_folder(parent_folder=managed_folder)
+    subfolder = create_folder(parent_folder=folder)
+    files = [create_shared_file(parent_folder=subfolder) for _ in range(7)]
+    other_files = [create_shared_file(parent_folder=folder), create_shared_file(parent_folder=managed_folder)]
+    for file in files + other_files:
+        ddb_items.append(common.make_ddb_item(file))
+
+    # a row rewritten with a newer version after the index was read is left alone
+    query = mock_ddb_table.query
+
+    def racing_query(**kwargs):
+        response = query(**kwargs)
+        if response["Items"] and response["Items"][0]["filepath"] == common.get_filepath(files[0]):
+            ddb_items[0] = dict(ddb_items[0], sequence_id=ddb_items[0]["sequence_id"] + 1)
+        return response
+
+    monkeypatch.setattr(mock_ddb_table, "query", racing_query)
+
+    assert common.delete_folder_items(mock_ddb_table, common.get_filepath(subfolder)) == len(files) - 1
+    assert {i["box_file_id"] for i in ddb_items} == {f.id for f in other_files + files[:1]}
 
 
 def test_get_file(create_file, mock_box_client, monkeypatch):
@@ -261,6 +439,21 @@ def test_get_file(create_file, mock_box_client, monkeypatch):
         common.get_file(mock_box_client, "1234")
 
 
+def test_get_file_throttled(create_file, mock_box_client, monkeypatch):
+    file = create_file()
+    client_file = mock_box_client.file
+    responses = [boxsdk.exception.BoxAPIException(429, headers={"Retry-After": "0"})]
+
+    def throttled_file(file_id):
+        if responses:
+            raise responses.pop()
+        return client_file(file_id)
+
+    monkeypatch.setattr(mock_box_client, "file", throttled_file)
+    assert common.get_file(mock_box_client, file.id) is file
+    assert responses == []
+
+
 def test_get_folder(create_folder, mock_box_client, monkeypatch):
     folder = create_folder()
     assert common.get_folder(mock_box_client, folder.id) is folder
@@ -277,9 +470,6 @@ def test_get_folder(create_folder, mock_box_client, monkeypatch):
 
 
 def test_iterate_files(create_folder, create_file, managed_folder):
-    # this test never hits the else: break in iterate files
-    # I assume that what this means is that folder.get_items works.
-    # so indirectly, the fact that else: break isn't covered means that get_items works
     folders = [managed_folder]
     folders.append(create_folder(parent_folder=managed_folder))
     folders.append(create_folder(parent_folder=managed_folder))
@@ -298,8 +488,7 @@ def test_iterate_files(create_folder, create_file, managed_folder):
     assert len(results_files) == len(files)
     assert set(results_files) == files
 
-    # Test behavior when we are forced to page through a large number of files
-    # in a single folder:
+    # Test behavior with more files than fit in a single page of a folder listing:
     for _ in range(common.GET_ITEMS_LIMIT * 2 + 1):
         files.add(create_file(parent_folder=managed_folder))
 
@@ -311,4 +500,287 @@ def test_iterate_files(create_folder, create_file, managed_folder):
     assert len(results_files) == len(files)
     assert set(results_files) == files
 
-    # TODO: Test a mix of shared folders
+
+def _mini_file(file_id, name):
+    return boxsdk.object.file.File(None, file_id, {"type": "file", "id": file_id, "name": name, "shared_link": None})
+
+
+def test_iterate_files_listing(create_folder, managed_folder, monkeypatch):
+    nested_folder = create_folder(parent_folder=managed_folder)
+    get_items_calls = []
+
+    def mini_get_items(folder, children):
+        # the mini representations Box returns for the requested fields, without path_collection
+        def _mini_get_items(**kwargs):
+            get_items_calls.append(kwargs)
+            return conftest.MockItems(children)
+
+        monkeypatch.setattr(folder, "get_items", _mini_get_items)
+
+    mini_folder = boxsdk.object.folder.Folder(
+        None,
+        nested_folder.id,
+        {
+            "type": "folder",
+            "id": nested_folder.id,
+            "sequence_id": "3",
+            "etag": "3",
+            "name": nested_folder.name,
+            "shared_link": None,
+        },
+    )
+    mini_get_items(mini_folder, [_mini_file("1", "a.dat")])
+    mini_get_items(managed_folder, [mini_folder, _mini_file("2", "b.dat")])
+
+    results = {common.get_filepath(file) for file, _ in common.iterate_files(managed_folder)}
+    assert results == {f"{nested_folder.name}/a.dat", "b.dat"}
+
+    for kwargs in get_items_calls:
+        assert kwargs["use_marker"] is True
+        assert "path_collection" not in kwargs["fields"]
+
+
+def test_iterate_files_shared(create_folder, create_shared_folder, create_file, managed_folder):
+    shared_folder = create_shared_folder(parent_folder=managed_folder)
+    nested_folder = create_folder(parent_folder=shared_folder)
+    unshared_folder = create_folder(parent_folder=managed_folder)
+
+    expected = {}
+    for folder, shared in [
+        (managed_folder, False),
+        (shared_folder, True),
+        (nested_folder, True),
+        (unshared_folder, False),
+    ]:
+        for _ in range(3):
+            expected[create_file(parent_folder=folder)] = shared
+
+    for workers in [1, 4]:
+        results = dict(common.iterate_files(managed_folder, workers=workers))
+        assert results == expected
+
+    assert set(dict(common.iterate_files(managed_folder, shared=True)).values()) == {True}
+
+
+def test_iterate_files_concurrent(create_folder, create_file, managed_folder, monkeypatch):
+    folders = [create_folder(parent_folder=managed_folder) for _ in range(4)]
+    files = {create_file(parent_folder=folder) for folder in folders}
+
+    # every sibling listing must be in flight at once for the barrier to release
+    barrier = threading.Barrier(len(folders), timeout=5)
+    for folder in folders:
+        get_items = folder.get_items
+
+        def waiting_get_items(get_items=get_items, **kwargs):
+            barrier.wait()
+            return get_items(**kwargs)
+
+        monkeypatch.setattr(folder, "get_items", waiting_get_items)
+
+    results = {f for f, _ in common.iterate_files(managed_folder, workers=len(folders))}
+    assert results == files
+
+
+def test_iterate_files_error(create_folder, managed_folder, monkeypatch):
+    folder = create_folder(parent_folder=managed_folder)
+
+    def failing_get_items(**kwargs):
+        raise boxsdk.exception.BoxAPIException(500)
+
+    monkeypatch.setattr(folder, "get_items", failing_get_items)
+    with pytest.raises(boxsdk.exception.BoxAPIException):
+        list(common.iterate_files(managed_folder))
+
+
+def test_list_folder_pages(create_folder, create_file, managed_folder, monkeypatch):
+    monkeypatch.setattr(common, "GET_ITEMS_LIMIT", 2)
+    folder = create_folder(parent_folder=managed_folder)
+    files = [create_file(parent_folder=folder) for _ in range(5)]
+    acquired = []
+    monkeypatch.setattr(common.BOX_LISTINGS.bucket, "acquire", lambda: acquired.append(1))
+
+    # every page takes a token, and a throttled page is retried from its own marker
+    markers = []
+    get_items = folder.get_items
+
+    def throttled_get_items(**kwargs):
+        markers.append(kwargs["marker"])
+        if kwargs["marker"] == "2" and markers.count("2") == 1:
+            raise boxsdk.exception.BoxAPIException(429, headers={"Retry-After": "0"})
+        return get_items(**kwargs)
+
+    monkeypatch.setattr(folder, "get_items", throttled_get_items)
+    listed, _ = common.list_folder(folder, False)
+    assert [file for file, _ in listed] == files
+    assert markers == [None, "2", "2", "4"]
+    assert len(acquired) == 4
+
+    # should Box return a short page before the last, the page after it is read from its own marker
+    def short_get_items(**kwargs):
+        markers.append(kwargs["marker"])
+        return conftest.MockItems(files, 1 if kwargs["marker"] is None else kwargs["limit"], kwargs["marker"])
+
+    monkeypatch.setattr(folder, "get_items", short_get_items)
+    markers.clear()
+    listed, _ = common.list_folder(folder, False)
+    assert [file for file, _ in listed] == files
+    assert markers == [None, "1", "3"]
+
+
+def test_limited_session():
+    responses = []
+    retried = []
+
+    class MockNetwork:
+        def request(self, method, url, access_token, **kwargs):
+            status = responses.pop(0)
+            return types.SimpleNamespace(
+                status_code=status,
+                ok=status < 400,
+                headers={"Content-Type": "application/json", "Retry-After": "0"},
+                json=lambda: {"status": status},
+                content=b"{}",
+            )
+
+        def retry_after(self, delay, request_method, *args, **kwargs):
+            retried.append(delay)
+            return request_method(*args, **kwargs)
+
+    oauth = boxsdk.OAuth2(client_id="some-id", client_secret="some-secret", access_token="some-token")
+    session = common.LimitedSession(oauth, network_layer=MockNetwork())
+
+    # a 429 is raised for the Limiter to retry, rather than retried by boxsdk unseen by the bucket
+    responses.extend([429, 200])
+    limiter = ratelimit.Limiter("Box test", ratelimit.TokenBucket(1000))
+    assert limiter.call(session.get, "https://api.box.com/2.0/folders/0").json() == {"status": 200}
+    assert limiter.throttled == 1
+    assert retried == []
+
+    # but boxsdk still retries server errors itself
+    responses.extend([500, 200])
+    assert session.get("https://api.box.com/2.0/folders/0").json() == {"status": 200}
+    assert len(retried) == 1
+
+
+def test_walk_folders_stop(create_folder, create_shared_folder, create_file, managed_folder, mock_box_client):
+    shared_folder = create_shared_folder(parent_folder=managed_folder)
+    folders = [create_folder(parent_folder=shared_folder) for _ in range(3)]
+    files = {create_file(parent_folder=folder) for folder in [managed_folder, shared_folder] + folders}
+
+    # stop once the root has been listed, leaving its subfolder pending
+    pending = collections.deque([(managed_folder, False)])
+    listed = []
+    results = dict(common.walk_folders(pending, workers=1, should_stop=lambda: len(listed) > 0 or listed.append(1)))
+    assert len(results) == 1
+    assert [folder for folder, _ in pending] == [shared_folder]
+
+    # the pending folders survive a round trip through JSON
+    records = json.loads(json.dumps([common.dump_folder(folder, shared) for folder, shared in pending]))
+    pending = collections.deque(common.load_folder(mock_box_client, record) for record in records)
+    for file, shared in common.walk_folders(pending):
+        results[file] = shared
+        assert common.get_filepath(file) == common.get_filepath(mock_box_client.file(file.id).get())
+    assert set(results) == files
+    assert sum(results.values()) == len(files) - 1
+    assert not pending
+
+
+def test_state(mock_state_table):
+    assert common.get_state(mock_state_table, "some-key") is None
+
+    common.put_state(mock_state_table, "some-key", {"some": "state"})
+    assert common.get_state(mock_state_table, "some-key") == {"some": "state"}
+
+
+def test_get_state_table():
+    table = common.get_state_table()
+    assert table.name == conftest.STATE_TABLE_NAME
+
+
+def test_is_managed(create_file, create_folder, managed_folder):
+    assert common.is_managed(create_file(parent_folder=managed_folder)) is True
+    assert common.is_managed(create_file(parent_folder=create_folder(parent_folder=managed_folder))) is True
+    assert common.is_managed(create_file()) is False
+    assert common.is_managed(managed_folder) is False
+
+
+def test_sync_file(create_file, create_shared_file, managed_folder, mock_box_client, mock_ddb_table, ddb_items):
+    file = common.sync_file(mock_box_client, mock_ddb_table, create_file(parent_folder=managed_folder), True)
+    assert common.is_box_object_public(file) is True
+    assert ddb_items == [common.make_ddb_item(file)]
+
+    file = common.sync_file(mock_box_client, mock_ddb_table, file, False)
+    assert common.is_box_object_public(file) is False
+    assert ddb_items == []
+
+
+def test_sync_box_folder(
+    create_folder, create_shared_folder, create_file, managed_folder, mock_box_client, mock_ddb_table, ddb_items
+):
+    shared_folder = create_shared_folder(parent_folder=managed_folder)
+    nested_folder = create_folder(parent_folder=shared_folder)
+    file = create_file(parent_folder=nested_folder)
+
+    # files inherit publicity from folders above the one being synced
+    common.sync_box_folder(mock_box_client, mock_ddb_table, nested_folder.id)
+    assert {i["box_file_id"] for i in ddb_items} == {file.id}
+
+    outside_folder = create_shared_folder()
+    create_file(parent_folder=outside_folder)
+    common.sync_box_folder(mock_box_client, mock_ddb_table, outside_folder.id)
+    common.sync_box_folder(mock_box_client, mock_ddb_table, "123456789")
+    assert {i["box_file_id"] for i in ddb_items} == {file.id}
+
+    common.sync_box_folder(mock_box_client, mock_ddb_table, managed_folder.id)
+    assert {i["box_file_id"] for i in ddb_items} == {file.id}
+
+
+def test_sync_box_folder_unchanged(
+    create_shared_folder, create_file, managed_folder, mock_box_client, mock_ddb_table, ddb_items, monkeypatch
+):
+    folder = create_shared_folder(parent_folder=managed_folder)
+    files = [create_file(parent_folder=folder) for _ in range(5)]
+    common.sync_box_folder(mock_box_client, mock_ddb_table, folder.id)
+    assert len(ddb_items) == len(files)
+
+    synced = []
+    write_file_item = common.write_file_item
+
+    def recording_write_file_item(ddb_table, file):
+        synced.append(file.id)
+        return write_file_item(ddb_table, file)
+
+    monkeypatch.setattr(common, "write_file_item", recording_write_file_item)
+
+    # only files that differ from their rows are written
+    common.sync_box_folder(mock_box_client, mock_ddb_table, folder.id)
+    assert synced == []
+
+    files[2].sequence_id = "3"
+    common.sync_box_folder(mock_box_client, mock_ddb_table, folder.id)
+    assert synced == [files[2].id]
+
+
+def test_sync_box_folder_cached(
+    create_folder,
+    create_shared_folder,
+    managed_folder,
+    mock_box_client,
+    mock_ddb_table,
+    mock_folder_table,
+    folder_items,
+):
+    shared_folder = create_shared_folder(parent_folder=managed_folder)
+    nested_folder = create_folder(parent_folder=shared_folder)
+
+    common.sync_box_folder(mock_box_client, mock_ddb_table, shared_folder.id, mock_folder_table)
+    assert {folder_id: item["public"] for folder_id, item in folder_items.items()} == {
+        shared_folder.id: True,
+        nested_folder.id: False,
+    }
+
+    # a folder that has gone missing is dropped from the cache
+    common.sync_box_folder(mock_box_client, mock_ddb_table, "123456789", mock_folder_table)
+    folder_items["123456789"] = {"folder_id": "123456789", "public": True, "etag": "0", "expires_at": 2**40}
+    common.sync_box_folder(mock_box_client, mock_ddb_table, "123456789", mock_folder_table)
+    assert "123456789" not in folder_items
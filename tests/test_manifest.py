@@ -0,0 +1,171 @@
+import pytest
+
+import common
+import manifest
+
+from . import conftest
+
+
+def test_get_ddb_table():
+    table = manifest.get_ddb_table()
+    assert table.name == conftest.MANIFEST_TABLE_NAME
+
+
+def test_get_download_url(create_shared_file, mock_ddb_table, ddb_items):
+    file = create_shared_file()
+    ddb_items.append(common.make_ddb_item(file))
+
+    assert manifest.get_download_url(mock_ddb_table, common.get_filepath(file)) == file.shared_link["download_url"]
+
+    assert manifest.get_download_url(mock_ddb_table, "non/existant/file.dat") is None
+
+
+def test_get_filepaths(mock_ddb_table, ddb_items):
+    # more rows than fit in a page of the query
+    filepaths = [f"some/path/{i}.dat" for i in range(12)]
+    ddb_items.extend({"filepath": f, "box_file_id": "1", "download_url": "some-download-url"} for f in filepaths)
+    ddb_items.append({"filepath": "other.dat", "box_file_id": "2", "download_url": "some-download-url"})
+
+    assert manifest.get_filepaths(mock_ddb_table, "1") == filepaths
+    assert manifest.get_filepaths(mock_ddb_table, "3") == []
+
+
+def test_get_download_urls(create_shared_file, mock_ddb_table, ddb_items, monkeypatch):
+    monkeypatch.setattr(manifest, "BATCH_RETRY_DELAY", 0)
+
+    files = [create_shared_file() for _ in range(manifest.BATCH_GET_SIZE + 10)]
+    for file in files:
+        ddb_items.append(common.make_ddb_item(file))
+    filepaths = [common.get_filepath(f) for f in files] + ["non/existant/file.dat"]
+
+    expected = {common.get_filepath(f): f.shared_link["download_url"] for f in files}
+    assert manifest.get_download_urls(mock_ddb_table, filepaths) == expected
+
+    # throttled batches return some of their keys unprocessed, which must be retried
+    mock_ddb_table.meta.client.BATCH_PROCESSED_LIMIT = 30
+    assert manifest.get_download_urls(mock_ddb_table, filepaths + filepaths) == expected
+
+    mock_ddb_table.meta.client.BATCH_PROCESSED_LIMIT = 0
+    with pytest.raises(RuntimeError):
+        manifest.get_download_urls(mock_ddb_table, filepaths)
+
+    assert manifest.get_download_urls(mock_ddb_table, []) == {}
+
+
+def _item(filepath, box_file_id, sequence_id, download_url="some-download-url"):
+    return {"filepath": filepath, "box_file_id": box_file_id, "download_url": download_url, "sequence_id": sequence_id}
+
+
+def test_put_item(mock_ddb_table, ddb_items):
+    assert manifest.put_item(mock_ddb_table, _item("a.dat", "1", 2)) == {}
+    assert manifest.put_item(mock_ddb_table, _item("a.dat", "1", 2, "new-url")) == _item("a.dat", "1", 2)
+
+    # an older version of the file doesn't replace a newer one
+    assert manifest.put_item(mock_ddb_table, _item("a.dat", "1", 1)) is None
+    assert ddb_items == [_item("a.dat", "1", 2, "new-url")]
+
+    # but another file's version numbers aren't comparable
+    assert manifest.put_item(mock_ddb_table, _item("a.dat", "2", 1)) is not None
+    assert ddb_items == [_item("a.dat", "2", 1)]
+
+
+def test_delete_item(mock_ddb_table, ddb_items):
+    ddb_items.append(_item("a.dat", "1", 2))
+    assert not manifest.delete_item(mock_ddb_table, "a.dat", "1", 1)
+    assert not manifest.delete_item(mock_ddb_table, "a.dat", "2")
+    assert len(ddb_items) == 1
+
+    assert manifest.delete_item(mock_ddb_table, "a.dat", "1", 2)
+    assert ddb_items == []
+    assert not manifest.delete_item(mock_ddb_table, "a.dat", "1")
+
+
+def test_delete_item_tombstone(mock_ddb_table, ddb_items, ddb_tombstones):
+    ddb_items.extend(
+        dict(_item(filepath, box_file_id, 1), path_root="a")
+        for filepath, box_file_id in [("a/a.dat", "1"), ("a/b.dat", "2")]
+    )
+    assert manifest.delete_item(mock_ddb_table, "a/a.dat", "1", 3)
+    assert [(i["filepath"], i["sequence_id"], "download_url" in i) for i in ddb_tombstones] == [("a/a.dat", 3, False)]
+
+    # the tombstone keeps a stale put of the file from bringing its row back
+    assert manifest.put_item(mock_ddb_table, _item("a/a.dat", "1", 2)) is None
+    assert [i["filepath"] for i in ddb_items] == ["a/b.dat"]
+
+    # and readers pass over it
+    assert manifest.get_download_url(mock_ddb_table, "a/a.dat") is None
+    assert manifest.get_download_urls(mock_ddb_table, ["a/a.dat", "a/b.dat"]) == {"a/b.dat": "some-download-url"}
+    assert manifest.get_filepaths(mock_ddb_table, "1") == []
+    assert [i["filepath"] for i in manifest.query_folder_items(mock_ddb_table, "a")] == ["a/b.dat"]
+    assert [i["filepath"] for i in manifest.scan_items(mock_ddb_table)] == ["a/b.dat"]
+
+    # until a newer version of the file replaces it
+    tombstone = ddb_tombstones[0]
+    assert manifest.put_item(mock_ddb_table, _item("a/a.dat", "1", 3)) == tombstone
+    assert ddb_tombstones == []
+    assert manifest.get_download_url(mock_ddb_table, "a/a.dat") == "some-download-url"
+
+
+def test_write_items(mock_ddb_table, ddb_items):
+    # rows read by a slow writer, which others update in the meantime
+    stale_items = [_item(f"{i}.dat", str(i), 1) for i in range(10)]
+    ddb_items.extend(_item(f"{i}.dat", str(i), 2) for i in range(5))
+    ddb_items.extend(stale_items[5:])
+
+    skipped = manifest.write_items(mock_ddb_table, put_items=stale_items[:3], delete_items=stale_items[3:])
+    assert skipped == 5
+    assert sorted(i["filepath"] for i in ddb_items) == [f"{i}.dat" for i in range(5)]
+    assert all(i["sequence_id"] == 2 for i in ddb_items)
+
+
+def test_batch_write_items(mock_ddb_table, ddb_items, monkeypatch):
+    monkeypatch.setattr(manifest, "BATCH_RETRY_DELAY", 0)
+
+    ddb_items.extend({"filepath": f"old/file-{i}.dat"} for i in range(30))
+    put_items = [{"filepath": f"new/file-{i}.dat"} for i in range(60)]
+    delete_keys = [{"filepath": f"old/file-{i}.dat"} for i in range(20)]
+
+    # throttled batches return some of their requests unprocessed, which must be retried
+    mock_ddb_table.meta.client.BATCH_PROCESSED_LIMIT = 10
+    assert manifest.batch_write_items(mock_ddb_table, put_items, delete_keys) == 4
+
+    expected = {f"new/file-{i}.dat" for i in range(60)} | {f"old/file-{i}.dat" for i in range(20, 30)}
+    assert {i["filepath"] for i in ddb_items} == expected
+
+    assert manifest.batch_write_items(mock_ddb_table) == 0
+
+    mock_ddb_table.meta.client.BATCH_PROCESSED_LIMIT = 0
+    with pytest.raises(RuntimeError):
+        manifest.batch_write_items(mock_ddb_table, put_items)
+
+
+def test_scan_items(mock_ddb_table, ddb_items):
+    ddb_items.extend(
+        {"filepath": f"folder/file-{i}.dat", "box_file_id": str(i), "download_url": f"url-{i}"} for i in range(53)
+    )
+
+    for segments in [1, 4]:
+        results = list(manifest.scan_items(mock_ddb_table, segments=segments))
+        assert sorted(results, key=lambda i: i["filepath"]) == sorted(ddb_items, key=lambda i: i["filepath"])
+
+    results = list(manifest.scan_items(mock_ddb_table, ["filepath", "download_url"]))
+    assert {i["filepath"]: i["download_url"] for i in results} == {i["filepath"]: i["download_url"] for i in ddb_items}
+    assert all(set(i) == {"filepath", "download_url"} for i in results)
+
+    # stopping early must not leave the scanning threads blocked
+    items = manifest.scan_items(mock_ddb_table, segments=4)
+    assert next(items) in ddb_items
+    items.close()
+
+
+def test_scan_items_error(mock_ddb_table, ddb_items, monkeypatch):
+    ddb_items.extend({"filepath": f"folder/file-{i}.dat"} for i in range(20))
+
+    def failing_scan(**kwargs):
+        if kwargs["Segment"] == 1:
+            raise RuntimeError("scan failed")
+        return {"Items": []}
+
+    monkeypatch.setattr(mock_ddb_table, "scan", failing_scan)
+    with pytest.raises(RuntimeError):
+        list(manifest.scan_items(mock_ddb_table, segments=2))
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+import pipeline
+
+
+def test_pipeline():
+    stages = [
+        pipeline.Stage("double", lambda i: [i, i]),
+        pipeline.Stage("odd", lambda i: [i] if i % 2 else [], workers=3),
+        pipeline.Stage("square", lambda i: [i * i], workers=2),
+    ]
+    files_pipeline = pipeline.Pipeline(iter(range(100)), stages)
+    assert sorted(files_pipeline.run()) == sorted(i * i for i in range(100) if i % 2 for _ in range(2))
+
+    metrics = files_pipeline.metrics()
+    assert [metrics[name]["received"] for name in ["double", "odd", "square"]] == [100, 200, 100]
+    assert [metrics[name]["emitted"] for name in ["double", "odd", "square"]] == [200, 100, 100]
+    assert all(m["per_second"] > 0 for m in metrics.values())
+
+
+def test_pipeline_empty():
+    files_pipeline = pipeline.Pipeline(iter([]), [pipeline.Stage("some-stage", lambda i: [i], workers=2)])
+    assert list(files_pipeline.run()) == []
+
+
+def test_pipeline_backpressure():
+    # a stalled last stage holds back the source once the queues in between fill up
+    produced = []
+    release = threading.Event()
+
+    def source():
+        for i in range(100):
+            produced.append(i)
+            yield i
+
+    def stalled(i):
+        release.wait()
+        return [i]
+
+    stages = [pipeline.Stage("pass", lambda i: [i], queue_size=2), pipeline.Stage("stalled", stalled, queue_size=2)]
+    files_pipeline = pipeline.Pipeline(source(), stages)
+    results = files_pipeline.run()
+
+    held_back = []
+
+    def unstall():
+        threading.Event().wait(0.2)
+        held_back.append(len(produced))
+        release.set()
+
+    thread = threading.Thread(target=unstall)
+    thread.start()
+    first = next(results)
+    # the source got no further than the queues, the stages and the item in hand allow
+    assert held_back[0] <= 8
+    assert sorted([first] + list(results)) == list(range(100))
+    thread.join()
+
+
+def test_pipeline_error():
+    def failing(i):
+        if i == 50:
+            raise RuntimeError("some-error")
+        return [i]
+
+    stages = [pipeline.Stage("pass", lambda i: [i]), pipeline.Stage("failing", failing, workers=2)]
+    files_pipeline = pipeline.Pipeline(iter(range(1000)), stages)
+    with pytest.raises(RuntimeError, match="some-error"):
+        list(files_pipeline.run())
+
+
+def test_pipeline_source_error():
+    def source():
+        yield 1
+        raise RuntimeError("some-error")
+
+    files_pipeline = pipeline.Pipeline(source(), [pipeline.Stage("pass", lambda i: [i])])
+    with pytest.raises(RuntimeError, match="some-error"):
+        list(files_pipeline.run())
@@ -0,0 +1,67 @@
+import json
+
+import queues
+
+
+def test_memory_queue():
+    queue = queues.MemoryQueue()
+    queue.send_batch([{"n": n} for n in range(25)])
+    assert len(queue) == 25
+
+    batches = []
+
+    def handler(event, context):
+        batches.append([json.loads(record["body"])["n"] for record in event["Records"]])
+        assert all(record["attributes"]["ApproximateReceiveCount"] == "1" for record in event["Records"])
+
+    assert queue.drain(handler, batch_size=10) == 3
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert sorted(sum(batches, [])) == list(range(25))
+    assert len(queue) == 0
+
+
+def test_memory_queue_failures():
+    queue = queues.MemoryQueue(max_receives=3)
+    queue.send_batch([{"n": n} for n in range(5)])
+    received = []
+
+    def handler(event, context):
+        failures = []
+        for record in event["Records"]:
+            n = json.loads(record["body"])["n"]
+            received.append(n)
+            # odd messages fail once, and message 4 always fails
+            if n == 4 or (n % 2 and record["attributes"]["ApproximateReceiveCount"] == "1"):
+                failures.append({"itemIdentifier": record["messageId"]})
+        return {"batchItemFailures": failures}
+
+    queue.drain(handler)
+    assert sorted(received) == [0, 1, 1, 2, 3, 3, 4, 4, 4]
+    assert queue.dead_letters == [{"n": 4}]
+
+
+def test_sqs_queue(monkeypatch):
+    calls = []
+
+    class MockSQSClient:
+        def send_message(self, **kwargs):
+            calls.append(("send_message", kwargs))
+
+        def send_message_batch(self, **kwargs):
+            calls.append(("send_message_batch", kwargs))
+            return {"Successful": [{"Id": e["Id"]} for e in kwargs["Entries"]]}
+
+    monkeypatch.setattr(queues.boto3, "client", lambda service_name: MockSQSClient())
+    monkeypatch.setattr(queues, "WEBHOOK_QUEUE_URL", "https://sqs.example.com/some-queue")
+
+    queue = queues.get_webhook_queue()
+    queue.send({"some": "message"})
+    queue.send_batch([{"n": n} for n in range(12)])
+
+    assert calls[0] == ("send_message", {"QueueUrl": queue.queue_url, "MessageBody": '{"some": "message"}'})
+    assert [len(kwargs["Entries"]) for name, kwargs in calls[1:]] == [10, 2]
+
+
+def test_get_webhook_queue():
+    assert isinstance(queues.get_webhook_queue(), queues.MemoryQueue)
+    assert queues.get_webhook_queue() is queues.get_webhook_queue()
@@ -0,0 +1,167 @@
+import threading
+
+import boxsdk
+import pytest
+from botocore.exceptions import ClientError
+
+import ratelimit
+
+
+class MockClock:
+    # sleeping advances the clock instead of waiting
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _throttled(code="ProvisionedThroughputExceededException"):
+    return ClientError({"Error": {"Code": code, "Message": "slow down"}}, "BatchWriteItem")
+
+
+def test_token_bucket():
+    clock = MockClock()
+    bucket = ratelimit.TokenBucket(10, capacity=5, clock=clock, sleep=clock.sleep)
+
+    # a burst up to the capacity goes straight through, then calls are spaced at the rate
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.sleeps == []
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.now == pytest.approx(0.5)
+
+    # unused capacity refills over time
+    clock.now += 10
+    clock.sleeps.clear()
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+
+def test_token_bucket_adapts():
+    clock = MockClock()
+    bucket = ratelimit.TokenBucket(10, clock=clock, sleep=clock.sleep)
+
+    bucket.throttle(2)
+    assert bucket.rate == 5
+    bucket.acquire()
+    assert clock.sleeps == [2]
+
+    for _ in range(100):
+        bucket.throttle(0)
+    assert bucket.rate == bucket.min_rate
+
+    for _ in range(200):
+        bucket.recover()
+    assert bucket.rate == bucket.max_rate
+
+
+def test_token_bucket_unlimited():
+    clock = MockClock()
+    bucket = ratelimit.TokenBucket(0, clock=clock, sleep=clock.sleep)
+    for _ in range(1000):
+        bucket.acquire()
+    assert clock.sleeps == []
+
+    # pauses are honoured even without a rate
+    bucket.throttle(3)
+    bucket.acquire()
+    assert clock.sleeps == [3]
+
+
+def test_limiter_retry_after(monkeypatch):
+    clock = MockClock()
+    limiter = ratelimit.Limiter("Box", ratelimit.TokenBucket(0, clock=clock, sleep=clock.sleep))
+    responses = [
+        boxsdk.exception.BoxAPIException(429, headers={"Retry-After": "7"}),
+        boxsdk.exception.BoxAPIException(429, headers={}),
+        "some-result",
+    ]
+
+    def callback(*args, **kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response, args, kwargs
+
+    monkeypatch.setattr(ratelimit, "backoff_delay", lambda attempt: 0.5)
+    assert limiter.call(callback, 1, some="kwarg") == ("some-result", (1,), {"some": "kwarg"})
+    assert clock.sleeps == [7, 0.5]
+    assert limiter.throttled == 2
+
+
+def test_limiter_dynamodb():
+    clock = MockClock()
+    limiter = ratelimit.Limiter("DynamoDB", ratelimit.TokenBucket(0, clock=clock, sleep=clock.sleep))
+    calls = []
+
+    def callback():
+        calls.append(None)
+        if len(calls) < 3:
+            raise _throttled()
+        return "some-result"
+
+    assert limiter.call(callback) == "some-result"
+    assert len(clock.sleeps) == 2
+
+
+@pytest.mark.parametrize(
+    "exception",
+    [
+        boxsdk.exception.BoxAPIException(404),
+        _throttled("ValidationException"),
+        RuntimeError("not throttling"),
+    ],
+)
+def test_limiter_not_retried(exception):
+    limiter = ratelimit.Limiter("some-service", ratelimit.TokenBucket(0))
+    calls = []
+
+    def callback():
+        calls.append(None)
+        raise exception
+
+    with pytest.raises(type(exception)):
+        limiter.call(callback)
+    assert len(calls) == 1
+
+
+def test_limiter_gives_up(monkeypatch):
+    clock = MockClock()
+    limiter = ratelimit.Limiter("DynamoDB", ratelimit.TokenBucket(0, clock=clock, sleep=clock.sleep))
+
+    def callback():
+        raise _throttled("ThrottlingException")
+
+    with pytest.raises(ClientError):
+        limiter.call(callback)
+    assert limiter.throttled == ratelimit.MAX_ATTEMPTS - 1
+
+
+def test_limiter_concurrency():
+    limiter = ratelimit.Limiter("some-service", ratelimit.TokenBucket(0), concurrency=2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def callback():
+        with lock:
+            running.append(None)
+            peak.append(len(running))
+        threading.Event().wait(0.01)
+        with lock:
+            running.pop()
+
+    threads = [threading.Thread(target=limiter.call, args=(callback,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
@@ -1,14 +1,36 @@
+import os
+import sys
+import json
+import subprocess
 import urllib.parse
+
 import pytest
 
 import common
+import store
+import manifest
+import bloom
+import snapshot
 import redirector
 
+from . import conftest
+
+# Cold starts dominate the redirector's tail latency, so importing it must stay cheap
+# and must never pull in boxsdk or its JWT/cryptography dependencies.
+IMPORT_TIME_BUDGET = 1.0
+BOX_MODULES = {"boxsdk", "jwt", "cryptography"}
+
 
 class TestRedirector:
     @pytest.fixture(autouse=True)
     def monkeypatch_table(self, monkeypatch, mock_ddb_table):
-        monkeypatch.setattr(common, "get_ddb_table", lambda: mock_ddb_table)
+        monkeypatch.setattr(manifest, "get_ddb_table", lambda: mock_ddb_table)
+        redirector.CACHE.clear()
+        monkeypatch.setattr(
+            redirector,
+            "_ARTIFACT_STATE",
+            {"snapshot": None, "bloom_filter": None, "loaded_at": None, "bloom_rejections": 0},
+        )
 
     @pytest.fixture
     def create_redirector_event(self):
@@ -37,3 +59,174 @@ class TestRedirector:
         result = redirector.lambda_handler(event, None)
         assert result["statusCode"] == 302
         assert result["headers"]["Location"] == expected_location
+
+    def test_cached_lookups(self, create_redirector_event, create_shared_file, ddb_items, mock_ddb_table, monkeypatch):
+        file = create_shared_file()
+        ddb_items.append(common.make_ddb_item(file))
+
+        get_item_calls = []
+        get_item = mock_ddb_table.get_item
+
+        def counting_get_item(Key):
+            get_item_calls.append(Key)
+            return get_item(Key)
+
+        monkeypatch.setattr(mock_ddb_table, "get_item", counting_get_item)
+
+        for _ in range(3):
+            result = redirector.lambda_handler(create_redirector_event(file.name), None)
+            assert result["statusCode"] == 302
+            assert result["headers"]["Location"] == file.shared_link["download_url"]
+
+            result = redirector.lambda_handler(create_redirector_event("some/bogus/path.dat"), None)
+            assert result["statusCode"] == 404
+
+        assert len(get_item_calls) == 2
+        assert redirector.CACHE.hits == 4
+        assert redirector.CACHE.misses == 2
+
+    @pytest.fixture
+    def create_bulk_event(self):
+        def _create_bulk_event(filepaths):
+            return {"body": json.dumps({"filepaths": filepaths})}
+
+        return _create_bulk_event
+
+    def test_bulk_resolve(self, create_bulk_event, create_shared_file, ddb_items, mock_ddb_table, monkeypatch):
+        files = [create_shared_file() for _ in range(3)]
+        for file in files:
+            ddb_items.append(common.make_ddb_item(file))
+        expected = {f.name: f.shared_link["download_url"] for f in files}
+
+        batch_calls = []
+        batch_get_item = mock_ddb_table.meta.client.batch_get_item
+
+        def counting_batch_get_item(RequestItems):
+            batch_calls.append(RequestItems)
+            return batch_get_item(RequestItems)
+
+        monkeypatch.setattr(mock_ddb_table.meta.client, "batch_get_item", counting_batch_get_item)
+
+        filepaths = [f.name for f in files] + ["some/bogus/path.dat"]
+        for _ in range(2):
+            result = redirector.bulk_lambda_handler(create_bulk_event(filepaths), None)
+            assert result["statusCode"] == 200
+            body = json.loads(result["body"])
+            assert body["download_urls"] == expected
+            assert body["missing"] == ["some/bogus/path.dat"]
+
+        # the second request is served entirely from the cache
+        assert len(batch_calls) == 1
+
+        # and single-file lookups share that cache
+        result = redirector.lambda_handler({"pathParameters": {"filepath": files[0].name}}, None)
+        assert result["headers"]["Location"] == expected[files[0].name]
+        assert redirector.CACHE.misses == 4
+
+    @pytest.mark.parametrize(
+        "body", ["not json", "[]", '{"paths": []}', '{"filepaths": "a.dat"}', '{"filepaths": [1]}']
+    )
+    def test_bulk_resolve_malformed(self, body):
+        result = redirector.bulk_lambda_handler({"body": body}, None)
+        assert result["statusCode"] == 400
+
+    def test_bulk_resolve_too_many(self, create_bulk_event, monkeypatch):
+        monkeypatch.setattr(redirector, "BULK_MAX_FILEPATHS", 2)
+        result = redirector.bulk_lambda_handler(create_bulk_event(["a.dat", "b.dat", "c.dat"]), None)
+        assert result["statusCode"] == 400
+
+    def test_snapshot_lookups(
+        self, create_redirector_event, create_bulk_event, create_shared_file, ddb_items, tmp_path, monkeypatch
+    ):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+
+        # without a snapshot, everything is served from DynamoDB
+        old_file = create_shared_file()
+        ddb_items.append(common.make_ddb_item(old_file))
+        result = redirector.lambda_handler(create_redirector_event(old_file.name), None)
+        assert result["headers"]["Location"] == old_file.shared_link["download_url"]
+        assert redirector._ARTIFACT_STATE["snapshot"] is None
+
+        snapshot_file = create_shared_file()
+        snapshot.write_snapshot(str(tmp_path), {snapshot_file.name: snapshot_file.shared_link["download_url"]})
+        monkeypatch.setitem(redirector._ARTIFACT_STATE, "loaded_at", None)
+
+        new_file = create_shared_file()
+        ddb_items.append(common.make_ddb_item(new_file))
+
+        # the snapshotted file is served without touching DynamoDB
+        result = redirector.lambda_handler(create_redirector_event(snapshot_file.name), None)
+        assert result["headers"]["Location"] == snapshot_file.shared_link["download_url"]
+        assert redirector.CACHE.misses == 1
+
+        # files published after the snapshot fall back to DynamoDB
+        result = redirector.lambda_handler(create_redirector_event(new_file.name), None)
+        assert result["headers"]["Location"] == new_file.shared_link["download_url"]
+        assert redirector.CACHE.misses == 2
+
+        result = redirector.bulk_lambda_handler(create_bulk_event([snapshot_file.name, new_file.name]), None)
+        assert json.loads(result["body"])["download_urls"] == {
+            snapshot_file.name: snapshot_file.shared_link["download_url"],
+            new_file.name: new_file.shared_link["download_url"],
+        }
+
+        # the snapshot is only reloaded once the refresh interval has passed
+        snapshot.write_snapshot(str(tmp_path), {})
+        redirector.get_snapshot()
+        assert redirector.get_snapshot().get(snapshot_file.name) is not None
+        monkeypatch.setattr(redirector, "SNAPSHOT_REFRESH_INTERVAL", 0)
+        assert redirector.get_snapshot().get(snapshot_file.name) is None
+
+    def test_bloom_filter(
+        self, create_redirector_event, create_bulk_event, create_shared_file, ddb_items, tmp_path, monkeypatch
+    ):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+        monkeypatch.setattr(redirector, "BLOOM_FILTER_ENABLED", True)
+
+        published_file = create_shared_file()
+        ddb_items.append(common.make_ddb_item(published_file))
+        bloom.write_bloom_filter(str(tmp_path), [published_file.name], 0.0001)
+
+        get_item_calls = []
+        monkeypatch.setattr(manifest, "get_download_url", lambda t, f: get_item_calls.append(f) or None)
+
+        result = redirector.lambda_handler(create_redirector_event("some/bogus/path.dat"), None)
+        assert result["statusCode"] == 404
+        result = redirector.bulk_lambda_handler(create_bulk_event(["other/bogus/path.dat"]), None)
+        assert json.loads(result["body"])["missing"] == ["other/bogus/path.dat"]
+        assert get_item_calls == []
+        assert redirector._ARTIFACT_STATE["bloom_rejections"] == 2
+
+        # paths in the filter still go to DynamoDB, since the filter can't prove they exist
+        redirector.lambda_handler(create_redirector_event(published_file.name), None)
+        assert get_item_calls == [published_file.name]
+
+        monkeypatch.setattr(redirector, "BLOOM_FILTER_ENABLED", False)
+        redirector.lambda_handler(create_redirector_event("some/bogus/path.dat"), None)
+        assert get_item_calls == [published_file.name, "some/bogus/path.dat"]
+
+    def test_snapshot_load_failure(self, create_redirector_event, create_shared_file, ddb_items, monkeypatch):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", "/some/location")
+
+        def failing_load_snapshot(location):
+            raise OSError("unable to load snapshot")
+
+        monkeypatch.setattr(snapshot, "load_snapshot", failing_load_snapshot)
+
+        file = create_shared_file()
+        ddb_items.append(common.make_ddb_item(file))
+        result = redirector.lambda_handler(create_redirector_event(file.name), None)
+        assert result["headers"]["Location"] == file.shared_link["download_url"]
+
+
+def test_import_budget():
+    code = (
+        "import sys, time, json; start = time.perf_counter(); import redirector; "
+        "print(json.dumps({'elapsed': time.perf_counter() - start, 'modules': sorted(sys.modules)}))"
+    )
+    env = dict(os.environ, PYTHONPATH=str(conftest.redirector_path))
+    output = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, check=True, text=True).stdout
+    result = json.loads(output)
+
+    assert result["elapsed"] < IMPORT_TIME_BUDGET
+    assert not BOX_MODULES & {m.split(".")[0] for m in result["modules"]}
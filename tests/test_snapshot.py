@@ -0,0 +1,55 @@
+import pytest
+
+import snapshot
+
+
+@pytest.fixture
+def download_urls():
+    return {
+        "file.dat": "https://company.box.com/shared/static/a.dat",
+        "folder/file.dat": "https://company.box.com/shared/static/b.dat",
+        "folder/nested/file with spaces.dat": "https://company.box.com/shared/static/c.dat",
+        "folder/ünïcödé.dat": "https://company.box.com/shared/static/d.dat",
+        "zzz.dat": "https://company.box.com/shared/static/e.dat",
+    }
+
+
+def test_write_and_load(tmp_path, download_urls):
+    snapshot.write_snapshot(str(tmp_path), download_urls)
+
+    manifest_snapshot = snapshot.load_snapshot(str(tmp_path))
+    assert len(manifest_snapshot) == len(download_urls)
+    for filepath, download_url in download_urls.items():
+        assert manifest_snapshot.get(filepath) == download_url
+
+    for filepath in ["", "aaa.dat", "folder", "folder/file.da", "folder/file.dat2", "zzzz.dat"]:
+        assert manifest_snapshot.get(filepath) is None
+    manifest_snapshot.close()
+
+
+def test_empty_snapshot(tmp_path):
+    snapshot.write_snapshot(str(tmp_path), {})
+
+    manifest_snapshot = snapshot.load_snapshot(str(tmp_path))
+    assert len(manifest_snapshot) == 0
+    assert manifest_snapshot.get("file.dat") is None
+
+
+def test_missing_snapshot(tmp_path):
+    assert snapshot.load_snapshot(str(tmp_path)) is None
+
+
+def test_invalid_snapshot(tmp_path):
+    (tmp_path / snapshot.SNAPSHOT_NAME).write_bytes(b"\0" * snapshot.HEADER.size)
+    with pytest.raises(ValueError):
+        snapshot.load_snapshot(str(tmp_path))
+
+
+def test_encode_snapshot_sorted(download_urls):
+    data = snapshot.encode_snapshot(download_urls, created_at=1234)
+    _, count, created_at = snapshot.HEADER.unpack_from(data, 0)
+    assert count == len(download_urls)
+    assert created_at == 1234
+
+    reordered = dict(reversed(list(download_urls.items())))
+    assert snapshot.encode_snapshot(reordered, created_at=1234) == data
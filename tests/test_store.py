@@ -0,0 +1,57 @@
+import io
+
+import pytest
+from botocore.exceptions import ClientError
+
+import store
+
+
+def test_local_artifacts(tmp_path):
+    location = str(tmp_path / "artifacts")
+    assert store.fetch_artifact(location, "some-artifact") is None
+
+    store.put_artifact(location, "some-artifact", b"first")
+    path = store.fetch_artifact(location, "some-artifact")
+    with open(path, "rb") as file:
+        assert file.read() == b"first"
+
+    # replacing an artifact leaves previously opened copies intact
+    with open(path, "rb") as old_file:
+        store.put_artifact(location, "some-artifact", b"second")
+        assert old_file.read() == b"first"
+    with open(store.fetch_artifact(location, "some-artifact"), "rb") as file:
+        assert file.read() == b"second"
+
+
+def test_s3_artifacts(tmp_path, monkeypatch):
+    objects = {}
+
+    class MockS3Client:
+        def put_object(self, Bucket, Key, Body):
+            objects[(Bucket, Key)] = Body
+
+        def get_object(self, Bucket, Key):
+            if Bucket == "forbidden-bucket":
+                raise ClientError({"Error": {"Code": "AccessDenied"}}, "GetObject")
+            if (Bucket, Key) not in objects:
+                raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+            return {"Body": io.BytesIO(objects[(Bucket, Key)])}
+
+    monkeypatch.setattr("boto3.client", lambda service_name: MockS3Client())
+    monkeypatch.setattr(store, "ARTIFACT_CACHE_DIR", str(tmp_path))
+
+    assert store.fetch_artifact("s3://some-bucket/some/prefix", "some-artifact") is None
+
+    store.put_artifact("s3://some-bucket/some/prefix/", "some-artifact", b"contents")
+    store.put_artifact("s3://some-bucket", "other-artifact", b"other contents")
+    assert objects == {
+        ("some-bucket", "some/prefix/some-artifact"): b"contents",
+        ("some-bucket", "other-artifact"): b"other contents",
+    }
+
+    path = store.fetch_artifact("s3://some-bucket/some/prefix", "some-artifact")
+    with open(path, "rb") as file:
+        assert file.read() == b"contents"
+
+    with pytest.raises(ClientError):
+        store.fetch_artifact("s3://forbidden-bucket", "some-artifact")
@@ -1,14 +1,27 @@
+import io
+import json
+import multiprocessing
+import concurrent.futures
+
+import botocore.exceptions
 import pytest
 
+import bloom
 import common
+import store
+import snapshot
 import sync
 
 
 class TestSync:
     @pytest.fixture(autouse=True)
-    def monkeypatch_clients(self, monkeypatch, mock_ddb_table, mock_box_client):
+    def monkeypatch_clients(self, monkeypatch, mock_ddb_table, mock_folder_table, mock_state_table, mock_box_client):
         monkeypatch.setattr(common, "get_ddb_table", lambda: mock_ddb_table)
+        monkeypatch.setattr(common, "get_state_table", lambda: mock_state_table)
+        monkeypatch.setattr(common, "get_folder_table", lambda: mock_folder_table)
         monkeypatch.setattr(common, "get_box_client", lambda: (mock_box_client, "some-webhook-key"))
+        # the mock folders' fingerprints don't change with their contents
+        monkeypatch.setattr(sync, "FULL_DESCENT_INTERVAL", 0)
 
     def test_sync_empty(self, ddb_items):
         sync.lambda_handler({}, None)
@@ -67,6 +80,18 @@ class TestSync:
         assert file_ids == {correct_file.id, missing_file.id, unshared_file.id}
         assert common.is_box_object_public(shared_file) is False
 
+    def test_sync_folder_publicity(self, folder_items, create_folder, create_shared_folder, managed_folder):
+        shared_folder = create_shared_folder(parent_folder=managed_folder)
+        nested_folder = create_folder(parent_folder=shared_folder)
+
+        # the full walk records every folder, for the webhook's ancestor checks
+        sync.lambda_handler({}, None)
+        assert {folder_id: item["public"] for folder_id, item in folder_items.items()} == {
+            managed_folder.id: False,
+            shared_folder.id: True,
+            nested_folder.id: False,
+        }
+
     def test_sync_ddb_paging(self, ddb_items):
         for i in range(5 * 2 + 1):
             ddb_items.append(
@@ -80,3 +105,438 @@ class TestSync:
         sync.lambda_handler({}, None)
 
         assert len(ddb_items) == 0
+
+    def test_sync_snapshot(self, ddb_items, create_shared_folder, create_file, managed_folder, tmp_path, monkeypatch):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+
+        shared_folder = create_shared_folder(parent_folder=managed_folder)
+        files = [create_file(parent_folder=shared_folder) for _ in range(3)]
+
+        sync.lambda_handler({}, None)
+
+        manifest_snapshot = snapshot.load_snapshot(str(tmp_path))
+        assert len(manifest_snapshot) == len(files)
+        for item in ddb_items:
+            assert manifest_snapshot.get(item["filepath"]) == item["download_url"]
+
+        bloom_filter = bloom.load_bloom_filter(str(tmp_path))
+        assert bloom_filter.count == len(files)
+        assert all(item["filepath"] in bloom_filter for item in ddb_items)
+
+    def test_sync_snapshot_failure(
+        self, ddb_items, state_items, create_shared_folder, create_file, managed_folder, tmp_path, monkeypatch
+    ):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+
+        def denied(*args):
+            raise botocore.exceptions.ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject")
+
+        monkeypatch.setattr(snapshot, "write_snapshot", denied)
+        files = [create_file(parent_folder=create_shared_folder(parent_folder=managed_folder)) for _ in range(3)]
+
+        # the rows are written, and the sync's progress recorded, without the artifacts
+        sync.lambda_handler({}, None)
+        assert {i["box_file_id"] for i in ddb_items} == {f.id for f in files}
+        assert sync.SYNC_STATE_KEY in state_items
+        assert snapshot.load_snapshot(str(tmp_path)) is None
+
+    def test_sync_writes(
+        self, ddb_items, create_shared_folder, create_file, managed_folder, mock_ddb_table, monkeypatch
+    ):
+        shared_folder = create_shared_folder(parent_folder=managed_folder)
+        files = [create_file(parent_folder=shared_folder) for _ in range(30)]
+        sync.lambda_handler({}, None)
+        assert {i["box_file_id"] for i in ddb_items} == {f.id for f in files}
+
+        calls = []
+        monkeypatch.setattr(mock_ddb_table, "get_item", lambda *args, **kwargs: calls.append(kwargs))
+        for method in ["put_item", "update_item"]:
+            write = getattr(mock_ddb_table, method)
+
+            def counting_write(write=write, **kwargs):
+                calls.append(kwargs)
+                return write(**kwargs)
+
+            monkeypatch.setattr(mock_ddb_table, method, counting_write)
+
+        # an unchanged tree needs no writes at all
+        sync.lambda_handler({"full_sync": True}, None)
+        assert calls == []
+
+        ddb_items.append({"filepath": "some/deleted/file.dat", "box_file_id": "123456789", "download_url": "bogus"})
+        new_file = create_file(parent_folder=shared_folder)
+        sync.lambda_handler({"full_sync": True}, None)
+        assert len(calls) == 2
+        assert all("ConditionExpression" in call for call in calls)
+        assert {i["box_file_id"] for i in ddb_items} == {f.id for f in files + [new_file]}
+
+    def test_sync_unchanged(self, ddb_items, create_shared_folder, create_file, managed_folder, monkeypatch):
+        shared_folder = create_shared_folder(parent_folder=managed_folder)
+        files = [create_file(parent_folder=shared_folder) for _ in range(10)]
+        sync.lambda_handler({}, None)
+
+        fixed = []
+        make_ddb_item = common.make_ddb_item
+
+        def recording_make_ddb_item(file):
+            fixed.append(file.id)
+            return make_ddb_item(file)
+
+        monkeypatch.setattr(common, "make_ddb_item", recording_make_ddb_item)
+
+        # files whose version and link match their rows are passed over
+        sync.lambda_handler({"full_sync": True}, None)
+        assert fixed == []
+
+        files[3].sequence_id = "1"
+        sync.lambda_handler({"full_sync": True}, None)
+        assert fixed == [files[3].id]
+        assert {i["box_file_id"]: i["sequence_id"] for i in ddb_items}[files[3].id] == 1
+        assert len(ddb_items) == len(files)
+
+    def test_sync_prune(self, ddb_items, folder_items, create_shared_folder, create_file, managed_folder, monkeypatch):
+        monkeypatch.setattr(sync, "FULL_DESCENT_INTERVAL", 3600)
+        static_folder = create_shared_folder(parent_folder=managed_folder)
+        nested_folder = create_shared_folder(parent_folder=static_folder)
+        static_files = [create_file(parent_folder=folder) for folder in [static_folder, nested_folder]]
+        changing_folder = create_shared_folder(parent_folder=managed_folder)
+        create_file(parent_folder=changing_folder)
+        sync.lambda_handler({}, None)
+        assert len(ddb_items) == 3
+
+        listed = []
+        list_folder = common.list_folder
+
+        def recording_list_folder(folder, shared):
+            listed.append(folder.id)
+            return list_folder(folder, shared)
+
+        monkeypatch.setattr(common, "list_folder", recording_list_folder)
+
+        # a folder whose fingerprint changed is walked, while the others keep their rows unlisted
+        changing_folder.content_modified_at = "2020-01-02T00:00:00-08:00"
+        new_file = create_file(parent_folder=changing_folder)
+        sync.lambda_handler({"full_sync": True}, None)
+        assert listed == [managed_folder.id, changing_folder.id]
+        assert len(ddb_items) == 4
+        assert new_file.id in {i["box_file_id"] for i in ddb_items}
+        assert {f.id for f in static_files} <= {i["box_file_id"] for i in ddb_items}
+
+        # folder entries the webhook rewrites keep their fingerprints
+        box_client, _ = common.get_box_client()
+        common.sync_box_folder(box_client, common.get_ddb_table(), static_folder.id, common.get_folder_table())
+        listed.clear()
+        sync.lambda_handler({"full_sync": True}, None)
+        assert listed == [managed_folder.id]
+
+        # once the interval has passed, every folder is walked again
+        for item in folder_items.values():
+            if "descended_at" in item:
+                item["descended_at"] -= 3600
+        listed.clear()
+        sync.lambda_handler({"full_sync": True}, None)
+        assert sorted(listed) == sorted([managed_folder.id, static_folder.id, nested_folder.id, changing_folder.id])
+
+    def test_sync_state(self, state_items, box_events, managed_folder, monkeypatch):
+        box_events.extend({"event_type": "ITEM_PREVIEW", "source": None} for _ in range(3))
+        sync.lambda_handler({}, None)
+
+        state = state_items[sync.SYNC_STATE_KEY]["state"]
+        assert state["stream_position"] == 3
+
+        full_syncs = []
+
+        def full_sync(box_client, ddb_table, checkpoint, context):
+            full_syncs.append(checkpoint)
+            return dict(checkpoint, pending=[])
+
+        monkeypatch.setattr(sync, "full_sync", full_sync)
+
+        # until the full sync interval passes, only the events stream is read
+        box_events.append({"event_type": "ITEM_PREVIEW", "source": None})
+        sync.lambda_handler({}, None)
+        assert len(full_syncs) == 0
+        assert state_items[sync.SYNC_STATE_KEY]["state"]["stream_position"] == 4
+
+        sync.lambda_handler({"full_sync": True}, None)
+        assert len(full_syncs) == 1
+
+        monkeypatch.setattr(sync, "FULL_SYNC_INTERVAL", 0)
+        sync.lambda_handler({}, None)
+        assert len(full_syncs) == 2
+        assert state_items[sync.SYNC_STATE_KEY]["state"]["last_full_sync"] >= state["last_full_sync"]
+
+    def test_sync_checkpoint(
+        self,
+        ddb_items,
+        state_items,
+        folder_items,
+        box_folders,
+        create_shared_folder,
+        create_shared_file,
+        managed_folder,
+        tmp_path,
+        monkeypatch,
+    ):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+        monkeypatch.setattr(sync, "CHECKPOINT_MARGIN", 1)
+        monkeypatch.setattr(sync, "CHECKPOINT_CHUNK_SIZE", 64)
+        monkeypatch.setattr(sync, "FULL_DESCENT_INTERVAL", 3600)
+        listed = set()
+        list_folder = common.list_folder
+
+        def recording_list_folder(folder, shared):
+            listed.add(folder.id)
+            return list_folder(folder, shared)
+
+        monkeypatch.setattr(common, "list_folder", recording_list_folder)
+        ddb_items.append({"filepath": "some/deleted/file.dat", "box_file_id": "123456789", "download_url": "bogus"})
+
+        shared_files = []
+        for _ in range(3):
+            folder = create_shared_folder(parent_folder=managed_folder)
+            subfolder = create_shared_folder(parent_folder=folder)
+            shared_files.append(create_shared_file(parent_folder=folder))
+            shared_files.append(create_shared_file(parent_folder=subfolder))
+
+        class Context:
+            # enough time left to start two folder listings per invocation
+            def __init__(self):
+                self.calls = 0
+
+            def get_remaining_time_in_millis(self):
+                self.calls += 1
+                return 60000 if self.calls <= 2 else 0
+
+        invocations = 0
+        while True:
+            sync.lambda_handler({}, Context())
+            invocations += 1
+            if sync.CHECKPOINT_STATE_KEY not in state_items:
+                break
+            # the checkpoint is split across items, and only the latest one's are kept
+            header = state_items[sync.CHECKPOINT_STATE_KEY]["state"]
+            assert header["chunks"] > 1
+            assert len(state_items) == header["chunks"] + 1
+            # the stale row survives until the walk has covered the whole tree
+            assert "some/deleted/file.dat" in {item["filepath"] for item in ddb_items}
+            # and only folders whose whole subtree was listed are fingerprinted
+            unlisted = [folder for folder in box_folders if folder.id not in listed]
+            assert unlisted
+            for folder in unlisted:
+                for folder_id in [entry["id"] for entry in folder.path_collection["entries"]] + [folder.id]:
+                    assert "fingerprint" not in folder_items.get(folder_id, {})
+            assert sync.SYNC_STATE_KEY not in state_items
+            assert snapshot.load_snapshot(str(tmp_path)) is None
+
+        assert invocations > 1
+        assert list(state_items) == [sync.SYNC_STATE_KEY]
+        assert {item["filepath"] for item in ddb_items} == {common.get_filepath(f) for f in shared_files}
+        assert len(snapshot.load_snapshot(str(tmp_path))) == len(shared_files)
+
+    def test_sync_checkpoint_trashed(
+        self,
+        ddb_items,
+        state_items,
+        box_folders,
+        box_files,
+        create_shared_folder,
+        create_file,
+        managed_folder,
+        monkeypatch,
+    ):
+        monkeypatch.setattr(sync, "CHECKPOINT_MARGIN", 1)
+        folders = [create_shared_folder(parent_folder=managed_folder) for _ in range(3)]
+        files = {folder.id: [create_file(parent_folder=folder) for _ in range(2)] for folder in folders}
+        sync.lambda_handler({"full_sync": True}, None)
+        assert len(ddb_items) == 6
+
+        class Context:
+            def __init__(self):
+                self.calls = 0
+
+            def get_remaining_time_in_millis(self):
+                self.calls += 1
+                return 60000 if self.calls <= 2 else 0
+
+        sync.lambda_handler({"full_sync": True}, Context())
+        pending = sync._load_checkpoint(common.get_state_table())["pending"]
+        assert pending
+
+        # a pending folder trashed before the walk resumes is passed over, and its rows go
+        trashed = next(folder for folder in folders if folder.id == pending[0]["id"])
+        box_folders[:] = [f for f in box_folders if f is not trashed]
+        box_files[:] = [f for f in box_files if f.id not in {file.id for file in files[trashed.id]}]
+        sync.lambda_handler({}, None)
+        assert sync.CHECKPOINT_STATE_KEY not in state_items
+        assert sync.SYNC_STATE_KEY in state_items
+        expected = {f.id for folder in folders if folder is not trashed for f in files[folder.id]}
+        assert {i["box_file_id"] for i in ddb_items} == expected
+
+    @pytest.fixture
+    def sharded_tree(
+        self, ddb_items, create_folder, create_shared_folder, create_file, create_shared_file, managed_folder
+    ):
+        # returns the top-level folders, and the files that should be in the manifest after a full sync
+        folders, expected = [], []
+        create_shared_file(parent_folder=managed_folder)
+        for i in range(3):
+            folder = create_folder(parent_folder=managed_folder)
+            shared_folder = create_shared_folder(parent_folder=folder)
+            create_shared_file(parent_folder=folder)
+            expected.extend(create_file(parent_folder=shared_folder) for _ in range(i + 1))
+            folders.append(folder)
+            ddb_items.extend(
+                {
+                    "filepath": f"{folder.name}/deleted-{j}.dat",
+                    "box_file_id": "123456789",
+                    "download_url": "bogus",
+                    "path_root": folder.name,
+                }
+                for j in range(i + 1)
+            )
+
+        # rows of a deleted top-level folder, and of a deleted file in the managed folder
+        ddb_items.append({"filepath": "deleted/file.dat", "box_file_id": "123456789", "download_url": "bogus"})
+        ddb_items.append({"filepath": "deleted.dat", "box_file_id": "123456789", "download_url": "bogus"})
+        return folders, expected
+
+    def test_sync_sharded_lambda(self, ddb_items, state_items, sharded_tree, tmp_path, monkeypatch):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+        monkeypatch.setattr(sync, "SYNC_DISPATCH", "lambda")
+        monkeypatch.setattr(sync, "SYNC_WORKERS", 1)
+        folders, expected = sharded_tree
+        shards = []
+
+        class MockLambdaClient:
+            def invoke(self, FunctionName, Payload):
+                event = json.loads(Payload)
+                shards.append(event["shard"]["id"])
+                result = sync.shard_lambda_handler(event, None)
+                return {"Payload": io.BytesIO(json.dumps(result).encode("utf-8"))}
+
+        monkeypatch.setattr(sync.boto3, "client", lambda *args, **kwargs: MockLambdaClient())
+
+        sync.lambda_handler({}, None)
+
+        assert {item["filepath"] for item in ddb_items} == {common.get_filepath(f) for f in expected}
+        assert len(snapshot.load_snapshot(str(tmp_path))) == len(expected)
+        assert sync.SYNC_STATE_KEY in state_items
+        # the shards with the most rows are dispatched first
+        assert shards == [folder.id for folder in reversed(folders)]
+
+    def test_sync_sharded_processes(self, ddb_items, sharded_tree, monkeypatch):
+        monkeypatch.setattr(sync, "SYNC_DISPATCH", "process")
+        # threads share the mock tables with the test, unlike processes
+        monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor)
+        folders, expected = sharded_tree
+        # rows written before path_root was, which the workers' index leaves out
+        ddb_items.append({"filepath": common.get_filepath(expected[0]), "box_file_id": expected[0].id})
+        ddb_items.append({"filepath": f"{folders[0].name}/legacy.dat", "box_file_id": "123456789"})
+
+        sync.lambda_handler({}, None)
+        assert {item["filepath"] for item in ddb_items} == {common.get_filepath(f) for f in expected}
+        assert all("path_root" in item for item in ddb_items)
+
+    @pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="workers must inherit the mock clients")
+    def test_sync_sharded_process_pool(self, sharded_tree, mock_ddb_table, monkeypatch):
+        folders, expected = sharded_tree
+        # each worker reads its rows from the path_root index rather than scanning the table
+        monkeypatch.setattr(mock_ddb_table, "scan", None)
+        results = sync._dispatch_processes([common.dump_folder(folder, False) for folder in folders])
+        assert [result["written"] for result in results] == [1, 2, 3]
+        assert [result["deleted"] for result in results] == [1, 2, 3]
+        assert all(result["complete"] for result in results)
+
+    def test_sync_incremental(
+        self,
+        ddb_items,
+        box_events,
+        create_folder,
+        create_file,
+        create_shared_file,
+        create_shared_folder,
+        managed_folder,
+        tmp_path,
+        monkeypatch,
+    ):
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+        sync.lambda_handler({}, None)
+
+        shared_folder = create_shared_folder(parent_folder=managed_folder)
+        new_file = create_file(parent_folder=shared_folder)
+        unshared_file = create_shared_file(parent_folder=managed_folder)
+        ddb_items.append(common.make_ddb_item(unshared_file))
+        outside_file = create_file()
+        # untouched by any event, so left alone until the next full sync
+        ignored_file = create_file(parent_folder=shared_folder)
+
+        box_events.extend(
+            [
+                {"event_type": "ITEM_UPLOAD", "source": {"type": "file", "id": new_file.id}},
+                {"event_type": "ITEM_UPLOAD", "source": {"type": "file", "id": new_file.id}},
+                {"event_type": "ITEM_SHARED_CREATE", "source": {"type": "file", "id": unshared_file.id}},
+                {"event_type": "ITEM_UPLOAD", "source": {"type": "file", "id": outside_file.id}},
+                {"event_type": "ITEM_PREVIEW", "source": {"type": "file", "id": ignored_file.id}},
+                {"event_type": "ITEM_TRASH", "source": {"type": "file", "id": "123456789"}},
+                {"event_type": "COLLAB_INVITE", "source": None},
+            ]
+        )
+        sync.lambda_handler({}, None)
+
+        assert {i["box_file_id"] for i in ddb_items} == {new_file.id}
+        assert common.is_box_object_public(unshared_file) is False
+        assert common.is_box_object_public(outside_file) is False
+        assert common.is_box_object_public(ignored_file) is False
+
+        # the published artifacts are rebuilt to include the change
+        manifest_snapshot = snapshot.load_snapshot(str(tmp_path))
+        assert manifest_snapshot.get(common.get_filepath(new_file)) == new_file.shared_link["download_url"]
+
+        box_events.append({"event_type": "ITEM_MOVE", "source": {"type": "folder", "id": shared_folder.id}})
+        sync.lambda_handler({}, None)
+        assert {i["box_file_id"] for i in ddb_items} == {new_file.id, ignored_file.id}
+
+    def test_sync_incremental_artifacts_unchanged(
+        self, ddb_items, box_files, box_events, create_file, create_shared_folder, managed_folder, tmp_path, monkeypatch
+    ):
+        published = []
+        monkeypatch.setattr(sync, "_publish_artifacts", published.append)
+        shared_folder = create_shared_folder(parent_folder=managed_folder)
+        shared_file = create_file(parent_folder=shared_folder)
+        sync.lambda_handler({}, None)
+        assert len(ddb_items) == 1
+        published.clear()
+
+        # events that change no rows leave the artifacts as they are
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", str(tmp_path))
+        box_events.extend(
+            [
+                {"event_type": "ITEM_UPLOAD", "source": {"type": "file", "id": create_file().id}},
+                {"event_type": "ITEM_UPLOAD", "source": {"type": "file", "id": shared_file.id}},
+            ]
+        )
+        sync.lambda_handler({}, None)
+        assert published == []
+
+        box_files.remove(shared_file)
+        box_events.append({"event_type": "ITEM_TRASH", "source": {"type": "file", "id": shared_file.id}})
+        sync.lambda_handler({}, None)
+        assert published == [{}]
+
+        # and without somewhere to publish them, they aren't rebuilt at all
+        monkeypatch.setattr(store, "ARTIFACT_LOCATION", None)
+        box_events.append(
+            {"event_type": "ITEM_UPLOAD", "source": {"type": "file", "id": create_file(parent_folder=shared_folder).id}}
+        )
+        sync.lambda_handler({}, None)
+        assert len(ddb_items) == 1
+        assert published == [{}]
+
+    def test_sync_incremental_paging(self, state_items, box_events, monkeypatch):
+        sync.lambda_handler({}, None)
+
+        monkeypatch.setattr(sync, "EVENTS_PAGE_LIMIT", 2)
+        box_events.extend({"event_type": "ITEM_PREVIEW", "source": None} for _ in range(5))
+        sync.lambda_handler({}, None)
+        assert state_items[sync.SYNC_STATE_KEY]["state"]["stream_position"] == 5
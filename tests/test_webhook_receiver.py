@@ -1,10 +1,14 @@
 import json
 import base64
+import datetime
 
 import pytest
 
+import coalesce
 import common
+import queues
 import webhook_receiver
+import webhook_worker
 
 SHARED_LINK_TRIGGERS = {"SHARED_LINK.CREATED", "SHARED_LINK.UPDATED", "SHARED_LINK.DELETED"}
 
@@ -12,33 +16,83 @@ SHARED_LINK_TRIGGERS = {"SHARED_LINK.CREATED", "SHARED_LINK.UPDATED", "SHARED_LI
 def handle_event(event):
     assert webhook_receiver.lambda_handler(event, {})["statusCode"] == 200
 
+    # the receiver only queues events, so deliver them to the worker as SQS would
+    webhook_queue = queues.get_webhook_queue()
+    webhook_queue.drain(webhook_worker.lambda_handler)
+    assert webhook_queue.dead_letters == []
+
 
 class TestWebhookReceiver:
     @pytest.fixture(autouse=True)
-    def monkeypatch_clients(self, monkeypatch, mock_ddb_table, mock_box_client, box_webhook_signature_key):
+    def webhook_queue(self, monkeypatch):
+        webhook_queue = queues.MemoryQueue()
+        monkeypatch.setattr(queues, "get_webhook_queue", lambda: webhook_queue)
+        monkeypatch.setattr(webhook_worker, "COALESCER", coalesce.Coalescer())
+        return webhook_queue
+
+    @pytest.fixture(autouse=True)
+    def monkeypatch_clients(
+        self, monkeypatch, mock_ddb_table, mock_folder_table, mock_box_client, box_webhook_signature_key
+    ):
         monkeypatch.setattr(common, "get_ddb_table", lambda: mock_ddb_table)
+        monkeypatch.setattr(common, "get_folder_table", lambda: mock_folder_table)
         monkeypatch.setattr(common, "get_box_client", lambda: (mock_box_client, box_webhook_signature_key))
+        monkeypatch.setattr(common, "get_secret", lambda: {"box_webhook_signature_key": box_webhook_signature_key})
 
     @pytest.fixture
     def create_webhook_event(self, box_webhook_signature_key, box_webhook_id, compute_webhook_signature):
-        def _create_webhook_event(trigger, box_object, signature=None):
+        def _create_webhook_event(trigger, box_object, signature=None, timestamp=None):
             source = {"item": {"id": box_object.id, "type": box_object.type}}
 
             body = {"trigger": trigger, "source": source, "webhook": {"id": box_webhook_id}}
             json_body = json.dumps(body)
+            if not timestamp:
+                timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
             if not signature:
-                signature = compute_webhook_signature(bytes(json_body, "utf-8"))
+                signature = compute_webhook_signature(bytes(json_body + timestamp, "utf-8"))
 
-            return {"body": json_body, "headers": {"box-signature-primary": signature}}
+            headers = {
+                "box-signature-version": "1",
+                "box-signature-algorithm": "HmacSHA256",
+                "box-delivery-timestamp": timestamp,
+                "box-signature-primary": signature,
+            }
+            return {"body": json_body, "headers": headers}
 
         return _create_webhook_event
 
-    def test_invalid_signature(self, create_webhook_event, create_shared_file, ddb_items):
+    def test_invalid_signature(self, create_webhook_event, create_shared_file, ddb_items, monkeypatch):
+        # invalid requests never get as far as authenticating with Box
+        monkeypatch.setattr(common, "get_box_client", lambda: pytest.fail("authenticated with Box"))
         file = create_shared_file()
         event = create_webhook_event("SHARED_LINK.CREATED", file, signature=base64.b64encode(b"nope").decode("utf-8"))
         handle_event(event)
         assert len(ddb_items) == 0
 
+        # nor do replays of a valid request
+        event = create_webhook_event("SHARED_LINK.CREATED", file, timestamp="2020-01-01T00:00:00-08:00")
+        handle_event(event)
+        assert len(ddb_items) == 0
+
+    def test_queued(self, create_webhook_event, create_shared_file, webhook_queue, monkeypatch):
+        # the receiver answers without touching Box or DynamoDB
+        monkeypatch.setattr(common, "get_box_client", lambda: pytest.fail("authenticated with Box"))
+        monkeypatch.setattr(common, "get_ddb_table", lambda: pytest.fail("read DynamoDB"))
+        file = create_shared_file()
+        event = create_webhook_event("FILE.TRASHED", file)
+        event["headers"]["BOX-DELIVERY-ID"] = "some-delivery-id"
+        assert webhook_receiver.lambda_handler(event, {})["statusCode"] == 200
+
+        (record,) = webhook_queue.receive()
+        message = json.loads(record["body"])
+        assert message == {
+            "trigger": "FILE.TRASHED",
+            "box_type": "file",
+            "box_id": file.id,
+            "delivery_id": "some-delivery-id",
+            "delivered_at": event["headers"]["box-delivery-timestamp"],
+        }
+
     def test_unhandled_webhook(self, create_webhook_event, create_shared_file, ddb_items):
         file = create_shared_file()
         event = create_webhook_event("FILE.BLORPED", file)
@@ -101,7 +155,7 @@ class TestWebhookReceiver:
 
     def test_shared_link_deleted(self, create_webhook_event, create_file, ddb_items, managed_folder):
         file = create_file(parent_folder=managed_folder)
-        ddb_items.append({"filepath": common.get_filepath(file)})
+        ddb_items.append({"filepath": common.get_filepath(file), "box_file_id": file.id, "download_url": "some-url"})
         event = create_webhook_event("SHARED_LINK.DELETED", file)
         handle_event(event)
         assert len(ddb_items) == 0
@@ -112,7 +166,7 @@ class TestWebhookReceiver:
         box_files.remove(file)
         event = create_webhook_event("FILE.TRASHED", file)
         handle_event(event)
-        assert len(ddb_items) == 1
+        assert len(ddb_items) == 0
 
     def test_file_restored(
         self, create_webhook_event, create_file, ddb_items, box_files, create_shared_folder, managed_folder
@@ -139,8 +193,34 @@ class TestWebhookReceiver:
         ddb_items.append({"filepath": "some/old/path.dat", "box_file_id": file.id, "download_url": "some-download-url"})
         event = create_webhook_event("FILE.MOVED", file)
         handle_event(event)
-        assert len(ddb_items) == 2
-        assert {i["filepath"] for i in ddb_items} == {"some/old/path.dat", common.get_filepath(file)}
+        assert len(ddb_items) == 1
+        assert ddb_items[0]["filepath"] == common.get_filepath(file)
+
+    def test_file_moved_private(
+        self,
+        create_webhook_event,
+        create_shared_file,
+        create_folder,
+        ddb_items,
+        box_files,
+        managed_folder,
+        create_shared_folder,
+    ):
+        # moving a file from a shared folder to a private one removes its row at the old path
+        file = create_shared_file(parent_folder=create_shared_folder(parent_folder=managed_folder))
+        ddb_items.append(common.make_ddb_item(file))
+        box_files.remove(file)
+        file = create_shared_file(id=file.id, parent_folder=create_folder(parent_folder=managed_folder))
+        event = create_webhook_event("FILE.MOVED", file)
+        handle_event(event)
+        assert len(ddb_items) == 0
+
+    def test_file_moved_unmanaged(self, create_webhook_event, create_shared_file, create_folder, ddb_items, box_files):
+        file = create_shared_file(parent_folder=create_folder())
+        ddb_items.append({"filepath": "some/old/path.dat", "box_file_id": file.id, "download_url": "some-download-url"})
+        event = create_webhook_event("FILE.MOVED", file)
+        handle_event(event)
+        assert len(ddb_items) == 0
 
     def test_folder_restored(self, create_shared_folder, managed_folder, create_file, create_webhook_event, ddb_items):
         folder = create_shared_folder(parent_folder=managed_folder)
@@ -162,8 +242,34 @@ class TestWebhookReceiver:
         box_folders.clear()
         event = create_webhook_event("FOLDER.TRASHED", folder)
         handle_event(event)
+        # without a record of where the folder was, its rows are left to the sync lambda
         assert len(ddb_items) == 2
 
+    def test_folder_trashed_cached(
+        self,
+        create_folder,
+        managed_folder,
+        create_shared_file,
+        create_webhook_event,
+        ddb_items,
+        box_folders,
+        folder_items,
+    ):
+        folder = create_folder(parent_folder=managed_folder)
+        subfolder = create_folder(parent_folder=folder)
+        files = [create_shared_file(parent_folder=subfolder) for _ in range(7)]
+        other_file = create_shared_file(parent_folder=managed_folder)
+        for file in files + [other_file]:
+            ddb_items.append(common.make_ddb_item(file))
+        common.put_folder_publicity(common.get_folder_table(), [folder, subfolder])
+        box_folders.remove(folder)
+        box_folders.remove(subfolder)
+
+        event = create_webhook_event("FOLDER.TRASHED", folder)
+        handle_event(event)
+        assert [i["box_file_id"] for i in ddb_items] == [other_file.id]
+        assert folder.id not in folder_items
+
     def test_folder_moved(self, create_shared_folder, managed_folder, create_file, create_webhook_event, ddb_items):
         folder = create_shared_folder(parent_folder=managed_folder)
         file1 = create_file(parent_folder=folder)
@@ -176,10 +282,73 @@ class TestWebhookReceiver:
         )
         event = create_webhook_event("FOLDER.MOVED", folder)
         handle_event(event)
-        assert len(ddb_items) == 4
-        assert {i["filepath"] for i in ddb_items} == {
-            "some/old/path1.dat",
-            "some/old/path2.dat",
-            common.get_filepath(file1),
-            common.get_filepath(file2),
+        # the rows at the files' old paths go as the new ones are written
+        assert len(ddb_items) == 2
+        assert {i["filepath"] for i in ddb_items} == {common.get_filepath(file1), common.get_filepath(file2)}
+
+    def test_folder_moved_cached(
+        self, create_folder, managed_folder, create_file, create_webhook_event, ddb_items, folder_items
+    ):
+        folder = create_folder(parent_folder=managed_folder)
+        files = [create_file(parent_folder=folder) for _ in range(7)]
+        folder_items[folder.id] = {
+            "folder_id": folder.id,
+            "public": True,
+            "shared": True,
+            "expires_at": 2**40,
+            "path": "old/place",
         }
+        for file in files:
+            filepath = f"old/place/{file.name}"
+            ddb_items.append(
+                {"filepath": filepath, "box_file_id": file.id, "download_url": "some-download-url", "path_root": "old"}
+            )
+
+        # the folder's files are no longer shared where it has moved to, so only its old path has rows
+        event = create_webhook_event("FOLDER.MOVED", folder)
+        handle_event(event)
+        assert ddb_items == []
+        assert folder_items[folder.id]["path"] == common.get_filepath(folder)
+        assert folder_items[folder.id]["shared"] is False
+
+    def test_folder_moved_shared(
+        self,
+        create_shared_folder,
+        create_folder,
+        managed_folder,
+        create_shared_file,
+        create_webhook_event,
+        ddb_items,
+        folder_items,
+        monkeypatch,
+    ):
+        folder = create_shared_folder(parent_folder=managed_folder)
+        subfolder = create_folder(parent_folder=folder)
+        files = [create_shared_file(parent_folder=f) for f in [folder, folder, subfolder]]
+        for path, f in [("old/place", folder), (f"old/place/{subfolder.name}", subfolder)]:
+            folder_items[f.id] = {
+                "folder_id": f.id,
+                "public": f is folder,
+                "shared": True,
+                "expires_at": 0,
+                "path": path,
+            }
+        for file in files:
+            filepath = "old/place/" + common.get_filepath(file)[len(common.get_filepath(folder)) + 1 :]
+            ddb_items.append(dict(common.make_ddb_item(file), filepath=filepath, path_root="old"))
+        ddb_items.append(common.make_ddb_item(create_shared_file(parent_folder=managed_folder)))
+        other_items = list(ddb_items[-1:])
+
+        def failing_list_folder(folder, shared):
+            raise AssertionError("listed a folder")
+
+        monkeypatch.setattr(common, "list_folder", failing_list_folder)
+
+        # the folder's files are shared as they were, so their rows move along with it without a walk
+        event = create_webhook_event("FOLDER.MOVED", folder)
+        handle_event(event)
+        assert sorted(ddb_items, key=lambda i: i["filepath"]) == sorted(
+            [common.make_ddb_item(file) for file in files] + other_items, key=lambda i: i["filepath"]
+        )
+        assert folder_items[folder.id]["path"] == common.get_filepath(folder)
+        assert folder_items[subfolder.id]["path"] == common.get_filepath(subfolder)
@@ -0,0 +1,163 @@
+import json
+
+import boxsdk
+import pytest
+
+import coalesce
+import common
+import queues
+import webhook_worker
+
+
+class TestWebhookWorker:
+    @pytest.fixture(autouse=True)
+    def monkeypatch_clients(self, monkeypatch, mock_ddb_table, mock_folder_table, mock_box_client):
+        monkeypatch.setattr(common, "get_ddb_table", lambda: mock_ddb_table)
+        monkeypatch.setattr(common, "get_folder_table", lambda: mock_folder_table)
+        monkeypatch.setattr(common, "get_box_client", lambda: (mock_box_client, "some-webhook-key"))
+        monkeypatch.setattr(webhook_worker, "COALESCER", coalesce.Coalescer())
+
+    def test_batch(self, create_shared_folder, create_file, managed_folder, ddb_items, monkeypatch):
+        folder = create_shared_folder(parent_folder=managed_folder)
+        files = [create_file(parent_folder=folder) for _ in range(3)]
+
+        failing_id = files[1].id
+        attempts = []
+        sync_box_file = common.sync_box_file
+
+        def failing_sync_box_file(client, ddb, box_id, folder_table=None):
+            if box_id == failing_id:
+                attempts.append(box_id)
+                raise boxsdk.exception.BoxAPIException(500)
+            return sync_box_file(client, ddb, box_id, folder_table)
+
+        monkeypatch.setattr(common, "sync_box_file", failing_sync_box_file)
+
+        queue = queues.MemoryQueue(max_receives=2)
+        queue.send_batch(
+            [
+                {"trigger": "FILE.RESTORED", "box_type": "file", "box_id": f.id, "delivery_id": f"delivery-{f.id}"}
+                for f in files
+            ]
+        )
+        queue.drain(webhook_worker.lambda_handler)
+
+        # only the failing event is redelivered, until it's given up on
+        assert {i["box_file_id"] for i in ddb_items} == {files[0].id, files[2].id}
+        assert attempts == [failing_id, failing_id]
+        assert [message["box_id"] for message in queue.dead_letters] == [failing_id]
+
+    def test_unauthorized(self, create_file, monkeypatch):
+        file = create_file()
+
+        def unauthorized_sync_box_file(*args):
+            raise boxsdk.exception.BoxAPIException(401)
+
+        monkeypatch.setattr(common, "sync_box_file", unauthorized_sync_box_file)
+        invalidations = []
+        monkeypatch.setattr(common, "invalidate_box_client", lambda: invalidations.append(None))
+
+        # bad credentials fail the whole batch, and drop the cached client
+        record = {
+            "messageId": "1",
+            "body": json.dumps({"trigger": "FILE.RESTORED", "box_type": "file", "box_id": file.id}),
+        }
+        with pytest.raises(boxsdk.exception.BoxAPIException):
+            webhook_worker.lambda_handler({"Records": [record]}, None)
+        assert len(invalidations) == 1
+
+    def test_duplicates(self, create_shared_file, managed_folder, ddb_items, monkeypatch):
+        file = create_shared_file(parent_folder=managed_folder)
+        synced = []
+        monkeypatch.setattr(
+            common, "sync_box_file", lambda client, ddb, box_id, folder_table=None: synced.append(box_id)
+        )
+
+        delivered_at = "2020-01-01T00:00:00+00:00"
+        message = {"trigger": "FILE.RESTORED", "box_type": "file", "box_id": file.id, "delivered_at": delivered_at}
+        queue = queues.MemoryQueue()
+        queue.send_batch(
+            [
+                dict(message, delivery_id="1"),
+                dict(message, trigger="SHARED_LINK.CREATED", delivery_id="2"),
+                # Box's retry of the first delivery
+                dict(message, delivery_id="1"),
+                {"trigger": "SHARED_LINK.CREATED", "box_type": "web_link", "box_id": "some-id"},
+            ]
+        )
+        queue.drain(webhook_worker.lambda_handler)
+        assert synced == [file.id]
+        assert webhook_worker.COALESCER.dropped == 1
+
+        # Box retrying a delivery that was processed is dropped
+        queue.send(dict(message, delivery_id="2", delivered_at="2020-01-01T00:01:00+00:00"))
+        queue.drain(webhook_worker.lambda_handler)
+        assert synced == [file.id]
+
+        # an event delivered before the item was last processed is already settled
+        queue.send(dict(message, delivery_id="3"))
+        queue.drain(webhook_worker.lambda_handler)
+        assert synced == [file.id]
+
+    def test_duplicates_failure(self, create_shared_file, managed_folder, monkeypatch):
+        file = create_shared_file(parent_folder=managed_folder)
+        attempts = []
+
+        def failing_sync_box_file(client, ddb, box_id, folder_table=None):
+            attempts.append(box_id)
+            if len(attempts) == 1:
+                raise boxsdk.exception.BoxAPIException(500)
+
+        monkeypatch.setattr(common, "sync_box_file", failing_sync_box_file)
+
+        # a delivery whose processing failed isn't remembered, so Box's retry of it is processed
+        message = {"trigger": "FILE.RESTORED", "box_type": "file", "box_id": file.id, "delivery_id": "1"}
+        queue = queues.MemoryQueue(max_receives=1)
+        queue.send(message)
+        queue.drain(webhook_worker.lambda_handler)
+        assert attempts == [file.id]
+        assert len(queue.dead_letters) == 1
+
+        queue.send(message)
+        queue.drain(webhook_worker.lambda_handler)
+        assert attempts == [file.id, file.id]
+
+        # once processed, it is
+        queue.send(message)
+        queue.drain(webhook_worker.lambda_handler)
+        assert attempts == [file.id, file.id]
+
+    def test_nested_folders(self, create_folder, managed_folder, monkeypatch):
+        outer = create_folder(parent_folder=managed_folder)
+        inner = create_folder(parent_folder=outer)
+        innermost = create_folder(parent_folder=inner)
+        sibling = create_folder(parent_folder=managed_folder)
+        synced = []
+        monkeypatch.setattr(
+            common, "sync_box_folder", lambda client, ddb, box_id, folder_table=None: synced.append(box_id)
+        )
+
+        queue = queues.MemoryQueue()
+        queue.send_batch(
+            [
+                {"trigger": "FOLDER.RESTORED", "box_type": "folder", "box_id": folder.id}
+                for folder in [innermost, sibling, outer, inner]
+            ]
+        )
+        queue.drain(webhook_worker.lambda_handler)
+        assert synced == [sibling.id, outer.id]
+
+    def test_nested_folders_failure(self, create_folder, managed_folder, monkeypatch):
+        outer = create_folder(parent_folder=managed_folder)
+        inner = create_folder(parent_folder=outer)
+
+        def failing_sync_box_folder(client, ddb, box_id, folder_table=None):
+            raise boxsdk.exception.BoxAPIException(500)
+
+        monkeypatch.setattr(common, "sync_box_folder", failing_sync_box_folder)
+
+        # a failed walk fails the events it would have settled
+        queue = queues.MemoryQueue(max_receives=1)
+        queue.send_batch([{"trigger": "FOLDER.RESTORED", "box_type": "folder", "box_id": f.id} for f in [inner, outer]])
+        queue.drain(webhook_worker.lambda_handler)
+        assert sorted(message["box_id"] for message in queue.dead_letters) == sorted([inner.id, outer.id])